@@ -0,0 +1,83 @@
+# ----------------------------------------------------------------------
+# Copyright (C) 2015 by Rafael Gonzalez
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+'''
+Encoded acknowledge benchmark.
+
+Acknowledges a stream of msgIds cycling through the 16 bit range, as
+a subscriber does, with C{encodeAck}, which packs each frame as it is
+needed. Two caches of encoded frames, tried before, are measured as
+well, to show why they were dropped: a 256 frame least recently used
+cache is several times slower than packing, and a lazily filled 65536
+slot list saves some 30 ns on an acknowledge path taking over 10 us
+(see bench_acks.py), at the cost of about 3 MB per packet type.
+
+Usage: python bench/bench_ackframes.py
+'''
+
+import struct
+import timeit
+from collections import OrderedDict
+
+from mqtt.pdu import encodeAck
+
+
+N    = 65535
+_ACK = struct.Struct('!BBH')
+
+
+def best(run, n, repeat=9):
+    return 1e9 * min(timeit.repeat(run, number=1, repeat=repeat)) / n
+
+
+def encodeAckLRU(code, msgId, frames=OrderedDict()):
+    try:
+        frame = frames[msgId]
+    except KeyError:
+        frame = frames[msgId] = _ACK.pack(code, 0x02, msgId)
+        if len(frames) > 256:
+            frames.popitem(last=False)
+    else:
+        frames.move_to_end(msgId)
+    return frame
+
+
+def encodeAckSlots(code, msgId, frames=[None] * 65536):
+    if not 0 <= msgId <= 0xFFFF:
+        raise ValueError(msgId)
+    frame = frames[msgId]
+    if frame is None:
+        frame = frames[msgId] = _ACK.pack(code, 0x02, msgId)
+    return frame
+
+
+if __name__ == '__main__':
+    msgIds = list(range(1, N+1))
+    for encode, label in ((encodeAck, "packed each time"), 
+                          (encodeAckLRU, "LRU 256         "), 
+                          (encodeAckSlots, "65536-slot list ")):
+        def run():
+            for msgId in msgIds:
+                encode(0x40, msgId)
+        run()   # fill the caches
+        print("PUBACK, {0} : {1:6.0f} ns/ack".format(label, best(run, N)))
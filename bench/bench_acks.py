@@ -0,0 +1,133 @@
+# ----------------------------------------------------------------------
+# Copyright (C) 2015 by Rafael Gonzalez
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+
+'''
+In-flight table benchmark.
+
+Publishes 10,000 QoS 1 messages, so that all of them are waiting for
+their PUBACK, and reports the cost of processing the PUBACK stream
+through the full protocol path. The table operations alone are then
+compared with the former per address dictionaries, which needed a
+double lookup (C{factory.windowPublish[addr][msgId]}) on each ACK.
+
+Usage: python bench/bench_acks.py
+'''
+
+import timeit
+
+from twisted.internet import reactor
+from twisted.internet.testing import StringTransport
+
+from mqtt                   import v311
+from mqtt.pdu               import CONNACK, encodeAck
+from mqtt.client.base       import MQTTBaseProtocol
+from mqtt.client.factory    import MQTTFactory
+
+
+N = 10000
+
+
+def connectedPublisher():
+    # The reactor keeps its timers in a heap. task.Clock sorts them
+    # on every callLater() and would dominate the measurement.
+    MQTTBaseProtocol.callLater = reactor.callLater
+    MQTTBaseProtocol.clock     = reactor
+    factory  = MQTTFactory(MQTTFactory.PUBLISHER)
+    protocol = factory.buildProtocol(0)
+    protocol.makeConnection(StringTransport())
+    protocol.connect("bench", keepalive=0, version=v311)
+    ack = CONNACK()
+    ack.session    = False
+    ack.resultCode = 0
+    protocol.dataReceived(ack.encode())
+    protocol._window = N    # all messages in flight at once
+    return protocol
+
+
+def fullPath(repeat=5):
+    '''Best time per PUBACK in nanoseconds, publishing excluded'''
+    best = None
+    for i in range(repeat):
+        protocol = connectedPublisher()
+        ids = [protocol.publish("sensors/room1/temperature", b"21.5", qos=1).msgId for j in range(N)]
+        assert len(protocol.session.windowPublish) == N
+        stream = b''.join(encodeAck(0x40, msgId) for msgId in ids)
+        t = timeit.timeit(lambda: protocol.dataReceived(stream), number=1)
+        assert len(protocol.session.windowPublish) == 0
+        best = t if best is None else min(best, t)
+    return 1e9 * best / N
+
+
+class LegacyFactory(object):
+    '''Former layout, one dictionary per broker address'''
+    def __init__(self, addr):
+        self.windowPublish = {addr: {}}
+
+
+class Session(object):
+    def __init__(self, window):
+        self.windowPublish = window
+
+
+def legacyTable(repeat=5):
+    addr    = ('127.0.0.1', 1883)
+    factory = LegacyFactory(addr)
+    def run():
+        for msgId in range(1, N+1):
+            factory.windowPublish[addr][msgId] = msgId
+        for msgId in range(1, N+1):
+            factory.windowPublish[addr][msgId]
+            del factory.windowPublish[addr][msgId]
+    return 1e9 * min(timeit.repeat(run, number=1, repeat=repeat)) / N
+
+
+def sessionTable(repeat=5):
+    session = Session({})
+    def run():
+        for msgId in range(1, N+1):
+            session.windowPublish[msgId] = msgId
+        for msgId in range(1, N+1):
+            session.windowPublish[msgId]
+            del session.windowPublish[msgId]
+    return 1e9 * min(timeit.repeat(run, number=1, repeat=repeat)) / N
+
+
+def sessionSlots(repeat=5):
+    '''A bare 65536-slot list, without size nor ordering bookkeeping'''
+    session = Session([None] * 65536)
+    def run():
+        for msgId in range(1, N+1):
+            session.windowPublish[msgId] = msgId
+        for msgId in range(1, N+1):
+            session.windowPublish[msgId]
+            session.windowPublish[msgId] = None
+    return 1e9 * min(timeit.repeat(run, number=1, repeat=repeat)) / N
+
+
+if __name__ == '__main__':
+    print("PUBACK, full path, {0} in flight : {1:6.0f} ns/ack".format(N, fullPath()))
+    print("table insert + lookup + delete:")
+    print("  per address dict of dicts : {0:6.0f} ns".format(legacyTable()))
+    print("  session dict              : {0:6.0f} ns".format(sessionTable()))
+    print("  session 65536-slot list   : {0:6.0f} ns".format(sessionSlots()))
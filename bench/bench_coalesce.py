@@ -0,0 +1,143 @@
+# ----------------------------------------------------------------------
+# Copyright (C) 2015 by Rafael Gonzalez
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+'''
+Output coalescing benchmark.
+
+Publishes N small QoS 0 messages in a loop, as a sensor gateway 
+replaying a backlog does, and reports the cost per message and the
+number of transport writes, with and without output coalescing.
+A real TCP connection on the loopback interface is then used to 
+report the time needed to get the whole burst out of the process.
+
+Usage: python bench/bench_coalesce.py
+'''
+
+import timeit
+
+from twisted.internet import reactor, protocol, defer
+from twisted.internet.testing import StringTransport
+
+from mqtt                   import v311
+from mqtt.pdu               import CONNACK
+from mqtt.client.base       import MQTTBaseProtocol
+from mqtt.client.factory    import MQTTFactory
+
+
+N = 50000
+
+
+class Transport(StringTransport):
+    '''Counts writes, throwing away the data'''
+
+    writes = 0
+
+    def write(self, data):
+        self.writes += 1
+
+    def writeSequence(self, seq):
+        self.writes += 1
+
+
+def connected(protocol):
+    protocol.connect("bench", keepalive=0, version=v311)
+    ack = CONNACK()
+    ack.session    = False
+    ack.resultCode = 0
+    protocol.dataReceived(ack.encode())
+    return protocol
+
+
+def bench(coalescing, repeat=5):
+    '''Best time per message in nanoseconds and number of writes'''
+    MQTTBaseProtocol.callLater = reactor.callLater
+    MQTTBaseProtocol.clock     = reactor
+    best = None
+    for i in range(repeat):
+        factory  = MQTTFactory(MQTTFactory.PUBLISHER)
+        protocol = factory.buildProtocol(0)
+        protocol.makeConnection(Transport())
+        connected(protocol)
+        if coalescing:
+            protocol.setCoalescing(0.001)
+        protocol.transport.writes = 0
+        def run():
+            for j in range(N):
+                protocol.publish("sensors/room1/temperature", b"21.5")
+            protocol._flush()
+        t = timeit.timeit(run, number=1)
+        best = t if best is None else min(best, t)
+    return 1e9 * best / N, protocol.transport.writes
+
+
+class Sink(protocol.Protocol):
+    '''Broker stand-in, counting the bytes received'''
+
+    def dataReceived(self, data):
+        self.factory.received += len(data)
+        if self.factory.received >= self.factory.expected:
+            self.factory.done.callback(None)
+
+
+@defer.inlineCallbacks
+def loopback(coalescing):
+    '''Seconds from the first publish() to the last byte received'''
+    sinkFactory = protocol.Factory.forProtocol(Sink)
+    sinkFactory.received = 0
+    sinkFactory.expected = 1
+    sinkFactory.done     = defer.Deferred()
+    port = reactor.listenTCP(0, sinkFactory, interface='127.0.0.1')
+    factory = MQTTFactory(MQTTFactory.PUBLISHER)
+    client  = yield protocol.ClientCreator(reactor, lambda: factory.buildProtocol(0)).connectTCP(
+        '127.0.0.1', port.getHost().port)
+    connected(client)
+    yield sinkFactory.done      # CONNECT received
+    if coalescing:
+        client.setCoalescing(0.001)
+    sinkFactory.received = 0
+    sinkFactory.expected = 33 * N   # 2 bytes header + 2 + 25 bytes topic + 4 bytes payload
+    sinkFactory.done     = defer.Deferred()
+    start = reactor.seconds()
+    for j in range(N):
+        client.publish("sensors/room1/temperature", b"21.5")
+    yield sinkFactory.done
+    elapsed = reactor.seconds() - start
+    client.transport.loseConnection()
+    yield port.stopListening()
+    return elapsed
+
+
+@defer.inlineCallbacks
+def main():
+    print("{0:>12} {1:>10} {2:>10} {3:>14}".format("", "ns/msg", "writes", "loopback (ms)"))
+    for coalescing in (False, True):
+        cost, writes = bench(coalescing)
+        elapsed = yield loopback(coalescing)
+        print("{0:>12} {1:>10.0f} {2:>10} {3:>14.1f}".format(
+            "coalesced" if coalescing else "plain", cost, writes, 1e3*elapsed))
+    reactor.stop()
+
+
+if __name__ == '__main__':
+    reactor.callWhenRunning(main)
+    reactor.run()
@@ -0,0 +1,143 @@
+# ----------------------------------------------------------------------
+# Copyright (C) 2015 by Rafael Gonzalez
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+'''
+Inbound packet dispatch benchmark.
+
+Floods a connected subscriber with QoS 0 PUBLISH packets and reports
+the cost per packet. The dispatch step alone is then compared with the
+former lookup, which formatted a handler name, called getattr() and
+bounced from the protocol to the state object and back.
+
+Usage: python bench/bench_dispatch.py
+'''
+
+import timeit
+
+from twisted.internet import task
+from twisted.internet.testing import StringTransport
+
+from mqtt                   import v311
+from mqtt.pdu               import CONNACK, PUBLISH
+from mqtt.client.base       import MQTTBaseProtocol
+from mqtt.client.factory    import MQTTFactory
+
+
+N = 20000
+
+
+def connectedSubscriber():
+    clock = task.Clock()
+    MQTTBaseProtocol.callLater = clock.callLater
+    MQTTBaseProtocol.clock     = clock
+    factory  = MQTTFactory(MQTTFactory.SUBSCRIBER)
+    protocol = factory.buildProtocol(0)
+    protocol.makeConnection(StringTransport())
+    protocol.connect("bench", keepalive=0, version=v311)
+    ack = CONNACK()
+    ack.session    = False
+    ack.resultCode = 0
+    protocol.dataReceived(ack.encode())
+    protocol.onPublish = lambda *args: None
+    return protocol
+
+
+def makeStream(n, size=32):
+    pdu = PUBLISH()
+    pdu.qos     = 0
+    pdu.dup     = False
+    pdu.retain  = False
+    pdu.topic   = "sensors/room1/temperature"
+    pdu.payload = bytearray(size)
+    return pdu.encode() * n, pdu.encode()
+
+
+class LegacyState(object):
+    '''The former state object forwarding to the protocol'''
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+
+    def handlePUBLISH(self, response):
+        self.protocol.handlePUBLISH(response)
+
+
+class LegacyDispatcher(object):
+    '''The former getattr() based dispatch, with a no-op decoder'''
+
+    packetTypes = MQTTBaseProtocol.packetTypes
+
+    def __init__(self):
+        self.state = LegacyState(self)
+
+    def processPacket(self, packet):
+        try:
+            packet_type      = (packet[0] & 0xF0) >> 4
+            packet_type_name = self.packetTypes[packet_type]
+        except KeyError:
+            return
+        packetDecoder = getattr(self, "_handle%s" % packet_type_name, None)
+        if packetDecoder:
+            packetDecoder(packet)
+
+    def _handlePUBLISH(self, packet):
+        self.state.handlePUBLISH(packet)
+
+    def handlePUBLISH(self, response):
+        pass
+
+
+class TableDispatcher(object):
+    '''The table driven dispatch, with a no-op decoder'''
+
+    def __init__(self):
+        self._dispatch = [self._handlePUBLISH] * 16
+
+    def processPacket(self, packet, offset=2):
+        self._dispatch[packet[0] >> 4](packet, offset)
+
+    def _handlePUBLISH(self, packet, offset):
+        pass
+
+
+def best(func, number, repeat=5):
+    return 1e9 * min(timeit.repeat(func, number=1, repeat=repeat)) / number
+
+
+if __name__ == '__main__':
+    stream, packet = makeStream(N)
+    protocol = connectedSubscriber()
+    flood = best(lambda: protocol.dataReceived(stream), N)
+    print("QoS 0 flood, full path : {0:6.0f} ns/packet".format(flood))
+
+    legacy = LegacyDispatcher()
+    table  = TableDispatcher()
+    view   = memoryview(packet)
+    def runLegacy():
+        for i in range(N):
+            legacy.processPacket(view)
+    def runTable():
+        for i in range(N):
+            table.processPacket(view)
+    print("dispatch only, getattr : {0:6.0f} ns/packet".format(best(runLegacy, N)))
+    print("dispatch only, table   : {0:6.0f} ns/packet".format(best(runTable, N)))
@@ -0,0 +1,84 @@
+# ----------------------------------------------------------------------
+# Copyright (C) 2015 by Rafael Gonzalez
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+'''
+Receive buffer framing benchmark.
+
+Feeds bursts of small PUBLISH packets, either in a single read or
+fragmented in small reads, and reports the framing cost per packet.
+Packet decoding is stubbed out so that only the framer is measured.
+
+Usage: python bench/bench_framing.py
+'''
+
+import timeit
+
+from mqtt.pdu         import PUBLISH
+from mqtt.client.base import MQTTBaseProtocol
+
+
+class FramingProtocol(MQTTBaseProtocol):
+    '''Counts packets instead of decoding them'''
+
+    def __init__(self):
+        MQTTBaseProtocol.__init__(self, None)
+        self.packets = 0
+
+    def _processPacket(self, packet, offset):
+        self.packets += 1
+
+
+def makeStream(n, size=16):
+    '''Returns n encoded QoS 0 PUBLISH packets back to back'''
+    pdu = PUBLISH()
+    pdu.qos     = 0
+    pdu.dup     = False
+    pdu.retain  = False
+    pdu.topic   = "foo/bar/baz"
+    pdu.payload = bytearray(size)
+    return pdu.encode() * n
+
+
+def chunks(data, size):
+    return [data[i:i+size] for i in range(0, len(data), size)]
+
+
+def bench(reads, n, repeat=5):
+    '''Best time per packet in nanoseconds'''
+    def run():
+        protocol = FramingProtocol()
+        for data in reads:
+            protocol.dataReceived(data)
+        assert protocol.packets == n
+    number = max(1, 20000 // n)
+    best = min(timeit.repeat(run, number=number, repeat=repeat))
+    return 1e9 * best / (number * n)
+
+
+if __name__ == '__main__':
+    print("{0:>8} {1:>16} {2:>16}".format("packets", "1 read (ns/pkt)", "7 B reads (ns/pkt)"))
+    for n in (10, 100, 1000, 10000, 50000):
+        stream = makeStream(n)
+        single = bench([stream], n)
+        fragmented = bench(chunks(stream, 7), n)
+        print("{0:>8} {1:>16.0f} {2:>16.0f}".format(n, single, fragmented))
@@ -0,0 +1,114 @@
+# ----------------------------------------------------------------------
+# Copyright (C) 2015 by Rafael Gonzalez
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+'''
+Publish window refill benchmark.
+
+Queues N QoS 1 messages behind a window of W messages and acknowledges
+them W at a time, one read holding W PUBACKs, as a loaded broker does.
+The batched refill, once per read with a single write, is compared with
+the former refill after every PUBACK, writing each message on its own.
+
+Usage: python bench/bench_refill.py
+'''
+
+import timeit
+
+from twisted.internet import reactor
+from twisted.internet.testing import StringTransport
+
+from mqtt                   import v311
+from mqtt.pdu               import CONNACK, encodeAck
+from mqtt.client.base       import MQTTBaseProtocol
+from mqtt.client.factory    import MQTTFactory
+from mqtt.client.publisher  import MQTTProtocol
+
+
+N = 20000
+
+
+class PerAckProtocol(MQTTProtocol):
+    '''Refills the window after every PUBACK'''
+
+    def handlePUBACK(self, response):
+        MQTTProtocol.handlePUBACK(self, response)
+        self.readComplete()
+
+
+class Transport(StringTransport):
+    '''Counts writes, throwing away the data'''
+
+    writes = 0
+
+    def write(self, data):
+        self.writes += 1
+
+    def writeSequence(self, seq):
+        self.writes += 1
+
+
+def connectedPublisher(protocolClass, window):
+    # The reactor keeps its timers in a heap. task.Clock sorts them
+    # on every callLater() and would dominate the measurement.
+    MQTTBaseProtocol.callLater = reactor.callLater
+    MQTTBaseProtocol.clock     = reactor
+    factory  = MQTTFactory(MQTTFactory.PUBLISHER)
+    factory.buildProtocol(0)
+    protocol = protocolClass(factory, 0)
+    protocol.makeConnection(Transport())
+    protocol.connect("bench", keepalive=0, version=v311)
+    ack = CONNACK()
+    ack.session    = False
+    ack.resultCode = 0
+    protocol.dataReceived(ack.encode())
+    protocol.setWindowSize(window)
+    return protocol
+
+
+def bench(protocolClass, window, repeat=5):
+    '''Best time per message in nanoseconds and writes per read'''
+    best = None
+    for i in range(repeat):
+        protocol = connectedPublisher(protocolClass, window)
+        for j in range(N):
+            protocol.publish("sensors/room1/temperature", b"21.5", qos=1)
+        # Queued messages get their ids in order as they enter the window
+        ids   = range(1, N + 1)
+        reads = [b''.join(encodeAck(0x40, msgId) for msgId in ids[j:j+window]) for j in range(0, N, window)]
+        protocol.transport.writes = 0
+        def run():
+            for data in reads:
+                protocol.dataReceived(data)
+        t = timeit.timeit(run, number=1)
+        assert len(protocol.session.windowPublish) == 0
+        best = t if best is None else min(best, t)
+    return 1e9 * best / N, protocol.transport.writes / len(reads)
+
+
+if __name__ == '__main__':
+    print("{0:>7} {1:>22} {2:>22}".format("window", "per ACK (ns/msg, wr)", "per read (ns/msg, wr)"))
+    for window in (10, 100, 1000):
+        legacy, legacyWrites = bench(PerAckProtocol, window)
+        batch,  batchWrites  = bench(MQTTProtocol, window)
+        print("{0:>7} {1:>14.0f} {2:>7.0f} {3:>14.0f} {4:>7.0f}".format(window,
+            legacy, legacyWrites, batch, batchWrites))
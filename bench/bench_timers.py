@@ -0,0 +1,85 @@
+# ----------------------------------------------------------------------
+# Copyright (C) 2015 by Rafael Gonzalez
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+'''
+Retransmission timer benchmark.
+
+Schedules N timers and cancels them all, as happens when N in-flight
+requests are acknowledged, using either one reactor DelayedCall per
+request or the per protocol timing wheel. Then times the wheel
+scheduling N timers and firing them all on a task.Clock.
+
+Usage: python bench/bench_timers.py
+'''
+
+import random
+import timeit
+
+from twisted.internet import reactor, task
+
+from mqtt.client.wheel import TimingWheel
+
+
+def noop():
+    pass
+
+
+def best(func, number, repeat=5):
+    return 1e9 * min(timeit.repeat(func, number=1, repeat=repeat)) / number
+
+
+def benchReactor(delays):
+    def run():
+        calls = [reactor.callLater(d, noop) for d in delays]
+        for call in calls:
+            call.cancel()
+    return best(run, len(delays))
+
+
+def benchWheel(delays):
+    wheel = TimingWheel(reactor)
+    def run():
+        calls = [wheel.callLater(d, noop) for d in delays]
+        for call in calls:
+            call.cancel()
+    return best(run, len(delays))
+
+
+def benchWheelExpire(delays):
+    def run():
+        clock = task.Clock()
+        wheel = TimingWheel(clock)
+        for d in delays:
+            wheel.callLater(d, noop)
+        clock.advance(max(delays) + 1)
+        assert len(wheel) == 0
+    return best(run, len(delays))
+
+
+if __name__ == '__main__':
+    print("{0:>8} {1:>18} {2:>18} {3:>18}".format("timers",
+        "reactor (ns/tmr)", "wheel (ns/tmr)", "wheel fire (ns/tmr)"))
+    for n in (10000, 100000):
+        delays = [random.uniform(4, 60) for i in range(n)]
+        print("{0:>8} {1:>18.0f} {2:>18.0f} {3:>18.0f}".format(n,
+            benchReactor(delays), benchWheel(delays), benchWheelExpire(delays)))
@@ -0,0 +1,157 @@
+# ----------------------------------------------------------------------
+# Copyright (C) 2015 by Rafael Gonzalez
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+
+'''
+Remaining length codec benchmark.
+
+Draws remaining lengths from a size mix typical of telemetry traffic
+(mostly acks and small messages, some kilobyte sized and a few large
+ones) and compares the former general loops with the one and two byte
+fast paths. Then measures framing plus PUBLISH decoding of such a
+stream, with decoders rescanning the length field as they used to do
+and with the header offset handed over by the framer.
+
+Usage: python bench/bench_varint.py
+'''
+
+import random
+import timeit
+
+from mqtt.pdu         import PUBLISH, encodeLength, decodeLength, _packHeader
+from mqtt.client.base import MQTTBaseProtocol
+
+
+N = 20000
+
+# (probability, smallest, largest) remaining length
+MIX = (
+    (0.70,      2,      127),
+    (0.25,    128,    16383),
+    (0.04,  16384,  2097151),
+    (0.01, 2097152, 268435455),
+)
+
+
+def sizes(n, mix=MIX, seed=1):
+    rnd    = random.Random(seed)
+    result = []
+    for i in range(n):
+        x = rnd.random()
+        for p, low, high in mix:
+            if x < p:
+                break
+            x -= p
+        result.append(rnd.randint(low, high))
+    return result
+
+
+def legacyEncodeLength(value):
+    '''The former general loop'''
+    encoded = bytearray()
+    while True:
+        digit = value % 128
+        value //= 128
+        if value > 0:
+            digit |= 128
+        encoded.append(digit)
+        if value <= 0:
+            break
+    return encoded
+
+
+def legacyDecodeLength(encoded):
+    '''The former general loop'''
+    value      = 0
+    multiplier = 1
+    for i in encoded:
+        value += (i & 0x7F) * multiplier
+        multiplier *= 0x80
+        if (i & 0x80) != 0x80:
+            break
+    return value
+
+
+class DecodingProtocol(MQTTBaseProtocol):
+    '''Frames and decodes PUBLISH packets, optionally rescanning the header'''
+
+    def __init__(self, rescan):
+        MQTTBaseProtocol.__init__(self, None)
+        self.rescan = rescan
+
+    def _processPacket(self, packet, offset):
+        PUBLISH().decode(packet, None if self.rescan else offset)
+
+
+def makeStream(n):
+    '''QoS 1 PUBLISH packets with sizes up to 64 KB'''
+    stream = bytearray()
+    for size in sizes(n, mix=MIX[:2] + ((0.05, 16384, 65535),)):
+        pdu = PUBLISH()
+        pdu.qos     = 1
+        pdu.dup     = False
+        pdu.retain  = False
+        pdu.msgId   = 1
+        pdu.topic   = "sensors/room1/temperature"
+        pdu.payload = bytes(max(0, size - 29))
+        stream.extend(pdu.encode())
+    return bytes(stream)
+
+
+def best(func, number, repeat=5):
+    return 1e9 * min(timeit.repeat(func, number=1, repeat=repeat)) / number
+
+
+if __name__ == '__main__':
+    values  = sizes(N)
+    encoded = [bytes(legacyEncodeLength(v)) for v in values]
+    buf     = bytearray(8)
+
+    def runLegacyEncode():
+        for v in values:
+            legacyEncodeLength(v)
+    def runEncode():
+        for v in values:
+            encodeLength(v)
+    def runPackHeader():
+        for v in values:
+            _packHeader(buf, 0x30, v)
+    def runLegacyDecode():
+        for e in encoded:
+            legacyDecodeLength(e)
+    def runDecode():
+        for e in encoded:
+            decodeLength(e)
+
+    print("encode, former loop    : {0:6.0f} ns/length".format(best(runLegacyEncode, N)))
+    print("encode, encodeLength   : {0:6.0f} ns/length".format(best(runEncode, N)))
+    print("encode, in place       : {0:6.0f} ns/length".format(best(runPackHeader, N)))
+    print("decode, former loop    : {0:6.0f} ns/length".format(best(runLegacyDecode, N)))
+    print("decode, decodeLength   : {0:6.0f} ns/length".format(best(runDecode, N)))
+
+    n      = 2000
+    stream = makeStream(n)
+    for rescan, label in ((True, "rescan"), (False, "offset")):
+        def run():
+            DecodingProtocol(rescan).dataReceived(stream)
+        print("frame + decode, {0}  : {1:6.0f} ns/packet".format(label, best(run, n)))
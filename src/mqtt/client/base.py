@@ -50,6 +50,7 @@
 # ----------------
 
 from random import randint
+from collections import deque
 
 # ----------------
 # Twisted  modules
@@ -57,6 +58,7 @@ from random import randint
 
 from zope.interface import implementer
 from twisted.internet.protocol import Protocol
+from twisted.internet.interfaces import IPushProducer
 from twisted.internet import reactor, defer, task
 from twisted.logger   import Logger
 from twisted.python   import failure
@@ -66,13 +68,14 @@ from twisted.python   import failure
 # -----------
 
 from ..          import v31, v311
-from ..pdu       import decodeLength, DISCONNECT, PINGREQ, CONNECT, CONNACK
+from ..pdu       import DISCONNECT, PINGREQ, CONNECT, CONNACK
 from ..pdu       import SUBACK, UNSUBACK, PUBLISH, PUBREL, PUBACK, PUBREC, PUBCOMP
 from ..error     import ( MQTTStateError, MQTTWindowError, MQTTTimeoutError, TimeoutValueError, 
         QoSValueError, KeepaliveValueError, ClientIdValueError, ProtocolValueError, MissingTopicError,
-        MissingPayloadError, MissingUserError, WindowValueError)
+        MissingPayloadError, MissingUserError, WindowValueError, FrameSizeValueError, CoalescingValueError)
 from .interfaces import IMQTTClientControl
-from .interval   import Interval
+from .interval   import Interval, RTTEstimator
+from .wheel      import TimingWheel
 
 
 MQTT_CONNECT_CODES = [
@@ -93,8 +96,13 @@ log = Logger(namespace='mqtt')
 
 class BaseState(object):
 
+    # Names of the packets handled by the protocol in this state.
+    # Any other packet received is logged and discarded.
+    accepts = ()
+
     def __init__(self, protocol):
         self.protocol = protocol
+        self.dispatch = self._buildDispatch()
 
 
     def connect(self, request):
@@ -132,77 +140,36 @@ class BaseState(object):
     # Handle traffic form the network
     # -------------------------------
 
-    # These default implementations should never be executed
-    # in a well-behaved server
-
-    def handleCONNACK(self, response):
-        '''
-        Handles CONNACK packet from the server
-        '''
-        state = self.__class__.__name__
-        log.error("Unexpected {packet:7} packet received in {log_source}", packet="CONNACK")
-        
-    
-    def handlePINGRESP(self):
-        '''
-        Handles PINGRESP packet from the server
-        '''
-        state = self.__class__.__name__
-        log.error("Unexpected {packet:7} packet received in {log_source}", packet="PINGRESP")
-
-
-    def handleSUBACK(self, response):
-        '''
-        Handles SUBACK packet from the server
-        '''
-        state = self.__class__.__name__
-        log.error("Unexpected {packet:7} packet received in {log_source}", packet="SUBACK")
-
-
-    def handleUNSUBACK(self, response):
-        '''
-        Decodes specific UNSUBACK data from Variable Header & Payload
-        '''
-        state = self.__class__.__name__
-        log.error("Unexpected {packet:7} packet received in {log_source}", packet="UNSUBACK")
-
-
-    def handlePUBLISH(self, response):
-        '''
-        Handles PUBLISH packet from the server
-        '''
-        state = self.__class__.__name__
-        log.error("Unexpected {packet:7} packet received in {log_source}", packet="PUBLISH")
-
-
-    def handlePUBACK(self, response):
-        '''
-        Handles PUBACK packet from the server
-        '''
-        state = self.__class__.__name__
-        log.error("Unexpected {packet:7} packet received in {log_source}", packet="PUBACK")
-
+    def _buildDispatch(self):
+        '''
+        Builds the inbound packet handlers table for this state, 
+        indexed by packet type. Accepted packets go straight to the 
+        protocol decoder, invalid packet types abort the connection.
+        '''
+        protocol = self.protocol
+        table    = []
+        for packetType in range(16):
+            name    = protocol.packetTypes.get(packetType)
+            decoder = getattr(protocol, "_handle%s" % name, None)
+            if decoder is None:
+                table.append(protocol._handleInvalid)
+            elif name in self.accepts:
+                table.append(decoder)
+            else:
+                table.append(self._handleUnexpected)
+        return table
 
-    def handlePUBREC(self, response):
-        '''
-        Handles PUBREC packet from the server
-        '''
-        state = self.__class__.__name__
-        log.error("Unexpected {packet:7} packet received in {log_source}", packet="PUBREC")
 
-    def handlePUBREL(self, response):
-        '''
-        Handles PUBREL packet from the server
-        '''
-        state = self.__class__.__name__
-        log.error("Unexpected {packet:7} packet received in {log_source}", packet="PUBREL")
+    # This default handler should never be executed
+    # in a well-behaved server
 
-    def handlePUBCOMP(self, response):
+    def _handleUnexpected(self, packet, offset):
         '''
-        Handles PUBCOMP packet from the server
+        Handles a valid packet not expected in this state
         '''
         state = self.__class__.__name__
-        log.error("Unexpected {packet:7} packet received in {log_source}", packet="PUBCOMP")
+        name  = self.protocol.packetTypes[packet[0] >> 4]
+        log.error("Unexpected {packet:7} packet received in {state}", packet=name, state=state)
 
 
 # ---------------------------------------
@@ -220,8 +187,7 @@ class IdleState(BaseState):
 
 class ConnectingState(BaseState):
 
-    def handleCONNACK(self, response):
-        self.protocol.handleCONNACK(response)
+    accepts = ("CONNACK",)
 
 # ---------------------------------------
 # Connected State Class
@@ -229,6 +195,7 @@ class ConnectingState(BaseState):
 
 class ConnectedState(BaseState):
 
+    accepts = ("PINGRESP",)
 
     def disconnect(self, request):
         '''
@@ -244,30 +211,53 @@ class ConnectedState(BaseState):
         self.protocol.doPingRequest()
 
 
-    def handlePINGRESP(self):
-        '''
-        Handles PINGRESP packet from the server
-        '''
-        self.protocol.handlePINGRESP()
 
 
+# ------------------------
+# In-flight Request Record
+# ------------------------
 
+class InFlight(object):
+    '''
+    Compact record of a request waiting for its acknowledgement.
+    It keeps only what retransmission needs, the encoded frames
+    (original and DUP), so that the request PDU, its topic and its
+    original payload object can be garbage-collected once encoded.
+    '''
 
+    __slots__ = ('msgId', 'qos', 'frames', 'size', 'dup',
+                 'alarm', 'deferred', 'interval', 'retries', 'sentAt',
+                 'delivered', 'deliveredAt')
+
+    def __init__(self, msgId, frames=None, deferred=None, interval=None, size=0, qos=0):
+        self.msgId    = msgId
+        self.qos      = qos
+        self.frames   = frames      # (original, DUP) wire frames
+        self.size     = size        # frame size in bytes, for timeout computation
+        self.dup      = False
+        self.alarm    = None        # retransmission timer handle
+        self.deferred = deferred    # completion
+        self.interval = interval
+        self.retries  = 0
+        self.sentAt   = None        # first transmission time, None once retransmitted
+        self.delivered   = 0        # bytes acknowledged when first sent
+        self.deliveredAt = None     # time of the last acknowledge when first sent
 
 
 # ------------------------
 # MQTT Base Protocol Class
 # ------------------------
 
-@implementer(IMQTTClientControl)
+@implementer(IMQTTClientControl, IPushProducer)
 class MQTTBaseProtocol(Protocol):
     '''
     Base Class, not meant to be directly instantiated.
     Handles all MQTT connection stuff
     '''
     
-    # So that we can patch it in tests with Clock.callLater ...
+    # So that we can patch them in tests with Clock.callLater and Clock ...
     callLater = reactor.callLater
+    clock     = reactor     # IReactorTime provider driving the retransmission timeouts
 
     packetTypes = {0x00: "null",    0x01: "CONNECT",     0x02: "CONNACK",
                    0x03: "PUBLISH", 0x04: "PUBACK",      0x05: "PUBREC",
@@ -276,9 +266,17 @@ class MQTTBaseProtocol(Protocol):
                    0x0C: "PINGREQ", 0x0D: "PINGRESP",    0x0E: "DISCONNECT"}
 
 
-    MAX_WINDOW          = 16   # Max value of in-flight PUBLISH/SUBSCRIBE/UNSUBSCRIBE
+    MAX_WINDOW          = 65535 # Max value of in-flight PUBLISH/SUBSCRIBE/UNSUBSCRIBE (all packet ids)
     TIMEOUT_INITIAL     = 4    # Initial tiemout for retransmissions
     TIMEOUT_MAX_INITIAL = 1024 # Maximun value for initial timeout
+    TIMEOUT_MIN         = 0.5  # Lower bound of the estimated timeout from RTT samples
+    TIMEOUT_MAX         = 60   # Upper bound of the estimated timeout from RTT samples
+    MAX_PACKET_SIZE     = 268435460 # Largest packet allowed by the standard
+    COMPACT_THRESHOLD   = 65536     # Consumed bytes kept before compacting the receive buffer
+    TIMER_RESOLUTION    = 0.25      # Retransmission timers granularity (seconds)
+    TIMER_SLOTS         = 512       # Retransmission timing wheel size (one revolution = 128 sec.)
+    COALESCE_BYTES      = 65536     # Default output buffer size flushed at once when coalescing
+    COALESCE_MAX_DELAY  = 1         # Maximun value for the output coalescing delay
 
     def __init__(self, factory):
         self.IDLE        = IdleState(self)
@@ -287,217 +285,280 @@ class MQTTBaseProtocol(Protocol):
         self.state       = self.IDLE
         self.factory     = factory
         self._initialT   = self.TIMEOUT_INITIAL # Initial timeout for retransmissions
+        self._rtt        = self._buildEstimator()  # Adaptive timeout for retransmissions
         self._version    = v311 # default protocol version
         self._buffer     = bytearray()
-        self._keepalive  = 0    # keepalive (in ms) disabled by default
+        self._offset     = 0    # start of the next packet to parse in _buffer
+        self._maxFrameSize = self.MAX_PACKET_SIZE
+        self._keepalive  = 0    # keepalive (in seconds) disabled by default
         self._window     = 1    # Guarantees in-order delivery by default
         self._cleanStart = True # No session by default
-        self._pingReq       = PINGREQ() 
-        self._pingReq.timer = None
-        self._pingReq.alarm = None
-        self._pingReq.pdu   = self._pingReq.encode()    # reuses the same PDU over and over again
+        self._pingPDU    = PINGREQ().encode()   # reuses the same PDU over and over again
+        self._pingTimer  = None
+        self._pingAlarm  = None
+        self._pingSent   = None
+        self.connReq     = None
+        self._timers     = self._buildTimers()  # retransmission timeouts
+        self._coalesce   = None # (maxDelay, maxBytes) when coalescing output frames
+        self._outFrames  = []   # output frames pending flush
+        self._outBytes   = 0
+        self._flushCall  = None
+        self._ackFrames  = []   # acknowledges produced by the current read
+        self._bulk       = deque()  # (frames, size) of PUBLISH packets held back
+        self._bulkBytes  = 0
+        self._paused     = False    # the transport buffer is full
+        self._writable   = []       # Deferreds fired when no longer paused
         self.onDisconnection = None # callback to be invoked
 
- # ------------------------------------------------------------------------
-
-    def _accumulatePacket(self, data):
-        self._buffer.extend(data)
-
-        length = None
+    @property
+    def state(self):
+        '''
+        Current state in the protocol state machine
+        '''
+        return self._state
 
-        while len(self._buffer):
-            if length is None:
-                # Start on a new packet
+    @state.setter
+    def state(self, state):
+        self._state    = state
+        self._dispatch = state.dispatch     # swaps the inbound handlers table
 
-                # Haven't got enough data to start a new packet,
-                # wait for some more
-                if len(self._buffer) < 2:
-                    break
+ # ------------------------------------------------------------------------
 
-                lenLen = 1
-                # Calculate the length of the length field
-                while lenLen < len(self._buffer):
-                    if not self._buffer[lenLen] & 0x80:
+    def _accumulatePacket(self, data):
+        '''
+        Splits the incoming byte stream into MQTT packets.
+        Complete packets are parsed in place from a read offset, so that
+        a read holding many packets is handled in linear time.
+        Each packet is handed to the decoders as a memoryview of the buffer,
+        which is released once the packet has been processed.
+        Consumed bytes are discarded once they dominate the buffer.
+        '''
+        buf = self._buffer
+        buf.extend(data)
+        end    = len(buf)
+        offset = self._offset
+        view   = memoryview(buf)
+
+        while end - offset >= 2:
+            # Decode the remaining length field in place, 
+            # single byte lengths being the most common case
+            length = buf[offset + 1]
+            pos    = offset + 2
+            if length & 0x80:
+                length     = 0
+                multiplier = 1
+                pos        = offset + 1
+                while True:
+                    byte    = buf[pos]
+                    length += (byte & 0x7F) * multiplier
+                    pos    += 1
+                    if not byte & 0x80:
                         break
-                    lenLen += 1
-
-                # We still haven't got all of the remaining length field
-                if lenLen < len(self._buffer) and self._buffer[lenLen] & 0x80:
-                    return
+                    if pos - offset > 4:
+                        log.error("Malformed remaining length field. Closing connection !")
+                        view.release()
+                        self._discardBuffer()
+                        self.transport.abortConnection()
+                        return
+                    if pos == end:
+                        break
+                    multiplier *= 0x80
+                if byte & 0x80:
+                    # We still haven't got all of the remaining length field
+                    break
+            frameEnd = pos + length
+            if frameEnd - offset > self._maxFrameSize:
+                log.error("Packet size {size} exceeds {max} bytes. Closing connection !",
+                    size=frameEnd - offset, max=self._maxFrameSize)
+                view.release()
+                self._discardBuffer()
+                self.transport.abortConnection()
+                return
+            if frameEnd > end:
+                # Wait for the rest of the packet
+                break
+            packet = view[offset:frameEnd]
+            try:
+                self._processPacket(packet, pos - offset)
+            finally:
+                packet.release()
+            offset = frameEnd
+        view.release()
 
-                length = decodeLength(self._buffer[1:])
+        # Amortized compaction of already consumed bytes
+        if offset == end or (offset > self.COMPACT_THRESHOLD and 2*offset > end):
+            try:
+                del buf[:offset]
+            except BufferError:
+                # A decoder kept a view of the buffer, leave it to its owner
+                self._buffer = buf[offset:]
+            offset = 0
+        self._offset = offset
 
-            if len(self._buffer) >= length + lenLen + 1:
-                chunk = self._buffer[:length + lenLen + 1]
-                self._processPacket(chunk)
-                self._buffer = self._buffer[length + lenLen + 1:]
-                length = None
 
-            else:
-                break
+    def _discardBuffer(self):
+        '''
+        Throws away any received but not yet processed data
+        '''
+        self._buffer = bytearray()
+        self._offset = 0
 
  # ------------------------------------------------------------------------
 
-    def _processPacket(self, packet):
-        '''Generic MQTT packet decoder'''
-        try:
-            packet_type      = (packet[0] & 0xF0) >> 4
-            packet_flags     = (packet[0] & 0x0F)
-            packet_type_name = self.packetTypes[packet_type]
-        except KeyError as e:
-            # Invalid packet type, throw away this packet
-            log.error("Invalid packet type %x" % packet_type)
-            self.transport.abortConnection()
-            return
-
+    def _processPacket(self, packet, offset):
+        '''
+        Generic MQTT packet decoder.
+        offset is the size of the fixed header, already parsed by the framer.
+        '''
+        # Dispatch table of the current state, indexed by packet type
+        self._dispatch[packet[0] >> 4](packet, offset)
 
-        # Get the appropriate decoder function
-        packetDecoder = getattr(self, "_handle%s" % packet_type_name, None)
+    # ------------------------------------------------------------------------
 
-        if packetDecoder:
-            packetDecoder(packet)
-        else:
-            # No decoder
-            log.error("Invalid packet decoder for %s" % packet_type_name)
-            self.transport.abortConnection()
-            return
+    def _handleInvalid(self, packet, offset):
+        '''
+        Handles packet types never sent by a server
+        '''
+        log.error("Invalid packet type %x" % (packet[0] >> 4))
+        self.transport.abortConnection()
 
     # -----------------------------
     # SPECIFIC MQTT PACKET DECODERS
     # -----------------------------
 
-    def _handleCONNACK(self, packet):
+    def _handleCONNACK(self, packet, offset):
         '''
         Decodes specific CONNACK data from Variable Header & Payload
         '''
         response = CONNACK()
         try:
-            response.decode(packet)
+            response.decode(packet, offset)
         except Exception as e:
             log.debug("Exception {excp!r}.", excp=e)
             log.error("MQTT CONNACK PDU corrupt. Closing connection !")
             self.transport.abortConnection()
         else:
-            self.state.handleCONNACK(response)
+            self.handleCONNACK(response)
 
     # ------------------------------------------------------------------------
 
-    def _handlePINGRESP(self, packet):
+    def _handlePINGRESP(self, packet, offset):
         '''
         Decodes specific PNGRESP data from Variable Header & Payload
         '''
-        self.state.handlePINGRESP()           
+        self.handlePINGRESP()
 
     # ------------------------------------------------------------------------
 
-    def _handleSUBACK(self, packet):
+    def _handleSUBACK(self, packet, offset):
         '''
         Decodes specific SUBACK data from Variable Header & Payload
         '''
         response = SUBACK()
         try:
-            response.decode(packet)
+            response.decode(packet, offset)
         except Exception as e:
             log.debug("Exception {excp!r}.", excp=e)
             log.error("MQTT SUBACK PDU corrupt. Closing connection !")
             self.transport.abortConnection()
         else:
-            self.state.handleSUBACK(response)
+            self.handleSUBACK(response)
 
     # ------------------------------------------------------------------------
 
-    def _handleUNSUBACK(self, packet):
+    def _handleUNSUBACK(self, packet, offset):
         '''
         Decodes specific UNSUBACK data from Variable Header & Payload
         '''
         response = UNSUBACK()
         try:
-            response.decode(packet)
+            response.decode(packet, offset)
         except Exception as e:
             log.debug("Exception {excp!r}.", excp=e)
             log.error("MQTT UNSUBACK PDU corrupt. Closing connection !")
             self.transport.abortConnection()
         else:
-            self.state.handleUNSUBACK(response)
+            self.handleUNSUBACK(response)
 
     # ------------------------------------------------------------------------
 
-    def _handlePUBLISH(self, packet):
+    def _handlePUBLISH(self, packet, offset):
         '''
         Decodes specific PUBLISH data from Flags, Variable Header & Payload
         '''
         response = PUBLISH()
         try:
-            response.decode(packet)
+            response.decode(packet, offset)
         except Exception as e:
             log.debug("Exception {excp!r}.", excp=e)
             log.error("MQTT PUBLISH PDU corrupt. Closing connection !")
             self.transport.abortConnection()
         else:
-            self.state.handlePUBLISH(response)
+            self.handlePUBLISH(response)
 
     # ------------------------------------------------------------------------
 
-    def _handlePUBACK(self, packet):
+    def _handlePUBACK(self, packet, offset):
         '''
         Decodes specific PUBACK data from Variable Header & Payload
         '''
         response = PUBACK()
         try:
-            response.decode(packet)
+            response.decode(packet, offset)
         except Exception as e:
             log.debug("Exception {excp!r}.", excp=e)
             log.error("MQTT PUBACK PDU corrupt. Closing connection !")
             self.transport.abortConnection()
         else:
-            self.state.handlePUBACK(response)
+            self.handlePUBACK(response)
 
     # ------------------------------------------------------------------------
 
-    def _handlePUBREL(self, packet):
+    def _handlePUBREL(self, packet, offset):
         '''
         Decodes specific PUBREL data from Variable Header & Payload
         '''
         response = PUBREL()
         try:
-            response.decode(packet)
+            response.decode(packet, offset)
         except Exception as e:
             log.debug("Exception {excp!r}.", excp=e)
             log.error("MQTT PUBREL PDU corrupt. Closing connection !")
             self.transport.abortConnection()
         else:
-            self.state.handlePUBREL(response)
+            self.handlePUBREL(response)
 
     # ------------------------------------------------------------------------
 
-    def _handlePUBREC(self, packet):
+    def _handlePUBREC(self, packet, offset):
         '''
         Decodes specific PUBREC data from Variable Header & Payload
         '''
         response = PUBREC()
         try:
-            response.decode(packet)
+            response.decode(packet, offset)
         except Exception as e:
             log.debug("Exception {excp!r}.", excp=e)
             log.error("MQTT PUBREL PDU corrupt. Closing connection !")
             self.transport.abortConnection()
         else:
-            self.state.handlePUBREC(response)
+            self.handlePUBREC(response)
 
     # ------------------------------------------------------------------------
 
-    def _handlePUBCOMP(self, packet):
+    def _handlePUBCOMP(self, packet, offset):
         '''
         Decodes specific PUBCOMP data from Variable Header & Payload
         '''
         response = PUBCOMP()
         try:
-            response.decode(packet)
+            response.decode(packet, offset)
         except Exception as e:
             log.debug("Exception {excp!r}.", excp=e)
             log.error("MQTT PUBCOMP PDU corrupt. Closing connection !")
             self.transport.abortConnection()
-        self.state.handlePUBCOMP(response)
+        else:
+            self.handlePUBCOMP(response)
 
     # ------------------------------------------------------------------------
 
@@ -505,18 +566,37 @@ class MQTTBaseProtocol(Protocol):
     # Twisted Protocol Interface
     # --------------------------
 
+    def connectionMade(self):
+        # callLater may have been patched (i.e. in tests) after __init__()
+        self._timers = self._buildTimers()
+        self._paused = False
+        # The transport pauses us when its buffer is full
+        if getattr(self.transport, 'producer', None) is None:
+            self.transport.registerProducer(self, True)
+
+
     def dataReceived(self, data):
-        self._accumulatePacket(data)
+        try:
+            self._accumulatePacket(data)
+        finally:
+            self._flushAcks()
+        self.readComplete()
     
 
     def connectionLost(self, reason):
         log.debug("--- Connection to MQTT Broker lost")
-        if self._pingReq.timer:
-            self._pingReq.timer.stop()
-            self._pingReq.timer = None
-        if self._pingReq.alarm:
-            self._pingReq.alarm.cancel()
-            self._pingReq.alarm = None
+        self._discardOutput()
+        if getattr(self.transport, 'producer', None) is self:
+            self.transport.unregisterProducer()
+        waiting, self._writable = self._writable, []
+        for deferred in waiting:
+            deferred.errback(reason)
+        if self._pingTimer:
+            self._pingTimer.stop()
+            self._pingTimer = None
+        if self._pingAlarm:
+            self._pingAlarm.cancel()
+            self._pingAlarm = None
         self.doConnectionLost(reason)
         self.state = self.IDLE
         # The disconnect callback is invoked in another reactor loop cycle
@@ -526,6 +606,39 @@ class MQTTBaseProtocol(Protocol):
             self.callLater(0.1, self.onDisconnection, reason)
         
 
+    # ----------------------------
+    # IPushProducer Implementation
+    # ----------------------------
+
+    def pauseProducing(self):
+        '''
+        The transport buffer is full: holds back PUBLISH packets
+        '''
+        self._paused = True
+
+
+    def resumeProducing(self):
+        '''
+        The transport buffer has been drained: sends held back PUBLISH packets,
+        then any queued ones and finally tells the application it may go on
+        '''
+        self._paused = False
+        self._flush()
+        if not self._paused:
+            self.writeResumed()
+        # Any of the above may have filled the transport buffer again
+        if not self._paused:
+            waiting, self._writable = self._writable, []
+            for deferred in waiting:
+                deferred.callback(None)
+
+
+    def stopProducing(self):
+        '''
+        The connection is being lost, cleaned up in connectionLost()
+        '''
+        pass
+
     # ---------------------------------
     # IMQTTClientControl Implementation
     # ---------------------------------
@@ -567,6 +680,7 @@ class MQTTBaseProtocol(Protocol):
         if not ( 1 <= timeout <= self.TIMEOUT_MAX_INITIAL ):
              raise TimeoutValueError(timeout)
         self._initialT = timeout
+        self._rtt      = self._buildEstimator()
 
     # --------------------------------------------------------------------------
 
@@ -576,7 +690,45 @@ class MQTTBaseProtocol(Protocol):
         '''
         if not (0 < n <= self.MAX_WINDOW):
             raise WindowValueError(n)
-        self._window = min(n, self.MAX_WINDOW)
+        self._window = n
+
+    # --------------------------------------------------------------------------
+
+    def setMaxFrameSize(self, size):
+        '''
+        API Entry Point
+        '''
+        if not (2 <= size <= self.MAX_PACKET_SIZE):
+            raise FrameSizeValueError(size)
+        self._maxFrameSize = size
+
+    # ------------------------------------------------------------------------
+
+    def setCoalescing(self, maxDelay, maxBytes=COALESCE_BYTES):
+        '''
+        API Entry Point
+        '''
+        if maxDelay is None:
+            self._coalesce = None
+            self._flush()
+            return
+        if not (0 <= maxDelay <= self.COALESCE_MAX_DELAY):
+            raise CoalescingValueError(maxDelay)
+        if not (0 < maxBytes):
+            raise CoalescingValueError(maxBytes)
+        self._coalesce = (maxDelay, maxBytes)
+
+    # ------------------------------------------------------------------------
+
+    def whenWritable(self):
+        '''
+        API Entry Point
+        '''
+        if not self._paused:
+            return defer.succeed(None)
+        deferred = defer.Deferred()
+        self._writable.append(deferred)
+        return deferred
 
     # ------------------------------------------------------------------------
 
@@ -626,10 +778,9 @@ class MQTTBaseProtocol(Protocol):
         if response.resultCode == 0:
             self.state = self.CONNECTED
             self.mqttConnectionMade()   # before the callbacks are executed ...
-            if request.keepalive != 0:
-                self._pingReq.keepalive = request.keepalive
-                self._pingReq.timer     = task.LoopingCall(self.ping)
-                self._pingReq.timer.start(request.keepalive)
+            if self._keepalive != 0:
+                self._pingTimer = task.LoopingCall(self.ping)
+                self._pingTimer.start(self._keepalive)
             request.deferred.callback(response.session)
         else:
             self.state = self.IDLE
@@ -644,8 +795,9 @@ class MQTTBaseProtocol(Protocol):
         Handles PINGRESP packet from the server
         '''
         log.debug("<== {packet:7}", packet="PINGRESP")
-        self._pingReq.alarm.cancel()
-        self._pingReq.alarm = None
+        self._pingAlarm.cancel()
+        self._pingAlarm = None
+        self._sampleRTT(self._pingSent)
 
 
     # ---------------------------
@@ -659,6 +811,20 @@ class MQTTBaseProtocol(Protocol):
         '''
         pass
 
+    def readComplete(self):
+        '''
+        Called once all the packets received in a read have been processed.
+        Overriden in subscriber/publisher to batch the work triggered by them
+        '''
+        pass
+
+    def writeResumed(self):
+        '''
+        Called when the transport resumes us and the held back packets are sent.
+        Overriden in publisher to go on draining the publish queue
+        '''
+        pass
+
     # ---------------------------
     # State Machine API callbacks
     # ---------------------------
@@ -668,7 +834,13 @@ class MQTTBaseProtocol(Protocol):
         Performs the actual work of disconnecting
         '''
         log.debug("==> {packet:7}",packet="DISCONNECT")
-        self.transport.write(request.encode())
+        pdu = request.encode()
+        # After any PUBLISH held back
+        self._writeBulk((pdu,), len(pdu))
+        self._flush(force=True)
+        # A paused producer would hold the connection open forever
+        if getattr(self.transport, 'producer', None) is self:
+            self.transport.unregisterProducer()
         self.transport.loseConnection()
 
     # ------------------------------------------------------------------------
@@ -678,8 +850,8 @@ class MQTTBaseProtocol(Protocol):
         Performs the actual work of connecting
         '''
         def connectError():
-            request.deferred.errback(MQTTTimeoutError("CONNACK"))
-            request.deferred = None
+            record.deferred.errback(MQTTTimeoutError("CONNACK"))
+            record.deferred = None
             self.transport.abortConnection()            
 
         try:
@@ -690,13 +862,14 @@ class MQTTBaseProtocol(Protocol):
         log.debug("==> {packet:7} (id={id} keepalive={keepalive} clean={clean})", packet="CONNECT", id=request.clientId, keepalive=request.keepalive, clean=request.cleanStart)
         self._cleanStart = request.cleanStart
         self._version    = request.version
-        self.transport.write(pdu)
+        self._keepalive  = request.keepalive
+        self._write(pdu)
         # Changes state and returns deferred
         self.state = self.CONNECTING
-        request.alarm = self.callLater(request.keepalive or 10, connectError)
-        request.deferred = defer.Deferred()
-        self.connReq = request  # keep track of this request until CONNACK or timeout
-        return request.deferred
+        record = InFlight(None, deferred=defer.Deferred())
+        record.alarm = self.callLater(request.keepalive or 10, connectError)
+        self.connReq = record  # keep track of this request until CONNACK or timeout
+        return record.deferred
 
     # ------------------------------------------------------------------------
 
@@ -708,8 +881,9 @@ class MQTTBaseProtocol(Protocol):
             log.warn("--- {packet:7} Timeout", packet="PINGREQ")
             self.transport.abortConnection()
         log.debug("==> {packet:7}", packet="PINGREQ")
-        self.transport.write(self._pingReq.pdu)
-        self._pingReq.alarm = self.callLater(self._pingReq.keepalive, doPingError)
+        self._write(self._pingPDU)
+        self._pingSent  = self._timers.clock.seconds()
+        self._pingAlarm = self.callLater(self._keepalive, doPingError)
 
     # ------------------------------------------------------------------------
 
@@ -745,5 +919,156 @@ class MQTTBaseProtocol(Protocol):
 
     # ------------------------------------------------------------------------
 
+    def _buildTimers(self):
+        '''
+        Builds the timing wheel holding all retransmission timeouts,
+        driven by the C{clock} IReactorTime provider
+        '''
+        return TimingWheel(self.clock, self.TIMER_RESOLUTION, self.TIMER_SLOTS)
+
+    # ------------------------------------------------------------------------
+
+    def _writeAck(self, data):
+        '''
+        Sends an acknowledge frame at the end of the current read, or 
+        before any other frame sent meanwhile, keeping the output order
+        '''
+        self._ackFrames.append(data)
+
+    # ------------------------------------------------------------------------
+
+    def _flushAcks(self):
+        '''
+        Sends all pending acknowledges in a single write
+        '''
+        if self._ackFrames:
+            self._writeSequence(())
+
+    # ------------------------------------------------------------------------
+
+    def _write(self, data):
+        '''
+        Sends one frame
+        '''
+        if self._coalesce is None and not self._ackFrames:
+            self.transport.write(data)
+        else:
+            self._writeSequence((data,))
+
+    # ------------------------------------------------------------------------
+
+    def _writeSequence(self, frames):
+        '''
+        Sends a sequence of frames, in a single write.
+        When coalescing, frames are buffered until the byte threshold is 
+        reached or the delay expires, whatever comes first.
+        '''
+        if self._ackFrames:
+            self._ackFrames.extend(frames)
+            frames = self._ackFrames
+            self._ackFrames = []
+        if self._coalesce is None:
+            self.transport.writeSequence(frames)
+            return
+        maxDelay, maxBytes = self._coalesce
+        self._outFrames.extend(frames)
+        for frame in frames:
+            self._outBytes += len(frame)
+        if self._outBytes >= maxBytes:
+            self._flush()
+        elif self._flushCall is None:
+            self._flushCall = self.callLater(maxDelay, self._flush)
+
+    # ------------------------------------------------------------------------
+
+    def _writeBulk(self, frames, size):
+        '''
+        Sends the frames of PUBLISH packets, C{size} bytes in total.
+        They are held back while the transport buffer is full or when
+        coalescing, and control frames sent meanwhile go ahead of them.
+        '''
+        if not self._paused and self._coalesce is None:
+            self._writeSequence(frames)
+            return
+        self._bulk.append((frames, size))
+        self._bulkBytes += size
+        if not self._paused:
+            maxDelay, maxBytes = self._coalesce
+            if self._outBytes + self._bulkBytes >= maxBytes:
+                self._flush()
+            elif self._flushCall is None:
+                self._flushCall = self.callLater(maxDelay, self._flush)
+
+    # ------------------------------------------------------------------------
+
+    def _flush(self, force=False):
+        '''
+        Writes the buffered control frames at once, followed by
+        the held back PUBLISH packets while the transport accepts them
+        (or all of them if C{force}d)
+        '''
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+        frames = self._ackFrames + self._outFrames
+        self._ackFrames = []
+        self._outFrames = []
+        self._outBytes  = 0
+        bulk     = self._bulk
+        maxBytes = self._coalesce[1] if self._coalesce else self.COALESCE_BYTES
+        # writes may pause us again
+        while bulk and (force or not self._paused):
+            size = 0
+            while bulk and size < maxBytes:
+                more, n = bulk.popleft()
+                frames.extend(more)
+                size += n
+            self._bulkBytes -= size
+            self.transport.writeSequence(frames)
+            frames = []
+        if frames:
+            self.transport.writeSequence(frames)
+
+    # ------------------------------------------------------------------------
+
+    def _discardOutput(self):
+        '''
+        Throws away buffered output frames
+        '''
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+        self._outFrames = []
+        self._outBytes  = 0
+        self._ackFrames = []
+        self._bulk.clear()
+        self._bulkBytes = 0
+
+    # ------------------------------------------------------------------------
+
+    def _buildEstimator(self):
+        '''
+        Builds the round trip time estimator, seeded with the initial timeout
+        '''
+        return RTTEstimator(self._initialT, self.TIMEOUT_MIN, self.TIMEOUT_MAX, self.TIMER_RESOLUTION)
+
+    # ------------------------------------------------------------------------
+
+    def _sampleRTT(self, sent, transfer=0):
+        '''
+        Feeds the estimator with the round trip time of a request first sent 
+        at C{sent} and never retransmitted (Karn's rule, C{sent} is None otherwise).
+        C{transfer} is the estimated time to send a large payload, not counted.
+        Returns the sample, if any.
+        '''
+        if sent is not None:
+            rtt = max(0, self._timers.clock.seconds() - sent - transfer)
+            self._rtt.sample(rtt)
+            return rtt
+
+    # ------------------------------------------------------------------------
+
 
-__all__ = ["MQTTBaseProtocol"]
+__all__ = ["MQTTBaseProtocol", "InFlight"]
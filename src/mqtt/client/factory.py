@@ -22,12 +22,6 @@
 # WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 # ----------------------------------------------------------------------
 
-# ----------------
-# Standard modules
-# ----------------
-
-from collections import deque
-
 # ----------------
 # Twisted  modules
 # ----------------
@@ -42,11 +36,13 @@ from twisted.logger import Logger
 # Own modules
 # -----------
 
-from ..      import __version__
-from ..error import ProfileValueError
+from ..        import __version__
+from ..error   import ProfileValueError
+from .session  import Session, PacketIdAllocator
 
 log = Logger(namespace='mqtt')
 
+
 class MQTTFactory(ReconnectingClientFactory):
 
 
@@ -58,8 +54,10 @@ class MQTTFactory(ReconnectingClientFactory):
         self.profile  = profile
         self.factor   = 2
         self.maxDelay = 2*3600
-        # Packet Id generator
         self.id       = 0
+        self.sessions          = {} # Session state, one per broker address
+        # Per address views of the session state
+        self.packetIds         = {} # Packet Id allocators
         self.queuePublishTx    = {} # PUBLISH messages waiting before being transmitted
         self.windowPublish     = {} # PUBLISH messages window waiting for PUBREC/PUBACK
         self.windowPubRelease  = {} # PUBREL  messages (qos=2) window waiting for PUBCOMP (publisher)
@@ -80,18 +78,17 @@ class MQTTFactory(ReconnectingClientFactory):
         else:
             raise ProfileValueError("profile value not supported" , self.profile)
         
-        v = self.queuePublishTx.get(addr, deque())
-        self.queuePublishTx[addr] = v
-        v = self.windowPublish.get(addr, dict() )
-        self.windowPublish[addr] = v
-        v = self.windowPubRelease.get(addr, dict() )
-        self.windowPubRelease[addr] = v
-        v = self.windowPubRx.get(addr, dict())
-        self.windowPubRx[addr] = v
-        v = self.windowSubscribe.get(addr, dict() )
-        self.windowSubscribe[addr] = v
-        v = self.windowUnsubscribe.get(addr, dict())
-        self.windowUnsubscribe[addr] = v
+        session = self.sessions.get(addr)
+        if session is None:
+            session = Session()
+            self.sessions[addr]          = session
+            self.queuePublishTx[addr]    = session.queuePublishTx
+            self.windowPublish[addr]     = session.windowPublish
+            self.windowPubRelease[addr]  = session.windowPubRelease
+            self.windowPubRx[addr]       = session.windowPubRx
+            self.windowSubscribe[addr]   = session.windowSubscribe
+            self.windowUnsubscribe[addr] = session.windowUnsubscribe
+            self.packetIds[addr]         = session.packetIds
 
         # Keeps a persistent reference to the last protocol built
         # This is ok *only* when connecting to a single broker. 
@@ -113,11 +110,22 @@ class MQTTFactory(ReconnectingClientFactory):
     # Helper methods
     # --------------
 
-    def makeId(self):
-        '''Produce ids for Protocol packets, outliving their sessions'''
+    def makeId(self, addr=None):
+        '''
+        Produce ids for Protocol packets, not in use within the session 
+        with the broker at addr. Without addr, ids simply roll over 
+        [1..65535], outliving their sessions.
+        '''
+        if addr is not None:
+            return self.sessions[addr].packetIds.allocate()
         self.id = (self.id + 1) % 65536
         self.id = self.id or 1   # avoid id 0
         return self.id
 
 
-__all__ = ['MQTTFactory']
+    def releaseId(self, addr, msgId):
+        '''Frees a packet id once its exchange has completed'''
+        self.sessions[addr].packetIds.release(msgId)
+
+
+__all__ = ['MQTTFactory', 'PacketIdAllocator']
@@ -134,6 +134,12 @@ class IMQTTClientControl(Interface):
         & PUBREL will be done with exponentially backoff timeout value up to a limit. 
         Retries for PUBLISH will take into account estimated banwidth (see IPublisher)
 
+        The timeout adapts to the server latency: round trip times of
+        PUBLISH/PUBACK (PUBREC, PUBCOMP), SUBSCRIBE/SUBACK, UNSUBSCRIBE/UNSUBACK
+        and PINGREQ/PINGRESP exchanges are smoothed as TCP does (RFC 6298)
+        and replace this value once measured. Retransmitted requests are not
+        measured. Calling this function discards previous measurements.
+
         Signature
         =========
 
@@ -156,10 +162,32 @@ class IMQTTClientControl(Interface):
         acknowledge packets. 'n' can be limited to an internal maximun size
         (implementation defined).
 
-        To guarantee an in-order delivery of messages for messages with QoS > 0, 
-        only one ACK should be pending (n=1). 
+        To guarantee an in-order delivery of messages for messages with QoS > 0,
+        only one ACK should be pending (n=1).
         By default, the ack window size is n=1 unless changed by this function.
 
+        With n > 1, the ordering guarantees are:
+         1) First transmissions always follow the order of the C{publish()}
+            (or C{subscribe()}, C{unsubscribe()}) calls. Messages exceeding
+            the window wait in a FIFO queue, while subscribe and unsubscribe
+            requests exceeding it fail with C{MQTTWindowError}. QoS 0 
+            messages take no room in the window, but still wait in the
+            queue behind the messages queued before them.
+         2) A message retransmitted after a timeout (DUP flag set) is sent
+            after messages published later, so the server may receive
+            them out of order. Timeouts include a random jitter, thus
+            retransmissions are not ordered among themselves either.
+         3) When a persistent session is resumed (C{cleanStart=False}),
+            unacknowledged messages are retransmitted in their original
+            publish order, PUBREL packets first.
+        QoS 0 messages are never retransmitted and keep the publish order.
+
+        Large windows, up to the whole packet identifier space, are handled
+        efficiently: acknowledges and packet identifier allocation are O(1).
+
+        Publishers: this also disables the adaptive window set by 
+        C{setAdaptiveWindow()}.
+
         Signature
         =========
 
@@ -168,6 +196,93 @@ class IMQTTClientControl(Interface):
 
         '''
 
+    def setMaxFrameSize(size):
+        '''
+        Abstract
+        ========
+
+        Set the maximum size of received packets.
+
+        Description
+        ===========
+
+        Sets the maximum size in bytes (fixed header included) of any
+        control packet received from the server. A packet announcing a larger
+        size in its remaining length field is treated as a protocol violation
+        and the connection is aborted without buffering its contents.
+        By default, the limit is the maximum packet size allowed by the standard.
+
+        Signature
+        =========
+
+        @param size: maximum packet size in bytes.
+        @raise ValueError: if not within [2..MQTTBaseProtocol.MAX_PACKET_SIZE]
+        '''
+
+    def setCoalescing(maxDelay, maxBytes=65536):
+        '''
+        Abstract
+        ========
+
+        Coalesce outbound packets into fewer writes.
+
+        Description
+        ===========
+
+        By default, every control packet is written to the transport
+        as soon as it is produced. With output coalescing, packets are
+        buffered and written at once, in the order they were produced, 
+        when C{maxBytes} are buffered or C{maxDelay} seconds after the 
+        first buffered packet, whatever comes first. A zero delay flushes 
+        the buffer in the next reactor iteration. This turns bursts of 
+        small messages (i.e. C{publish()} called in a loop) into a few 
+        large writes and TCP segments, at the expense of latency.
+        A DISCONNECT flushes the buffer.
+
+        Control packets (PUBACK, PUBREC, PUBREL, PUBCOMP, PINGREQ, 
+        SUBSCRIBE, UNSUBSCRIBE) always go ahead of buffered PUBLISH
+        data. The same holds while the transport buffer is full and 
+        the protocol, registered as the transport producer, is paused: 
+        PUBLISH data is held back until the transport resumes it but
+        acknowledges and keepalives are still written at once.
+
+        Signature
+        =========
+
+        @param maxDelay: maximum delay in seconds or None to disable coalescing.
+        @param maxBytes: buffer size in bytes.
+        @raise ValueError: if maxDelay is not within 
+            [0..MQTTBaseProtocol.COALESCE_MAX_DELAY] or maxBytes is not positive.
+        '''
+
+
+    def whenWritable():
+        '''
+        Abstract
+        ========
+
+        Wait until the transport accepts more data.
+
+        Description
+        ===========
+
+        The protocol is registered as a producer of its transport and
+        is paused while the transport buffer is full. Meanwhile, 
+        C{publish()} requests of any QoS are queued but not written, so
+        a fast application only grows the publish queue. The queue is
+        drained again when the transport resumes the protocol.
+
+        Applications producing messages in a loop should wait on the 
+        returned Deferred before publishing more.
+
+        Signature
+        =========
+
+        @return: a Deferred that fires with None at once if the transport
+            is writable, or when it is resumed otherwise. It errbacks
+            with the disconnection reason if the connection is lost first.
+        '''
+
 # ============================================================================ #
 #                      MQTT Client Subscriber Interface                        #
 # ============================================================================ #
@@ -230,6 +345,12 @@ class IMQTTSubscriber(Interface):
         @type onPublish: C{function or bounded method}
         @ivar onPublish: handler that will be invoked whenever a PUBLISH message arrive.
         with parameters (topic, payload, qos, dup, retain, msgId).
+        The payload is an immutable C{bytes} object copied once from the 
+        receive buffer, which the handler may keep as long as needed.
+        The acknowledges (PUBACK, PUBREC, PUBCOMP) of the messages received 
+        in a single read are sent together once the read is processed, 
+        thus after delivery. Packets sent by the handler go out after the 
+        acknowledges of the messages delivered so far.
     """)
 
     
@@ -261,8 +382,116 @@ class IMQTTPublisher(Interface):
              where K = K*factor in each iteration
         This is useful to avoid timeouts and retransmissions in very 
         large payloads using QoS=1 and 2. 
+
+        The bandwith is estimated automatically from the rate at which
+        PUBLISH bytes are acknowledged (the highest rate measured over the 
+        last C{BANDWITH_WINDOW} seconds), and this value is only used 
+        until the first measurement. Calling this function discards 
+        previous measurements.
+        '''
+
+    def getBandwith():
+        '''
+        Abstract
+        ========
+
+        Get the estimated available bandwith.
+
+        Description
+        ===========
+
+        Returns the bandwith used to compute PUBLISH timeouts, 
+        either measured from acknowledged PUBLISH packets or, 
+        if none yet, the value given to C{setBandwith()}.
+        A sustained drop may be used to detect link degradation.
+
+        Signature
+        =========
+
+        @return: estimated bandwith in bytes/sec.
         '''
         
+    def setReleaseWindowSize(n):
+        '''
+        Abstract
+        ========
+
+        Set the PUBREL window size.
+
+        Description
+        ===========
+
+        QoS 2 messages leave the PUBLISH window as soon as their PUBREC
+        arrives, making room for new messages, and go on with the 
+        PUBREL/PUBCOMP exchange. New QoS 2 messages are not sent while 
+        'n' exchanges await their PUBCOMP (messages with a lower QoS 
+        queued after them wait as well, to keep the publish order).
+        By default, 'n' is twice the PUBLISH window size, so that a full
+        window of PUBRECs is refilled at once.
+
+        Signature
+        =========
+
+        @param n: window size
+        @raise ValueError: if not within [1..MQTTBaseProtocol.MAX_WINDOW]
+        '''
+
+    def setAdaptiveWindow(minimum=1, maximum=None):
+        '''
+        Abstract
+        ========
+
+        Adapt the PUBLISH window size to the network conditions.
+
+        Description
+        ===========
+
+        Replaces the fixed window size given by C{setWindowSize()} 
+        for PUBLISH packets (subscribe and unsubscribe requests still use
+        it) by a window adjusted as TCP does (AIMD), starting at C{minimum}:
+         1) Every PUBACK/PUBREC received on time grows the window by 
+            1/window, thus by one message per acknowledged window.
+         2) A timeout, or a round trip time above C{RTT_INFLATION} 
+            times the smoothed round trip time, shrinks the window 
+            by C{WINDOW_DECREASE}, once for all the messages in flight.
+        The window stays within C{[minimum..maximum]}.
+        Call C{setWindowSize()} to return to a fixed window.
+
+        Signature
+        =========
+
+        @param minimum: minimum window size
+        @param maximum: maximum window size, MQTTBaseProtocol.MAX_WINDOW by default
+        @raise ValueError: if not 1 <= minimum <= maximum <= MQTTBaseProtocol.MAX_WINDOW
+        '''
+
+    def getWindowStats():
+        '''
+        Abstract
+        ========
+
+        Get the PUBLISH window metrics.
+
+        Description
+        ===========
+
+        Returns a dictionary with the current PUBLISH window state and 
+        congestion event counters since the protocol was built:
+          - C{window}: current window size.
+          - C{adaptive}: whether the window is adaptive.
+          - C{inflight}: messages waiting for PUBACK/PUBREC.
+          - C{queued}: messages waiting for room in the window.
+          - C{releasing}: QoS 2 messages waiting for PUBCOMP.
+          - C{timeouts}: PUBLISH retransmissions due to timeouts.
+          - C{rttInflations}: acknowledges received too late (adaptive window).
+          - C{decreases}: adaptive window decreases.
+
+        Signature
+        =========
+
+        @return: a dictionary.
+        '''
+
     def publish(topic, message, qos=0, retain=False):
         '''
 
@@ -284,11 +513,44 @@ class IMQTTPublisher(Interface):
         =========
 
         @param topic: an UTF-8 string describing the topic on which to publish.
-        @param message: a bytearray() with the application message
+        @param message: the application message, either a string (sent UTF-8 
+            encoded) or any bytes-like object (bytes, bytearray, memoryview, 
+            mmap, array ...). Bytes are sent without copying them.
         @param qos: Desired Qos to publish the message to the server [0..3].
         @param retain: Retain Flag.
         @return: a Deferred, with an extra C{msgId} attribute which you can 
             use to keep track of requests. 
+            The msgId is allocated when the message leaves the publish queue
+            and enters the publish window, it is None until then.
             The callback is called upon successful confirm and will include
             the msgId as parameter.
         '''
+
+    def prepare(topic, qos=0, retain=False):
+        '''
+
+        Abstract
+        ========
+
+        Prepare a template to publish messages on a fixed topic.
+
+        Description
+        ===========
+        
+        Returns a template object whose C{publish(message)} method behaves
+        as C{publish(topic, message, qos, retain)} with the given arguments.
+        The topic name is validated and encoded only once, which pays off
+        when publishing many messages to a small set of fixed topics.
+        Templates are tied to this protocol instance.
+
+        Signature
+        =========
+
+        @param topic: an UTF-8 string describing the topic on which to publish.
+        @param qos: Desired Qos to publish messages to the server [0..2].
+        @param retain: Retain Flag.
+        @return: a template object with a C{publish(message)} method, 
+            returning a Deferred as C{publish()} does.
+        @raise ValueError: if the QoS is not within [0..2] or the encoded 
+            topic exceeds 65535 bytes.
+        '''
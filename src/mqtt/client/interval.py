@@ -1,3 +1,4 @@
+import collections
 import random
 
 class Interval(object):
@@ -28,7 +29,7 @@ class Interval(object):
         '''Call the interval to produce a new delay time'''
         self._value *= self.factor
         self._value = min(self._value, self.maxDelay)
-        return self._value + random.random()
+        return self._value + random.random()*min(1, self.initial)
 
 class IntervalLinear(object):
     '''
@@ -60,4 +61,110 @@ class IntervalLinear(object):
         '''Call the interval to produce a new delay time taking into account the bandwith'''
         self._value = self.initial + (self._k*size)/self.bandwith
         self._k    *= self.factor
-        return self._value + random.random()
\ No newline at end of file
+        return self._value + random.random()*min(1, self.initial)
+
+
+class RTTEstimator(object):
+    '''
+    This class estimates the retransmission timeout from round trip 
+    time samples, as TCP does (RFC 6298). Only requests acknowledged 
+    without being retransmitted should be sampled (Karn's rule).
+    Until the first sample arrives, the initial timeout is returned.
+    A timeout expiry doubles the timeout until the next sample.
+
+    Use like:
+    C{rtt = RTTEstimator(initial=4)}
+    C{rtt.sample(0.030)}
+    C{t = rtt.timeout()}
+    C{rtt.backoff()}
+
+    @ivar initial:     timeout returned before any sample, in seconds.
+    @ivar minTimeout:  lower bound of the timeout, in seconds.
+    @ivar maxTimeout:  upper bound of the timeout, in seconds.
+    @ivar granularity: timer granularity, in seconds.
+    @ivar srtt:        smoothed round trip time (None before any sample).
+    @ivar rttvar:      round trip time variation (None before any sample).
+    '''
+
+    ALPHA = 0.125
+    BETA  = 0.25
+    K     = 4
+
+    def __init__(self, initial=4, minTimeout=0.5, maxTimeout=60, granularity=0.25):
+        '''Initialize estimator object'''
+        self.initial     = initial
+        self.minTimeout  = minTimeout
+        self.maxTimeout  = max(initial, maxTimeout)
+        self.granularity = granularity
+        self.srtt        = None
+        self.rttvar      = None
+        self._rto        = initial
+
+
+    def sample(self, rtt):
+        '''Feed a new round trip time measurement, in seconds'''
+        if self.srtt is None:
+            self.srtt   = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA)*self.rttvar + self.BETA*abs(self.srtt - rtt)
+            self.srtt   = (1 - self.ALPHA)*self.srtt + self.ALPHA*rtt
+        rto = self.srtt + max(self.granularity, self.K*self.rttvar)
+        self._rto = min(max(rto, self.minTimeout), self.maxTimeout)
+
+
+    def backoff(self):
+        '''Double the timeout after an expiry, kept until the next sample'''
+        self._rto = min(2*self._rto, self.maxTimeout)
+
+
+    def timeout(self):
+        '''Current retransmission timeout, in seconds'''
+        return self._rto
+
+
+class BandwithEstimator(object):
+    '''
+    This class estimates the delivery rate from rate samples, keeping 
+    the maximum sample seen within a sliding time window, so that 
+    periods where the application sends little do not lower it.
+    Until the first sample arrives, the initial value is returned.
+    When all samples expire, the most recent one is kept.
+
+    Use like:
+    C{bw = BandwithEstimator(initial=10000, window=10)}
+    C{bw.sample(25000, now)}
+    C{rate = bw.estimate(now)}
+
+    @ivar initial: estimate returned before any sample, in bytes/sec.
+    @ivar window:  sample lifetime, in seconds.
+    '''
+
+    def __init__(self, initial=10000, window=10):
+        '''Initialize estimator object'''
+        self.initial  = initial
+        self.window   = window
+        self._samples = collections.deque()    # (time, rate), rates decreasing
+
+
+    def sample(self, rate, now):
+        '''Feed a new delivery rate measurement, in bytes/sec'''
+        samples = self._samples
+        while samples and samples[-1][1] <= rate:
+            samples.pop()
+        samples.append((now, rate))
+        self._expire(now)
+
+
+    def estimate(self, now):
+        '''Current delivery rate estimate, in bytes/sec'''
+        if not self._samples:
+            return self.initial
+        self._expire(now)
+        return self._samples[0][1]
+
+
+    def _expire(self, now):
+        samples = self._samples
+        while len(samples) > 1 and samples[0][0] < now - self.window:
+            samples.popleft()
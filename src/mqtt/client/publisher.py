@@ -48,9 +48,6 @@ log = Logger(namespace='mqtt')
 
 class ConnectingState(BaseConnectingState):
 
-    def handleCONNACK(self, response):
-        self.protocol.handleCONNACK(response)
-
     # The standard allows publishing data without waiting for CONNACK
     def publish(self, request):
         return self.protocol.doPublish(request)
@@ -61,18 +58,11 @@ class ConnectingState(BaseConnectingState):
 
 class ConnectedState(BaseConnectedState):
 
+    accepts = BaseConnectedState.accepts + ("PUBACK", "PUBREC", "PUBCOMP")
+
     def publish(self, request):
         return self.protocol.doPublish(request)
 
-    def handlePUBACK(self, response):
-        self.protocol.handlePUBACK(response)
-
-    def handlePUBREC(self, response):
-        self.protocol.handlePUBREC(response)
-
-    def handlePUBCOMP(self, response):
-        self.protocol.handlePUBCOMP(response)
-
 
 # ------------------------
 # MQTT Client Protocol Class
@@ -39,12 +39,12 @@ from twisted.logger   import Logger
 # Own modules
 # -----------
 
-from ..          import v31, PY2
-from ..error     import MQTTWindowError, QoSValueError, TopicTypeError
-from ..pdu       import SUBSCRIBE, UNSUBSCRIBE, PUBACK, PUBREC, PUBCOMP, PUBLISH, PUBREL
+from ..          import v31
+from ..error     import MQTTWindowError, QoSValueError, TopicTypeError, WindowValueError
+from ..pdu       import SUBSCRIBE, UNSUBSCRIBE, PUBLISH, PUBREL, encodeAck, encodeTopic, stampMsgId
 from .interfaces import IMQTTSubscriber, IMQTTPublisher
-from .interval   import Interval, IntervalLinear
-from .base       import MQTTBaseProtocol, IdleState as BaseIdleState, ConnectingState as BaseConnectingState, ConnectedState as BaseConnectedState
+from .interval   import Interval, IntervalLinear, BandwithEstimator
+from .base       import MQTTBaseProtocol, InFlight, IdleState as BaseIdleState, ConnectingState as BaseConnectingState, ConnectedState as BaseConnectedState
 
 
 log = Logger(namespace='mqtt')
@@ -69,9 +69,6 @@ class IdleState(BaseIdleState):
 
 class ConnectingState(BaseConnectingState):
 
-    def handleCONNACK(self, response):
-        self.protocol.handleCONNACK(response)
-
     # The standard allows publishing data without waiting for CONNACK
     def publish(self, request):
         return self.protocol.doPublish(request)
@@ -82,6 +79,11 @@ class ConnectingState(BaseConnectingState):
 
 class ConnectedState(BaseConnectedState):
 
+    # PUBLISH, PUBREL         for subscriber
+    # PUBACK, PUBREC, PUBCOMP for publisher
+    accepts = BaseConnectedState.accepts + ("SUBACK", "UNSUBACK", "PUBLISH", 
+        "PUBACK", "PUBREC", "PUBREL", "PUBCOMP")
+
     def publish(self, request):
         return self.protocol.doPublish(request)
 
@@ -90,31 +92,37 @@ class ConnectedState(BaseConnectedState):
 
     def unsubscribe(self, request):
         return self.protocol.doUnsubscribe(request)
-    
-    def handleSUBACK(self, response):
-        self.protocol.handleSUBACK(response)
 
-    def handleUNSUBACK(self, response):
-        self.protocol.handleUNSUBACK(response)
+# ---------------------------
+# MQTT Publish Template Class
+# ---------------------------
 
-    def handlePUBLISH(self, response):
-        self.protocol.handlePUBLISH(response)
-
-    # QoS=1 packets forwarded to subscriber
-    def handlePUBACK(self, response):
-        self.protocol.handlePUBACK(response)
-
-    # QoS=2 packets forwarded to publisher
-    def handlePUBREC(self, response):
-        self.protocol.handlePUBREC(response)
+class PublishTemplate(object):
+    '''
+    Publishes messages on a fixed topic with a fixed QoS and retain flag.
+    The topic name is validated and encoded once, when the template is
+    prepared by C{MQTTProtocol.prepare()}.
+    '''
 
-    # QoS=2 packets forwarded to subscriber
-    def handlePUBREL(self, response):
-        self.protocol.handlePUBREL(response)
+    def __init__(self, protocol, topic, qos, retain):
+        self.protocol     = protocol
+        self.topic        = topic
+        self.qos          = qos
+        self.retain       = retain
+        self.encodedTopic = encodeTopic(topic)
 
-    # QoS=2 packets forwarded to publisher
-    def handlePUBCOMP(self, response):
-        self.protocol.handlePUBCOMP(response)
+    def publish(self, message):
+        '''
+        API entry point.
+        '''
+        request = PUBLISH()
+        request.qos     = self.qos
+        request.topic   = self.topic
+        request.encodedTopic = self.encodedTopic
+        request.payload = message
+        request.retain  = self.retain
+        request.dup     = False
+        return self.protocol.state.publish(request)
 
 # --------------------------
 # MQTT Client Protocol Class
@@ -128,6 +136,10 @@ class MQTTProtocol(MQTTBaseProtocol):
 
     DEFAULT_BANDWITH = 10000
     DEFAULT_FACTOR   = 2
+    BANDWITH_WINDOW  = 10   # Lifetime (seconds) of delivery rate samples
+    WINDOW_DECREASE  = 0.5  # Adaptive publish window multiplier on congestion
+    RTT_INFLATION    = 2    # RTT samples above this times the smoothed RTT signal congestion
+    RETRY_SPREAD_MAX = 4    # Max extra delay (seconds) spreading out the retries of a full window
 
     def __init__(self, factory, addr):
         MQTTBaseProtocol.__init__(self, factory) 
@@ -136,17 +148,40 @@ class MQTTProtocol(MQTTBaseProtocol):
         self.CONNECTING    = ConnectingState(self)
         self.CONNECTED     = ConnectedState(self)
         self.state         = self.IDLE
-        # Copies addr
+        # Copies addr and the session state kept by the factory for it
         self.addr          = addr
+        self.session       = factory.sessions[addr]
         # Estimated bandwith in bytes/sec for PUBLISH PDUs
-        self._bandwith     =  self.DEFAULT_BANDWITH
+        self._bandwith     =  BandwithEstimator(self.DEFAULT_BANDWITH, self.BANDWITH_WINDOW)
         self._factor       =  self.DEFAULT_FACTOR
+        self._delivered    =  0     # PUBLISH bytes acknowledged so far
+        self._deliveredAt  =  None  # time of the last PUBLISH acknowledge
+        # Adaptive publish window (AIMD), None while a fixed window is used
+        self._cwnd         =  None
+        self._cwndMin      =  1
+        self._cwndMax      =  self.MAX_WINDOW
+        self._congestedAt  =  None  # time of the last window decrease
+        self._releaseWindow = None  # PUBREL phase limit, twice the publish window if None
+        self._refillPending = False # Acknowledges made room in the publish window
+        self._stats        =  {'timeouts': 0, 'rttInflations': 0, 'decreases': 0}
         # additional, per-connection subscriber state
         self.onPublish   = None
         # a callback  when CONNACK packet is received
         self.onMqttConnectionMade = None  
       
        
+    # ---------------------------------
+    # IMQTTClientControl Implementation
+    # ---------------------------------
+
+    def setWindowSize(self, n):
+        '''
+        API Entry Point
+        '''
+        MQTTBaseProtocol.setWindowSize(self, n)
+        self._cwnd = None
+
+
     # -----------------------------
     # IMQTTPublisher Implementation
     # -----------------------------
@@ -156,9 +191,51 @@ class MQTTProtocol(MQTTBaseProtocol):
             raise ValueError("Bandwith should be a positive number")
         if factor <= 0:
             raise ValueError("Factor should be a positive number")
-        self._bandwith = bandwith
+        self._bandwith = BandwithEstimator(bandwith, self.BANDWITH_WINDOW)
         self._factor   = factor
 
+
+    def getBandwith(self):
+        '''
+        API entry point.
+        '''
+        return self._bandwith.estimate(self._timers.clock.seconds())
+
+
+    def setReleaseWindowSize(self, n):
+        '''
+        API entry point.
+        '''
+        if not (0 < n <= self.MAX_WINDOW):
+            raise WindowValueError(n)
+        self._releaseWindow = n
+
+
+    def setAdaptiveWindow(self, minimum=1, maximum=None):
+        '''
+        API entry point.
+        '''
+        if maximum is None:
+            maximum = self.MAX_WINDOW
+        if not (0 < minimum <= maximum <= self.MAX_WINDOW):
+            raise WindowValueError((minimum, maximum))
+        self._cwndMin = minimum
+        self._cwndMax = maximum
+        self._cwnd    = float(minimum)
+
+
+    def getWindowStats(self):
+        '''
+        API entry point.
+        '''
+        stats = dict(self._stats)
+        stats['window']   = self._publishWindow()
+        stats['adaptive'] = self._cwnd is not None
+        stats['inflight'] = len(self.session.windowPublish)
+        stats['releasing'] = len(self.session.windowPubRelease)
+        stats['queued']   = len(self.session.queuePublishTx)
+        return stats
+
     
     def publish(self, topic, message, qos=0, retain=False):
         '''
@@ -173,6 +250,15 @@ class MQTTProtocol(MQTTBaseProtocol):
         return self.state.publish(request)
 
 
+    def prepare(self, topic, qos=0, retain=False):
+        '''
+        API entry point.
+        '''
+        if not ( 0<= qos < 3):
+            raise QoSValueError("prepare()", qos)
+        return PublishTemplate(self, topic, qos, retain)
+
+
     # ---------------------------------
     # IMQTTSubscriber Implementation
     # ---------------------------------
@@ -207,14 +293,15 @@ class MQTTProtocol(MQTTBaseProtocol):
         Handle SUBACK control packet received.
         '''
         try:
-            request = self.factory.windowSubscribe[self.addr][response.msgId]
+            request = self.session.windowSubscribe[response.msgId]
         except KeyError as e:
             log.debug("<== {packet:7} (id={response.msgId:04x}) already handled" , packet="SUBACK",  response=response)
         else:    
             log.debug("<== {packet:7} (id={response.msgId:04x})" , packet="SUBACK",  response=response)
-            request = self.factory.windowSubscribe[self.addr][response.msgId]
-            del self.factory.windowSubscribe[self.addr][response.msgId]
+            del self.session.windowSubscribe[response.msgId]
+            self.session.packetIds.release(response.msgId)
             request.alarm.cancel()
+            self._sampleRTT(request.sentAt)
             request.deferred.callback(response.granted)
        
     # --------------------------------------------------------------------------
@@ -224,14 +311,15 @@ class MQTTProtocol(MQTTBaseProtocol):
         Handle UNSUBACK control packet received.
         '''
         try:
-            request = self.factory.windowUnsubscribe[self.addr][response.msgId]
+            request = self.session.windowUnsubscribe[response.msgId]
         except KeyError as e:
             log.debug("<== {packet:7} (id={response.msgId:04x}) already handled" , packet="UNSUBACK",  response=response)
         else:
             log.debug("<== {packet:7} (id={response.msgId:04x})" , packet="UNSUBACK",  response=response)
-            request = self.factory.windowUnsubscribe[self.addr][response.msgId]
-            del self.factory.windowUnsubscribe[self.addr][response.msgId]
+            del self.session.windowUnsubscribe[response.msgId]
+            self.session.packetIds.release(response.msgId)
             request.alarm.cancel()
+            self._sampleRTT(request.sentAt)
             request.deferred.callback(response.msgId)
 
     # --------------------------------------------------------------------------
@@ -245,18 +333,14 @@ class MQTTProtocol(MQTTBaseProtocol):
             self._deliver(response)
         elif response.qos == 1:
             log.debug("==> {packet:7} (id={response.msgId:04x} qos={response.qos} dup={response.dup} retain={response.retain} topic={response.topic})" , packet="PUBLISH", response=response)
-            reply = PUBACK()
-            reply.msgId = response.msgId
             log.debug("<== {packet:7} (id={response.msgId:04x})" , packet="PUBACK", response=response)
-            self.transport.write(reply.encode())
+            self._writeAck(encodeAck(0x40, response.msgId))
             self._deliver(response)
         elif response.qos == 2:
             log.debug("==> {packet:7} (id={response.msgId:04x} qos={response.qos} dup={response.dup} retain={response.retain} topic={response.topic})" , packet="PUBLISH", response=response)
-            self.factory.windowPubRx[self.addr][response.msgId] = response
-            reply = PUBREC()
-            reply.msgId = response.msgId
+            self.session.windowPubRx[response.msgId] = response
             log.debug("<== {packet:7} (id={response.msgId:04x})" , packet="PUBREC", response=response)
-            self.transport.write(reply.encode())
+            self._writeAck(encodeAck(0x50, response.msgId))
 
     # --------------------------------------------------------------------------
 
@@ -265,18 +349,15 @@ class MQTTProtocol(MQTTBaseProtocol):
         Handle PUBREL control packet received.
         '''
         try:
-            msg = self.factory.windowPubRx[self.addr][response.msgId]
+            msg = self.session.windowPubRx[response.msgId]
         except KeyError as e:
             log.debug("==> {packet:7}(id={response.msgId:04x} dup={response.dup}) already handled" , packet="PUBREL", response=response)
         else:
             log.debug("==> {packet:7}(id={response.msgId:04x} dup={response.dup})" , packet="PUBREL", response=response)
-            del self.factory.windowPubRx[self.addr][response.msgId]
+            del self.session.windowPubRx[response.msgId]
             self._deliver(msg)
-            reply = PUBCOMP()
-            reply.msgId = response.msgId
-            reply.encode()
             log.debug("<== {packet:7} (id={response.msgId:04x})" , packet="PUBCOMP", response=response)
-            self.transport.write(reply.encode())
+            self._writeAck(encodeAck(0x72, response.msgId))
 
 
     # --------------------------------------------------------------------------
@@ -289,15 +370,17 @@ class MQTTProtocol(MQTTBaseProtocol):
         '''
         # so:  response.msgId == windowPublish[self.addr][0].msgId
         try:
-             request = self.factory.windowPublish[self.addr][response.msgId]
+             request = self.session.windowPublish[response.msgId]
         except KeyError as e:
             log.debug("<== {packet:7} (id={response.msgId:04x}) already handled", packet="PUBACK", response=response)
         else:
             log.debug("<== {packet:7} (id={response.msgId:04x})", packet="PUBACK", response=response)
             request.alarm.cancel()
+            self._sampleDelivery(request)
             request.deferred.callback(request.msgId)
-            del self.factory.windowPublish[self.addr][response.msgId]
-            self._refillPublish(dup=False)
+            del self.session.windowPublish[response.msgId]
+            self.session.packetIds.release(response.msgId)
+            self._refillPending = True
 
     # --------------------------------------------------------------------------
 
@@ -307,21 +390,27 @@ class MQTTProtocol(MQTTBaseProtocol):
         '''
         # so:  response.msgId == windowPublish[self.addr][0].msgId
         try:
-            request = self.factory.windowPublish[self.addr][response.msgId]
+            request = self.session.windowPublish[response.msgId]
         except KeyError as e:
             log.debug("<== {packet:7} (id={response.msgId:04x}) already handled", packet="PUBREC", response=response)
         else:
             log.debug("<== {packet:7} (id={response.msgId:04x})", packet="PUBREC", response=response)
             request.alarm.cancel()
-            del self.factory.windowPublish[self.addr][response.msgId]
-            reply = PUBREL()
-            reply.msgId = response.msgId
-            reply.interval = Interval(initial=self._initialT)
-            reply.deferred = request.deferred       # Transfer the deferred to PUBREL
-            reply.retries  = request.retries        # and the retry count
-            reply.encode()
-            self.factory.windowPubRelease[self.addr][reply.msgId] = reply
+            self._sampleDelivery(request)
+            del self.session.windowPublish[response.msgId]
+            pdu = PUBREL()
+            pdu.msgId = response.msgId
+            pdu.encode()
+            # Reuses the record, transferring the deferred and the retry count to PUBREL
+            reply = request
+            reply.frames   = pdu.frames
+            reply.size     = len(pdu.encoded)
+            reply.dup      = False
+            reply.alarm    = None
+            reply.interval = Interval(initial=self._rtt.timeout())
+            self.session.windowPubRelease[reply.msgId] = reply
             self._retryRelease(reply, False)
+            self._refillPending = True
 
 
     # --------------------------------------------------------------------------
@@ -332,15 +421,17 @@ class MQTTProtocol(MQTTBaseProtocol):
         '''
         # Same comment as PUBACK
         try:
-            reply = self.factory.windowPubRelease[self.addr][response.msgId]
+            reply = self.session.windowPubRelease[response.msgId]
         except KeyError as e:
             log.debug("<== {packet:7} (id={response.msgId:04x}) already handled", packet="PUBCOMP", response=response)
         else: 
             log.debug("<== {packet:7} (id={response.msgId:04x})", packet="PUBCOMP", response=response)
             reply.alarm.cancel()
+            self._sampleRTT(reply.sentAt)
             reply.deferred.callback(reply.msgId)
-            del self.factory.windowPubRelease[self.addr][reply.msgId]
-            self._refillPublish(dup=False)
+            del self.session.windowPubRelease[reply.msgId]
+            self.session.packetIds.release(reply.msgId)
+            self._refillPending = True
 
 
     # ---------------------------
@@ -358,6 +449,21 @@ class MQTTProtocol(MQTTBaseProtocol):
         if self.onMqttConnectionMade:
             self.onMqttConnectionMade()
 
+    def readComplete(self):
+        '''
+        Refills the publish window once for all the acknowledges in a read.
+        '''
+        if self._refillPending:
+            self._refillPending = False
+            self._refillPublish(dup=False)
+
+    def writeResumed(self):
+        '''
+        Goes on draining the publish queue, stopped while the transport was full.
+        '''
+        if self.state is not self.IDLE:    # publishing is allowed before CONNACK
+            self._refillPublish(dup=False)
+
     # ---------------------------
     # State Machine API callbacks
     # ---------------------------
@@ -373,16 +479,17 @@ class MQTTProtocol(MQTTBaseProtocol):
             request.topics = [(request.topics[0], request.topics[1])] 
         try:
             self._checkSubscribe(request)
-            request.msgId = self.factory.makeId()
+            request.msgId = self.session.packetIds.allocate()
             request.encode()
         except Exception as e:
+            self.session.packetIds.release(request.msgId)
             return defer.fail(e)
-        request.interval = Interval(initial=self._initialT)
-        request.deferred = defer.Deferred()
-        request.deferred.msgId = request.msgId
-        self.factory.windowSubscribe[self.addr][request.msgId] = request
-        self._retrySubscribe(request, False)
-        return  request.deferred 
+        record = InFlight(request.msgId, request.frames, defer.Deferred(),
+                          Interval(initial=self._rtt.timeout()), len(request.encoded))
+        record.deferred.msgId = record.msgId
+        self.session.windowSubscribe[record.msgId] = record
+        self._retrySubscribe(record, False)
+        return  record.deferred 
 
     # --------------------------------------------------------------------------
 
@@ -390,21 +497,21 @@ class MQTTProtocol(MQTTBaseProtocol):
         '''
         Send an UNSUBSCRIBE control packet
         '''
-        request.msgId = self.factory.makeId()
         if isinstance(request.topics, str):
             request.topics = [request.topics]
         try:
             self._checkUnsubscribe(request)
-            request.msgId = self.factory.makeId()
+            request.msgId = self.session.packetIds.allocate()
             request.encode() 
         except Exception as e:
+            self.session.packetIds.release(request.msgId)
             return defer.fail(e)
-        request.interval = Interval(initial=self._initialT)
-        request.deferred = defer.Deferred()
-        request.deferred.msgId = request.msgId
-        self.factory.windowUnsubscribe[self.addr][request.msgId] = request
-        self._retryUnsubscribe(request, dup=False)
-        return  request.deferred
+        record = InFlight(request.msgId, request.frames, defer.Deferred(),
+                          Interval(initial=self._rtt.timeout()), len(request.encoded))
+        record.deferred.msgId = record.msgId
+        self.session.windowUnsubscribe[record.msgId] = record
+        self._retryUnsubscribe(record, dup=False)
+        return  record.deferred
 
     # --------------------------------------------------------------------------
 
@@ -426,26 +533,28 @@ class MQTTProtocol(MQTTBaseProtocol):
         except Exception as e:
             return defer.fail(e)
 
-        if request.qos == 0:
-            request.msgId    = None
-            request.deferred = defer.succeed(None)
-            request.interval = None
-        else:
-            request.msgId    = self.factory.makeId()
-            request.deferred = defer.Deferred()
-            request.interval = IntervalLinear(initial=self._initialT, 
-                                              bandwith=self._bandwith, 
-                                              factor=self._factor)
-            request.retries  = 0
         try:
-            request.encode()
+            if request.qos != 0:
+                request.msgId = 0   # allocated when entering the publish window
+            request.encodeSegments()
         except Exception as e:
             return defer.fail(e)
-
-        self.factory.queuePublishTx[self.addr].append(request)
-        request.deferred.msgId = request.msgId
+        if request.qos == 0:
+            deferred = defer.succeed(None)
+            interval = None
+        else:
+            deferred = defer.Deferred()
+            interval = IntervalLinear(initial=self._rtt.timeout(), 
+                                      bandwith=self.getBandwith(), 
+                                      factor=self._factor)
+
+        # Only the encoded frames are kept from now on
+        size   = len(request.header) + len(request.body)
+        record = InFlight(None, request.frames, deferred, interval, size, request.qos)
+        self.session.queuePublishTx.append(record)
+        deferred.msgId = None
         self._refillPublish(dup=False)
-        return  request.deferred 
+        return  deferred 
 
 
     # --------------------------
@@ -456,12 +565,11 @@ class MQTTProtocol(MQTTBaseProtocol):
         '''
         Transmit/Retransmit SUBSCRIBE packet
         '''
-        if self._version == v31:
-            request.encoded[0] |=  (dup << 3)   # set the dup flag
-        interval = request.interval() + 0.25*len(self.factory.windowSubscribe[self.addr])
-        request.alarm = self.callLater(interval, self._subscribeError, request)
+        interval = request.interval() + min(0.25*len(self.session.windowSubscribe), self.RETRY_SPREAD_MAX)
+        request.alarm = self._timers.callLater(interval, self._subscribeError, request)
+        request.sentAt = None if dup else self._timers.clock.seconds()
         log.debug("==> {packet:7} (id={request.msgId:04x} dup={dup})", packet="SUBSCRIBE", request=request, dup=dup)
-        self.transport.write(str(request.encoded) if PY2 else bytes(request.encoded))
+        self._write(request.frames[self._version == v31 and dup])   # DUP flag only in v3.1
 
     # --------------------------------------------------------------------------
 
@@ -469,12 +577,11 @@ class MQTTProtocol(MQTTBaseProtocol):
         '''
         Transmit/Retransmit UNSUBSCRIBE packet
         '''
-        if self._version == v31:
-            request.encoded[0] |=  (dup << 3)   # set the dup flag
-        interval = request.interval() + 0.25*len(self.factory.windowUnsubscribe[self.addr])
-        request.alarm = self.callLater(interval, self._unsubscribeError, request)
+        interval = request.interval() + min(0.25*len(self.session.windowUnsubscribe), self.RETRY_SPREAD_MAX)
+        request.alarm = self._timers.callLater(interval, self._unsubscribeError, request)
+        request.sentAt = None if dup else self._timers.clock.seconds()
         log.debug("==> {packet:7} (id={request.msgId:04x} dup={dup})", packet="UNSUBSCRIBE", request=request, dup=dup)
-        self.transport.write(str(request.encoded) if PY2 else bytes(request.encoded))
+        self._write(request.frames[self._version == v31 and dup])   # DUP flag only in v3.1
 
     # --------------------------------------------------------------------------
 
@@ -499,7 +606,7 @@ class MQTTProtocol(MQTTBaseProtocol):
         Handle ack of UNSUBACK packet
         '''
         log.error("{packet:7} (id={request.msgId:04x}) {timeout}, retransmitting", packet="UNSUBSCRIBE", request=request,  timeout="timeout")
-        self.reUnubscribe(request,  dup=True)
+        self._retryUnsubscribe(request,  dup=True)
 
     # --------------------------------------------------------------------------
 
@@ -507,7 +614,7 @@ class MQTTProtocol(MQTTBaseProtocol):
         '''
         Assert subscribe parameters
         '''
-        if len(self.factory.windowSubscribe[self.addr]) == self._window:
+        if len(self.session.windowSubscribe) == self._window:
             raise MQTTWindowError("subscription requests exceeded limit", self._window)
         if not isinstance(request.topics, list):
             raise TopicTypeError(type(topic))
@@ -521,7 +628,7 @@ class MQTTProtocol(MQTTBaseProtocol):
         '''
         Assert unsubscribe parameters
         '''
-        if len(self.factory.windowUnsubscribe[self.addr]) == self._window:
+        if len(self.session.windowUnsubscribe) == self._window:
             raise MQTTWindowError("unsubscription requests exceeded limit", self._window)
         if not isinstance(request.topics, list):
             raise TopicTypeError(type(topic))
@@ -532,30 +639,84 @@ class MQTTProtocol(MQTTBaseProtocol):
 
     def _refillPublish(self, dup):
         '''
-        Refills the Publisher transmission window from the queue 
-        '''
-        cnx = self.addr
-        N = min(self._window - len(self.factory.windowPublish[cnx]), len(self.factory.queuePublishTx[cnx]))
-        for i in range(0,N):
-            request = self.factory.queuePublishTx[cnx].popleft()
-            if request.msgId:   # only form QoS 1 & 2
-                self.factory.windowPublish[cnx][request.msgId] = request
-            self._retryPublish(request, dup)
+        Refills the Publisher transmission window from the queue,
+        until the transport buffer is full (resumed in writeResumed())
+        '''
+        window   = self._publishWindow()
+        release  = self._releaseWindow or 2*window
+        queue    = self.session.queuePublishTx
+        inflight = self.session.windowPublish
+        batch    = self._coalesce[1] if self._coalesce else self.COALESCE_BYTES
+        frames   = []   # sent in as few writes as possible
+        size     = 0
+        while queue and not self._paused:
+            request = queue[0]
+            if request.qos:     # QoS 0 messages take no room in the window
+                if len(inflight) >= window:
+                    break
+                if request.qos == 2 and len(self.session.windowPubRelease) >= release:
+                    break   # QoS 2 waits for PUBCOMP, keeping the publish order
+                try:
+                    self._stampPublish(request)
+                except MQTTWindowError:
+                    break   # ids held by other exchanges, retried on their acknowledges
+                inflight[request.msgId] = request
+            queue.popleft()
+            self._retryPublish(request, dup, frames)
+            size += request.size
+            if size >= batch:
+                self._writeBulk(frames, size)   # may pause us
+                frames = []
+                size   = 0
+        if frames:
+            self._writeBulk(frames, size)
+
+
+    def _stampPublish(self, request):
+        '''
+        Allocates the packet id of a queued PUBLISH request (QoS 1 & 2)
+        as it enters the publish window, so that queued messages hold none.
+        '''
+        msgId = self.session.packetIds.allocate()
+        request.msgId  = msgId
+        request.frames = stampMsgId(request.frames, msgId)
+        request.deferred.msgId = msgId
+
+
+    def _publishWindow(self):
+        '''
+        Current size of the publish window, fixed or adaptive
+        '''
+        return self._window if self._cwnd is None else int(self._cwnd)
 
+    # --------------------------------------------------------------------------
 
-    def _retryPublish(self, request, dup):
+    def _retryPublish(self, request, dup, frames=None):
         '''
-        Transmit/Retransmit one PUBLISH packet 
+        Transmit/Retransmit one PUBLISH packet, 
+        or append its frames to the C{frames} list if given
         '''
-        request.encoded[0] |=  (dup << 3)   # set the dup flag
         request.dup = dup
         if request.interval:    # Handle timeouts for QoS 1 and 2
-            request.alarm = self.callLater(request.interval(len(request.encoded)), self._publishError, request)
+            request.interval.initial = self._rtt.timeout()  # backed off by earlier timeouts
+            request.alarm = self._timers.callLater(request.interval(request.size), self._publishError, request)
+            if dup:
+                request.sentAt = None
+            else:
+                now = self._timers.clock.seconds()
+                if len(self.session.windowPublish) == 1 or self._deliveredAt is None:
+                    self._deliveredAt = now     # nothing else in flight or a resumed session, restart the delivery clock
+                request.sentAt      = now
+                request.delivered   = self._delivered
+                request.deliveredAt = self._deliveredAt
         if request.msgId is None:
-            log.debug("==> {packet:7} (id={request.msgId} qos={request.qos} dup={dup} retain={request.retain} topic={request.topic})", packet="PUBLISH", request=request, dup=dup)
+            log.debug("==> {packet:7} (id={request.msgId} qos={request.qos} dup={dup} size={request.size})", packet="PUBLISH", request=request, dup=dup)
+        else:
+            log.debug("==> {packet:7} (id={request.msgId:04x} qos={request.qos} dup={dup} size={request.size})", packet="PUBLISH", request=request, dup=dup)
+        if frames is None:
+            self._writeBulk(request.frames[dup], request.size)
         else:
-            log.debug("==> {packet:7} (id={request.msgId:04x} qos={request.qos} dup={dup} retain={request.retain} topic={request.topic})", packet="PUBLISH", request=request, dup=dup)
-        self.transport.write(str(request.encoded) if PY2 else bytes(request.encoded))
+            frames.extend(request.frames[dup])
 
     # --------------------------------------------------------------------------
 
@@ -564,11 +725,11 @@ class MQTTProtocol(MQTTBaseProtocol):
         Transmit/Retransmit PUBREL packet 
         '''
         if self._version == v31:
-            reply.encoded[0] |=  (dup << 3)   # set the dup flag
             reply.dup = dup
-        reply.alarm = self.callLater(reply.interval(), self._pubrelError, reply)
+        reply.alarm = self._timers.callLater(reply.interval(), self._pubrelError, reply)
+        reply.sentAt = None if dup else self._timers.clock.seconds()
         log.debug("==> {packet:7} (id={reply.msgId:04x} dup={dup})", packet="PUBREL", reply=reply, dup=dup)
-        self.transport.write(str(reply.encoded) if PY2 else bytes(reply.encoded))
+        self._write(reply.frames[self._version == v31 and dup])   # DUP flag only in v3.1
 
     # --------------------------------------------------------------------------
 
@@ -576,11 +737,55 @@ class MQTTProtocol(MQTTBaseProtocol):
     # According to QoS = 1 we should never give up _retryPublish as long as 
     # we are connected to a server. So there is no retry count.
 
+    def _sampleDelivery(self, request):
+        '''
+        Accounts the bytes of an acknowledged PUBLISH and, unless it was
+        retransmitted, samples the round trip time and the delivery rate
+        since the acknowledge preceding its transmission.
+        '''
+        now = self._timers.clock.seconds()
+        self._delivered  += request.size
+        self._deliveredAt = now
+        if request.sentAt is not None:
+            srtt = self._rtt.srtt
+            # The transfer time is not part of the RTT as it is added back in IntervalLinear
+            rtt  = self._sampleRTT(request.sentAt, request.size/self._bandwith.estimate(now))
+            elapsed = now - request.deliveredAt
+            if elapsed > 0:
+                self._bandwith.sample((self._delivered - request.delivered)/elapsed, now)
+            if self._cwnd is not None:
+                if srtt is not None and rtt > self.RTT_INFLATION*srtt:
+                    self._stats['rttInflations'] += 1
+                    self._congestion(request)
+                else:
+                    self._cwnd = min(self._cwnd + 1/self._cwnd, self._cwndMax)
+
+    # --------------------------------------------------------------------------
+
+    def _congestion(self, request):
+        '''
+        Shrinks the adaptive publish window, once per congestion episode:
+        requests sent before the last decrease do not shrink it again.
+        '''
+        if self._congestedAt is not None and request.sentAt <= self._congestedAt:
+            return
+        self._congestedAt = self._timers.clock.seconds()
+        self._cwnd = max(self._cwnd*self.WINDOW_DECREASE, self._cwndMin)
+        self._stats['decreases'] += 1
+
+    # --------------------------------------------------------------------------
+
     def _publishError(self, request):
         '''
         Handle the absence of PUBACK / PUBREC 
         '''
         request.retries += 1
+        self._stats['timeouts'] += 1
+        # Messages sent together also expire together, back off once (RFC 6298, 5.5)
+        if request.interval.initial >= self._rtt.timeout():
+            self._rtt.backoff()
+        if self._cwnd is not None and request.sentAt is not None:
+            self._congestion(request)
         log.error("{packet:7} (id={request.msgId:04x} qos={request.qos}) {timeout}, _retryPublish({request.retries})", packet="PUBREC/PUBACK", request=request, timeout="timeout")
         self._retryPublish(request, dup=True)
 
@@ -590,7 +795,7 @@ class MQTTProtocol(MQTTBaseProtocol):
         '''
         Handle the absence of PUBCOMP 
         '''
-        log.error("{packet:7} (id={request.msgId:04x}) {timeout}, _retryPublish", packet="PUBCOMP", timeout="timeout")
+        log.error("{packet:7} (id={reply.msgId:04x}) {timeout}, _retryRelease", packet="PUBCOMP", reply=reply, timeout="timeout")
         self._retryRelease(reply, dup=True)
 
     # --------------------------------------------------------------------------
@@ -609,9 +814,9 @@ class MQTTProtocol(MQTTBaseProtocol):
         Tries to restore the session state upon a new MQTT connection made (publisher)
         '''
         #log.debug("{event}", event="Sync Persistent Session")
-        for _, reply in self.factory.windowPubRelease[self.addr].items():
+        for _, reply in self.session.windowPubRelease.items():
             self._retryRelease(reply, dup=True)
-        for _, request in self.factory.windowPublish[self.addr].items():
+        for _, request in self.session.windowPublish.items():
             self._retryPublish(request, dup=True)
 
     # --------------------------------------------------------------------------
@@ -621,14 +826,16 @@ class MQTTProtocol(MQTTBaseProtocol):
         Purges the persistent state in the client 
         '''
         #log.debug("{event}", event="Clean Persistent Session")
-        for k in list(self.factory.windowPublish[self.addr]):
-            request = self.factory.windowPublish[self.addr][k]
-            del self.factory.windowPublish[self.addr][k]
+        for k in list(self.session.windowPublish):
+            request = self.session.windowPublish[k]
+            del self.session.windowPublish[k]
+            self.session.packetIds.release(k)
             request.deferred.errback(reason)
 
-        for k in list(self.factory.windowPubRelease[self.addr]):
-            request = self.factory.windowPubRelease[self.addr][k]
-            del self.factory.windowPubRelease[self.addr][k]
+        for k in list(self.session.windowPubRelease):
+            request = self.session.windowPubRelease[k]
+            del self.session.windowPubRelease[k]
+            self.session.packetIds.release(k)
             request.deferred.errback(reason)
 
 
@@ -641,32 +848,35 @@ class MQTTProtocol(MQTTBaseProtocol):
         Additional connection lost clean up.
         '''
        
+        self._refillPending = False
         # Cancel Alarms first
-        for _, request in self.factory.windowSubscribe[self.addr].items():
+        for _, request in self.session.windowSubscribe.items():
             if request.alarm is not None:
                 request.alarm.cancel()
                 request.alarm = None
-        for _, request in self.factory.windowUnsubscribe[self.addr].items():
+        for _, request in self.session.windowUnsubscribe.items():
             if request.alarm is not None:
                 request.alarm.cancel()
                 request.alarm = None
-        for _, request in self.factory.windowPublish[self.addr].items():
+        for _, request in self.session.windowPublish.items():
             if request.alarm is not None:
                 request.alarm.cancel()
                 request.alarm = None
-        for _, request in self.factory.windowPubRelease[self.addr].items():
+        for _, request in self.session.windowPubRelease.items():
             if request.alarm is not None:
                 request.alarm.cancel()
                 request.alarm = None
         # Then, invoke errbacks anyway if we do not persist state
         if self._cleanStart:
-            for k in list(self.factory.windowSubscribe[self.addr]):
-                request = self.factory.windowSubscribe[self.addr][k]
-                del self.factory.windowSubscribe[self.addr][k]
+            for k in list(self.session.windowSubscribe):
+                request = self.session.windowSubscribe[k]
+                del self.session.windowSubscribe[k]
+                self.session.packetIds.release(k)
                 request.deferred.errback(reason)
-            for k in list(self.factory.windowUnsubscribe[self.addr]):
-                request = self.factory.windowUnsubscribe[self.addr][k]
-                del self.factory.windowUnsubscribe[self.addr][k]
+            for k in list(self.session.windowUnsubscribe):
+                request = self.session.windowUnsubscribe[k]
+                del self.session.windowUnsubscribe[k]
+                self.session.packetIds.release(k)
                 request.deferred.errback(reason)
             self._purgeSession(reason)
 
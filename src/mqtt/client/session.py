@@ -0,0 +1,125 @@
+# -*- test-case-name: mqtt.client.test.test_session -*-
+# ----------------------------------------------------------------------
+# Copyright (C) 2015 by Rafael Gonzalez 
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+# ----------------
+# Standard modules
+# ----------------
+
+from collections import deque
+
+# -----------
+# Own modules
+# -----------
+
+from ..error import MQTTWindowError
+
+
+class PacketIdAllocator(object):
+    '''
+    Allocates packet identifiers for a session, never handing out
+    an identifier still in use by an in-flight exchange.
+
+    Never used identifiers are handed out first, in increasing order.
+    Released identifiers are then reused in release order (oldest first),
+    so that an identifier is reused as late as possible.
+    Both allocation and release are O(1).
+
+    @ivar inUse: number of identifiers currently allocated.
+    '''
+
+    MAX_ID = 65535
+
+    def __init__(self):
+        self._next  = 1                          # lowest never used identifier
+        self._free  = deque()                    # released identifiers, oldest first
+        self._used  = bytearray(self.MAX_ID + 1) # in use bitmap, indexed by identifier
+        self.inUse  = 0
+
+
+    def allocate(self):
+        '''
+        Returns a free packet identifier in [1..65535].
+        @raise e: C{MQTTWindowError} if all identifiers are in use.
+        '''
+        if self._next <= self.MAX_ID:
+            msgId = self._next
+            self._next += 1
+        elif self._free:
+            msgId = self._free.popleft()
+        else:
+            raise MQTTWindowError("packet identifiers exhausted", self.MAX_ID)
+        self._used[msgId] = 1
+        self.inUse += 1
+        return msgId
+
+
+    def release(self, msgId):
+        '''
+        Releases a packet identifier once its exchange completes.
+        Releasing a free identifier or None does nothing.
+        '''
+        if msgId and self._used[msgId]:
+            self._used[msgId] = 0
+            self._free.append(msgId)
+            self.inUse -= 1
+
+
+    def __contains__(self, msgId):
+        return bool(self._used[msgId])
+
+
+    def __len__(self):
+        return self.inUse
+
+
+class Session(object):
+    '''
+    Client session state with a broker, outliving the network connections.
+
+    In-flight exchanges are kept in tables directly indexed by packet
+    identifier, so that handling an ACK costs one attribute fetch and
+    one lookup. Plain dictionaries are used: integer keys hash to
+    themselves, lookups run at C speed and iteration follows insertion
+    order, as needed to retransmit in order when the session resumes.
+
+    @ivar queuePublishTx:    PUBLISH messages waiting before being transmitted.
+    @ivar windowPublish:     PUBLISH messages waiting for PUBREC/PUBACK.
+    @ivar windowPubRelease:  PUBREL messages (qos=2) waiting for PUBCOMP (publisher).
+    @ivar windowPubRx:       PUBLISH messages (qos=2) waiting for PUBREL (subscriber).
+    @ivar windowSubscribe:   SUBSCRIBE messages waiting for SUBACK.
+    @ivar windowUnsubscribe: UNSUBSCRIBE messages waiting for UNSUBACK.
+    @ivar packetIds:         packet identifier allocator.
+    '''
+
+    def __init__(self):
+        self.queuePublishTx    = deque()
+        self.windowPublish     = {}
+        self.windowPubRelease  = {}
+        self.windowPubRx       = {}
+        self.windowSubscribe   = {}
+        self.windowUnsubscribe = {}
+        self.packetIds         = PacketIdAllocator()
+
+
+__all__ = ['Session', 'PacketIdAllocator']
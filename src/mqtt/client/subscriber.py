@@ -51,24 +51,14 @@ log = Logger(namespace='mqtt')
 
 class ConnectedState(BaseConnectedState):
 
+    # PUBREL for QoS=2 packets
+    accepts = BaseConnectedState.accepts + ("SUBACK", "UNSUBACK", "PUBLISH", "PUBREL")
+
     def subscribe(self, request):
         return self.protocol.doSubscribe(request)
 
     def unsubscribe(self, request):
         return self.protocol.doUnsubscribe(request)
-    
-    def handleSUBACK(self, response):
-        self.protocol.handleSUBACK(response)
-
-    def handleUNSUBACK(self, response):
-        self.protocol.handleUNSUBACK(response)
-
-    def handlePUBLISH(self, response):
-        self.protocol.handlePUBLISH(response)
-
-    # QoS=2 packets
-    def handlePUBREL(self, response):
-        self.protocol.handlePUBREL(response)
 
 # ------------------------
 # MQTT Client Protocol Class
@@ -28,7 +28,7 @@ from twisted.python   import log
 
 
 from mqtt import v31, v311
-from mqtt.pdu import CONNACK, PINGREQ, PINGRES
+from mqtt.pdu import CONNACK, PINGREQ, PINGRES, PUBLISH, SUBACK
 from mqtt.client.factory    import MQTTFactory
 from mqtt.client.subscriber import MQTTProtocol as MQTTSubscriberProtocol
 from mqtt.client.publisher  import MQTTProtocol as MQTTPublisherProtocol
@@ -48,6 +48,7 @@ class TestMQTTBaseProtocol1(unittest.TestCase):
         self.protocol  = MQTTBaseProtocol(self.factory)
         self.transport.protocol = self.protocol
         MQTTBaseProtocol.callLater = self.clock.callLater
+        MQTTBaseProtocol.clock     = self.clock
         self.protocol.makeConnection(self.transport)
        
 
@@ -81,6 +82,7 @@ class TestMQTTBaseProtocol2(unittest.TestCase):
         self.transport = proto_helpers.StringTransportWithDisconnection()
         self.clock     = task.Clock()
         MQTTBaseProtocol.callLater = self.clock.callLater
+        MQTTBaseProtocol.clock     = self.clock
         self.factory   = MQTTFactory(MQTTFactory.SUBSCRIBER)
         self._rebuild()
       
@@ -126,6 +128,14 @@ class TestMQTTBaseProtocol2(unittest.TestCase):
         self.transport.clear()
         self.clock.advance(6)
         self.assertEqual(self.protocol.state, self.protocol.IDLE)
+
+    def test_ping_rtt(self):
+        self._connect(keepalive=5)
+        self.assertEqual(self.protocol._rtt.srtt, None)
+        self.clock.advance(0.2)
+        self.protocol.dataReceived(PINGRES().encode())
+        self.assertAlmostEqual(self.protocol._rtt.srtt, 0.2)
+        self.assertAlmostEqual(self.protocol._rtt.timeout(), 0.6)
         
 class TestMQTTBaseExceptions(unittest.TestCase):
 
@@ -136,6 +146,7 @@ class TestMQTTBaseExceptions(unittest.TestCase):
         self.protocol  = MQTTBaseProtocol(self.factory)
         self.transport.protocol = self.protocol
         MQTTBaseProtocol.callLater = self.clock.callLater
+        MQTTBaseProtocol.clock     = self.clock
         self.protocol.makeConnection(self.transport)
        
 
@@ -200,11 +211,22 @@ class TestMQTTBaseExceptions(unittest.TestCase):
         self.assertEqual(self.protocol.state, self.protocol.IDLE)
     
     def test_window_size_large(self):
-        self.assertRaises(ValueError, self.protocol.setWindowSize, 32)
+        self.assertRaises(ValueError, self.protocol.setWindowSize, 65536)
+
+    def test_window_size_max(self):
+        self.protocol.setWindowSize(65535)
+        self.assertEqual(self.protocol._window, 65535)
 
     def test_window_size_negative(self):
         self.assertRaises(ValueError, self.protocol.setWindowSize, -1)
 
+    def test_coalescing_delay(self):
+        self.assertRaises(ValueError, self.protocol.setCoalescing, -1)
+        self.assertRaises(ValueError, self.protocol.setCoalescing, 2)
+
+    def test_coalescing_bytes(self):
+        self.assertRaises(ValueError, self.protocol.setCoalescing, 0.001, 0)
+
     def test_timeout_large(self):
         self.assertRaises(ValueError, self.protocol.setTimeout, 65536)
 
@@ -213,4 +235,141 @@ class TestMQTTBaseExceptions(unittest.TestCase):
    
        
  
-        
\ No newline at end of file
+        
+class TestMQTTBaseFraming(unittest.TestCase):
+
+    def setUp(self):
+        '''
+        Set up a connected subscriber
+        '''
+        self.transport = proto_helpers.StringTransportWithDisconnection()
+        self.clock     = task.Clock()
+        MQTTBaseProtocol.callLater = self.clock.callLater
+        MQTTBaseProtocol.clock     = self.clock
+        self.factory   = MQTTFactory(MQTTFactory.SUBSCRIBER)
+        self.protocol  = self.factory.buildProtocol(0)
+        self.transport.protocol = self.protocol
+        self.protocol.makeConnection(self.transport)
+        ack = CONNACK()
+        ack.session = False
+        ack.resultCode = 0
+        self.protocol.connect("TwistedMQTT-sub", keepalive=0, version=v31)
+        self.transport.clear()
+        self.protocol.dataReceived(ack.encode())
+        self.received = []
+        self.protocol.onPublish = self._onPublish
+
+    def _onPublish(self, topic, payload, qos, dup, retain, msgId):
+        self.received.append((topic, bytes(payload)))
+
+    def _stream(self, n, size=10):
+        encoded = bytearray()
+        for i in range(n):
+            pdu = PUBLISH()
+            pdu.qos     = 0
+            pdu.dup     = False
+            pdu.retain  = False
+            pdu.topic   = "foo/bar/{0}".format(i)
+            pdu.payload = bytearray(size)
+            encoded.extend(pdu.encode())
+        return bytes(encoded)
+
+    def test_many_packets_single_read(self):
+        self.protocol.dataReceived(self._stream(1000))
+        self.assertEqual(len(self.received), 1000)
+        self.assertEqual(self.received[999][0], "foo/bar/999")
+        self.assertEqual(len(self.protocol._buffer), 0)
+
+    def test_fragmented_reads(self):
+        data = self._stream(50, size=200)
+        for i in range(0, len(data), 7):
+            self.protocol.dataReceived(data[i:i+7])
+        self.assertEqual(len(self.received), 50)
+        self.assertEqual(self.received[49], ("foo/bar/49", bytes(200)))
+
+    def test_payload_outlives_buffer(self):
+        payloads = []
+        self.protocol.onPublish = lambda topic, payload, *args: payloads.append(payload)
+        data = self._stream(3, size=100)
+        self.protocol.dataReceived(data[:-10])
+        self.protocol.dataReceived(data[-10:])
+        self.protocol.dataReceived(b'\xff' * 2000)
+        self.assertEqual(len(payloads), 3)
+        for payload in payloads:
+            self.assertIsInstance(payload, bytes)
+            self.assertEqual(payload, bytes(100))
+
+    def test_split_length_field(self):
+        data = self._stream(1, size=300)    # 2 bytes remaining length field
+        self.protocol.dataReceived(data[:2])
+        self.protocol.dataReceived(data[2:])
+        self.assertEqual(len(self.received), 1)
+
+    def test_max_frame_size(self):
+        self.protocol.setMaxFrameSize(100)
+        data = self._stream(1, size=200)
+        self.protocol.dataReceived(data[:10])
+        self.assertEqual(self.transport.connected, False)
+        self.assertEqual(len(self.protocol._buffer), 0)
+        self.assertEqual(len(self.received), 0)
+
+    def test_malformed_length(self):
+        self.protocol.dataReceived(b'\x30\xff\xff\xff\xff\x01')
+        self.assertEqual(self.transport.connected, False)
+
+    def test_max_frame_size_range(self):
+        self.assertRaises(ValueError, self.protocol.setMaxFrameSize, 1)
+        self.assertRaises(ValueError, self.protocol.setMaxFrameSize, MQTTBaseProtocol.MAX_PACKET_SIZE+1)
+
+class TestMQTTBaseDispatch(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = proto_helpers.StringTransportWithDisconnection()
+        self.clock     = task.Clock()
+        MQTTBaseProtocol.callLater = self.clock.callLater
+        MQTTBaseProtocol.clock     = self.clock
+        self.factory   = MQTTFactory(MQTTFactory.PUBLISHER)
+        self.protocol  = self.factory.buildProtocol(0)
+        self.transport.protocol = self.protocol
+        self.protocol.makeConnection(self.transport)
+
+    def _connect(self):
+        ack = CONNACK()
+        ack.session = False
+        ack.resultCode = 0
+        self.protocol.connect("TwistedMQTT-pub", keepalive=0, version=v31)
+        self.transport.clear()
+        self.protocol.dataReceived(ack.encode())
+
+    def test_dispatch_follows_state(self):
+        self.assertIs(self.protocol._dispatch, self.protocol.IDLE.dispatch)
+        self._connect()
+        self.assertIs(self.protocol._dispatch, self.protocol.CONNECTED.dispatch)
+        self.assertEqual(len(self.protocol._dispatch), 16)
+
+    def test_unexpected_packet(self):
+        self._connect()
+        ack = SUBACK()
+        ack.msgId = 1
+        ack.granted = [(0, False)]
+        self.protocol.dataReceived(ack.encode())
+        self.assertEqual(self.transport.connected, True)
+        self.assertEqual(self.protocol.state, self.protocol.CONNECTED)
+
+    def test_unexpected_connack(self):
+        self._connect()
+        ack = CONNACK()
+        ack.session = False
+        ack.resultCode = 0
+        self.protocol.dataReceived(ack.encode())
+        self.assertEqual(self.transport.connected, True)
+
+    def test_invalid_packet(self):
+        self._connect()
+        self.protocol.dataReceived(b'\x10\x00')     # CONNECT is never sent by servers
+        self.assertEqual(self.transport.connected, False)
+
+    def test_reserved_packet(self):
+        self._connect()
+        self.protocol.dataReceived(b'\xF0\x00')
+        self.assertEqual(self.transport.connected, False)
@@ -54,3 +54,32 @@ class PDUTestCase(unittest.TestCase):
     def test_buildProtocol_other(self):
         self.factory = MQTTFactory(0)
         self.assertRaises(ValueError, self.factory.buildProtocol, 0)
+
+
+
+class SessionTestCase(unittest.TestCase):
+
+    def test_per_session(self):
+        factory = MQTTFactory(MQTTFactory.PUBLISHER)
+        factory.buildProtocol(0)
+        factory.buildProtocol(1)
+        self.assertEqual(factory.makeId(0), 1)
+        self.assertEqual(factory.makeId(1), 1)
+        factory.releaseId(0, 1)
+        self.assertEqual(factory.packetIds[0].inUse, 0)
+        self.assertEqual(factory.packetIds[1].inUse, 1)
+
+    def test_makeId_no_session(self):
+        factory = MQTTFactory(MQTTFactory.PUBLISHER)
+        self.assertEqual(factory.makeId(), 1)
+        self.assertEqual(factory.makeId(), 2)
+        factory.id = 65535
+        self.assertEqual(factory.makeId(), 1)
+
+    def test_session_views(self):
+        factory = MQTTFactory(MQTTFactory.PUBLISHER)
+        p1 = factory.buildProtocol(0)
+        p2 = factory.buildProtocol(0)
+        self.assertIs(p1.session, p2.session)
+        self.assertIs(factory.windowPublish[0], p1.session.windowPublish)
+        self.assertIs(factory.queuePublishTx[0], p1.session.queuePublishTx)
@@ -0,0 +1,115 @@
+# ----------------------------------------------------------------------
+# Copyright (C) 2015 by Rafael Gonzalez 
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+from twisted.trial    import unittest
+
+from mqtt.client.interval import Interval, IntervalLinear, RTTEstimator, BandwithEstimator
+
+
+class IntervalTestCase(unittest.TestCase):
+
+    def test_backoff(self):
+        interval = Interval(initial=4, maxDelay=20)
+        for expected in (8, 16, 20, 20):
+            t = interval()
+            self.assertTrue(expected <= t < expected + 1)
+
+    def test_jitter_short(self):
+        # Jitter does not exceed the initial value
+        interval = Interval(initial=0.5)
+        self.assertTrue(1 <= interval() < 1.5)
+        interval = IntervalLinear(initial=0.5, bandwith=1000)
+        self.assertTrue(1.5 <= interval(1000) < 2)
+
+
+class RTTEstimatorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.rtt = RTTEstimator(initial=4, minTimeout=0.5, maxTimeout=60, granularity=0.25)
+
+    def test_initial(self):
+        self.assertEqual(self.rtt.timeout(), 4)
+        self.assertEqual(self.rtt.srtt, None)
+
+    def test_first_sample(self):
+        self.rtt.sample(2)
+        self.assertEqual(self.rtt.srtt, 2)
+        self.assertEqual(self.rtt.rttvar, 1)
+        self.assertEqual(self.rtt.timeout(), 6)
+
+    def test_smoothing(self):
+        self.rtt.sample(2)
+        self.rtt.sample(4)
+        self.assertEqual(self.rtt.rttvar, 0.75*1 + 0.25*2)
+        self.assertEqual(self.rtt.srtt, 0.875*2 + 0.125*4)
+        self.assertEqual(self.rtt.timeout(), self.rtt.srtt + 4*self.rtt.rttvar)
+
+    def test_converges(self):
+        for i in range(50):
+            self.rtt.sample(0.8)
+        self.assertAlmostEqual(self.rtt.srtt, 0.8)
+        # variation vanishes, the timer granularity remains
+        self.assertAlmostEqual(self.rtt.timeout(), 0.8 + 0.25)
+
+    def test_bounds(self):
+        self.rtt.sample(0.001)
+        self.assertEqual(self.rtt.timeout(), 0.5)
+        for i in range(20):
+            self.rtt.sample(100)
+        self.assertEqual(self.rtt.timeout(), 60)
+
+
+    def test_backoff(self):
+        self.rtt.sample(2)
+        self.rtt.backoff()
+        self.assertEqual(self.rtt.timeout(), 12)
+        for i in range(5):
+            self.rtt.backoff()
+        self.assertEqual(self.rtt.timeout(), 60)
+        # Kept until a new sample arrives
+        self.rtt.sample(2)
+        self.assertEqual(self.rtt.timeout(), 2 + 4*0.75)
+
+
+class BandwithEstimatorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.bw = BandwithEstimator(initial=10000, window=10)
+
+    def test_initial(self):
+        self.assertEqual(self.bw.estimate(0), 10000)
+
+    def test_max_filter(self):
+        self.bw.sample(500, 0)
+        self.assertEqual(self.bw.estimate(0), 500)
+        self.bw.sample(2000, 1)
+        self.bw.sample(1000, 2)
+        self.assertEqual(self.bw.estimate(2), 2000)
+
+    def test_window(self):
+        self.bw.sample(2000, 0)
+        self.bw.sample(1000, 5)
+        self.assertEqual(self.bw.estimate(10), 2000)
+        self.assertEqual(self.bw.estimate(12), 1000)
+        # the last sample is kept when all expire
+        self.assertEqual(self.bw.estimate(100), 1000)
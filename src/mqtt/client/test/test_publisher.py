@@ -21,6 +21,9 @@
 # WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 #----------------------------------------------------------------------
 
+import array
+import weakref
+
 from twisted.trial    import unittest
 from twisted.test     import proto_helpers
 from twisted.internet import task, defer, error
@@ -29,7 +32,7 @@ from twisted.python   import log
 
 from mqtt                   import v31
 from mqtt.error             import MQTTWindowError
-from mqtt.pdu               import CONNACK, PUBACK, PUBREC, PUBREL, PUBCOMP
+from mqtt.pdu               import CONNACK, PUBACK, PUBREC, PUBREL, PUBCOMP, DISCONNECT, headerSize, decodeLength
 from mqtt.client.base       import MQTTBaseProtocol, MQTTStateError
 from mqtt.client.factory    import MQTTFactory
 from mqtt.client.subscriber import MQTTProtocol as MQTTSubscriberProtocol
@@ -50,6 +53,7 @@ class TestMQTTPublisher1(unittest.TestCase):
         self.transport = proto_helpers.StringTransportWithDisconnection()
         self.clock     = task.Clock()
         MQTTBaseProtocol.callLater = self.clock.callLater
+        MQTTBaseProtocol.clock     = self.clock
         self.factory   = MQTTFactory(MQTTFactory.PUBLISHER)
         self._rebuild()
         # Just to generate connection contexts
@@ -78,6 +82,7 @@ class TestMQTTPublisher1(unittest.TestCase):
         self.protocol  = self.factory.buildProtocol(self.addr)
         self.transport.protocol = self.protocol
         MQTTBaseProtocol.callLater = self.clock.callLater
+        MQTTBaseProtocol.clock     = self.clock
         self.protocol.makeConnection(self.transport)
 
 
@@ -142,6 +147,28 @@ class TestMQTTPublisher1(unittest.TestCase):
 
 
 
+    def _ack(self, cls, msgId):
+        ack = cls()
+        ack.msgId = msgId
+        return ack.encode()
+
+    def _sent(self):
+        '''
+        Returns a list of (packet type, msgId, DUP flag) tuples 
+        with the packets sent so far, in order
+        '''
+        data   = self.transport.value()
+        sent   = []
+        offset = 0
+        while offset < len(data):
+            start = offset + headerSize(data[offset:])
+            end   = start + decodeLength(data[offset+1:])
+            if data[offset] >> 4 == 0x03:   # PUBLISH, skip the topic
+                start += 2 + data[start]*256 + data[start+1]
+            sent.append((data[offset] >> 4, data[start]*256 + data[start+1], data[offset] & 0x08 == 0x08))
+            offset = end
+        return sent
+
     def test_publish_single_qos0(self):
         self._connect()
         d = self.protocol.publish(topic="foo/bar/baz1", qos=0, message="hello world 0")
@@ -178,6 +205,59 @@ class TestMQTTPublisher1(unittest.TestCase):
         self.assertEqual(len(self.protocol.factory.windowPubRelease[self.addr]), 0)
         self.assertEqual(ack.msgId, self.successResultOf(d))
 
+    def test_publish_template_qos0(self):
+        self._connect()
+        template = self.protocol.prepare(topic="foo/bar/baz1", qos=0)
+        self.transport.clear()
+        d = template.publish(b"hello world 0")
+        self.assertEqual(None, self.successResultOf(d))
+        expected = self.transport.value()
+        self.transport.clear()
+        self.protocol.publish(topic="foo/bar/baz1", qos=0, message=b"hello world 0")
+        self.assertEqual(self.transport.value(), expected)
+
+    def test_publish_template_qos1(self):
+        self._connect()
+        template = self.protocol.prepare(topic="foo/bar/baz1", qos=1, retain=True)
+        d = template.publish("hello world 1")
+        request = self.protocol.factory.windowPublish[self.addr][d.msgId]
+        header, body = request.frames[False]
+        self.assertEqual(header[0], 0x33)
+        self.assertEqual(header[2:-2], template.encodedTopic)
+        ack = PUBACK()
+        ack.msgId = d.msgId
+        self.protocol.dataReceived(ack.encode())
+        self.assertEqual(len(self.protocol.factory.windowPublish[self.addr]),  0)
+        self.assertEqual(ack.msgId, self.successResultOf(d))
+
+    def test_publish_record_compact(self):
+        self._connect()
+        message = array.array('B', b'hello world')
+        ref = weakref.ref(message)
+        d = self.protocol.publish(topic="foo/bar/baz1", qos=1, message=message)
+        del message
+        request = self.protocol.factory.windowPublish[self.addr][d.msgId]
+        self.assertIsNone(ref())
+        self.assertFalse(hasattr(request, '__dict__'))
+        self.assertFalse(hasattr(request, 'topic'))
+        self.assertFalse(hasattr(request, 'payload'))
+        header, body = request.frames[False]
+        self.assertEqual(request.size, len(header) + len(body))
+
+    def test_publish_ids_released(self):
+        self._connect()
+        ids = self.protocol.factory.packetIds[self.addr]
+        dl = self._publish(n=3, qos=2, topic="foo/bar/baz", msg="Hello World")
+        self.assertEqual(ids.inUse, 3)
+        self._pubrec(dl)
+        self.assertEqual(ids.inUse, 3)
+        self._pubcomp(dl)
+        self.assertEqual(ids.inUse, 0)
+
+    def test_publish_template_bad_qos(self):
+        self._connect()
+        self.assertRaises(ValueError, self.protocol.prepare, topic="foo/bar/baz1", qos=3)
+
     def test_publish_several_qos0(self):
         self._connect()
         dl = self._publish(n=3, qos=0, topic="foo/bar/baz", msg="Hello World")
@@ -236,7 +316,8 @@ class TestMQTTPublisher1(unittest.TestCase):
         self.assertEqual(len(self.protocol.factory.windowPublish[self.addr]),  window)
         self.assertEqual(len(self.protocol.factory.queuePublishTx[self.addr]), n-window)
         self._pubrec(dl[0:window])
-        self.assertEqual(len(self.protocol.factory.windowPublish[self.addr]),  0)
+        # Refilled after the PUBRECs read
+        self.assertEqual(len(self.protocol.factory.windowPublish[self.addr]),  window)
         self.assertEqual(len(self.protocol.factory.windowPubRelease[self.addr]), window)
         self._pubcomp(dl[0:window])
         self.assertEqual(len(self.protocol.factory.queuePublishTx[self.addr]), n-2*window)
@@ -245,6 +326,278 @@ class TestMQTTPublisher1(unittest.TestCase):
 
 
 
+    def test_publish_refill_batch(self):
+        self._connect()
+        dl = self._publish(n=300, window=100, qos=1, topic="foo/bar/baz", msg="Hello World")
+        writes = []
+        writeSequence = self.transport.writeSequence
+        def countWrites(seq):
+            writes.append(len(seq))
+            writeSequence(seq)
+        self.transport.writeSequence = countWrites
+        # 100 PUBACKs in a single read are followed by a single write
+        self.protocol.dataReceived(b''.join(self._ack(PUBACK, d.msgId) for d in dl[:100]))
+        self.assertEqual(writes, [200])
+        self.assertEqual(self._sent(), [(0x03, d.msgId, False) for d in dl[100:200]])
+        for d in dl[:100]:
+            self.assertEqual(d.msgId, self.successResultOf(d))
+
+    def test_coalescing_delay(self):
+        self._connect()
+        self.protocol.setCoalescing(0.001)
+        self.protocol.setWindowSize(50)
+        writes = []
+        writeSequence = self.transport.writeSequence
+        def countWrites(seq):
+            writes.append(len(seq))
+            writeSequence(seq)
+        self.transport.writeSequence = countWrites
+        dl = [self.protocol.publish(topic="foo/bar/baz", qos=1, message="Hello World") for i in range(50)]
+        self.assertEqual(self.transport.value(), b'')
+        self.clock.advance(0.001)
+        self.assertEqual(writes, [100])
+        self.assertEqual(self._sent(), [(0x03, d.msgId, False) for d in dl])
+
+    def test_coalescing_bytes(self):
+        self._connect()
+        self.protocol.setCoalescing(1, 1000)
+        message = b'x'*300
+        self.protocol.publish(topic="foo/bar/baz", qos=0, message=message)
+        self.protocol.publish(topic="foo/bar/baz", qos=0, message=message)
+        self.assertEqual(self.transport.value(), b'')
+        self.protocol.publish(topic="foo/bar/baz", qos=0, message=message)
+        self.protocol.publish(topic="foo/bar/baz", qos=0, message=message)
+        # flushed on the fourth message, the timer is gone
+        self.assertEqual(self.transport.value().count(message), 4)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_coalescing_disconnect(self):
+        self._connect()
+        self.protocol.setCoalescing(1)
+        self.protocol.publish(topic="foo/bar/baz", qos=0, message="Hello World")
+        self.protocol.disconnect()
+        data = self.transport.value()
+        self.assertEqual(data[0], 0x30)
+        self.assertEqual(data[-2:], DISCONNECT().encode())
+
+    def test_coalescing_off(self):
+        self._connect()
+        self.protocol.setCoalescing(1)
+        d = self.protocol.publish(topic="foo/bar/baz", qos=0, message="Hello World")
+        self.protocol.setCoalescing(None)
+        self.assertEqual(self.transport.value().count(b"Hello World"), 1)
+        self.protocol.publish(topic="foo/bar/baz", qos=0, message="Hello World")
+        self.assertEqual(self.transport.value().count(b"Hello World"), 2)
+
+    def test_publish_release_window(self):
+        self._connect()
+        dl = self._publish(n=8, window=4, qos=2, topic="foo/bar/baz", msg="Hello World")
+        self._pubrec(dl[0:4])
+        # PUBRECs make room for new QoS 2 messages
+        self.assertEqual(len(self.protocol.factory.windowPublish[self.addr]),  4)
+        self.assertEqual(len(self.protocol.factory.windowPubRelease[self.addr]), 4)
+        self.assertEqual(len(self.protocol.factory.queuePublishTx[self.addr]), 0)
+
+    def test_publish_release_window_size(self):
+        self._connect()
+        self.protocol.setReleaseWindowSize(2)
+        dl = self._publish(n=8, window=4, qos=2, topic="foo/bar/baz", msg="Hello World")
+        self._pubrec(dl[0:2])
+        # The release window is full, the queued messages wait for PUBCOMPs
+        self.assertEqual(len(self.protocol.factory.windowPublish[self.addr]),  2)
+        self.assertEqual(len(self.protocol.factory.windowPubRelease[self.addr]), 2)
+        self.assertEqual(len(self.protocol.factory.queuePublishTx[self.addr]), 4)
+        self._pubcomp(dl[0:1])
+        stats = self.protocol.getWindowStats()
+        self.assertEqual(stats['inflight'],  4)
+        self.assertEqual(stats['releasing'], 1)
+        self.assertEqual(stats['queued'],    2)
+
+    def test_publish_release_window_order(self):
+        self._connect()
+        self.protocol.setWindowSize(2)
+        self.protocol.setReleaseWindowSize(1)
+        d1 = self.protocol.publish(topic="foo/bar/baz", qos=2, message="Hello World")
+        self.protocol.dataReceived(self._ack(PUBREC, d1.msgId))
+        d2 = self.protocol.publish(topic="foo/bar/baz", qos=2, message="Hello World")
+        d3 = self.protocol.publish(topic="foo/bar/baz", qos=1, message="Hello World")
+        # d3 does not overtake d2, blocked by the release window
+        self.assertEqual(len(self.protocol.factory.queuePublishTx[self.addr]), 2)
+        self.transport.clear()
+        self.protocol.dataReceived(self._ack(PUBCOMP, d1.msgId))
+        self.assertEqual(self._sent(), [(0x03, d2.msgId, False), (0x03, d3.msgId, False)])
+
+    def test_publish_large_window(self):
+        self._connect()
+        self.protocol.setWindowSize(300)
+        dl = [self.protocol.publish(topic="foo/bar/baz", qos=1, message="Hello World") for i in range(400)]
+        ids = [d.msgId for d in dl]
+        self.assertEqual(self._sent(), [(0x03, msgId, False) for msgId in ids[:300]])
+        self.assertEqual(len(self.protocol.factory.queuePublishTx[self.addr]), 100)
+        self.transport.clear()
+        # Queued messages are sent in publish order as the window opens, 
+        # whatever the order of the ACKs
+        self.protocol.dataReceived(b''.join(self._ack(PUBACK, msgId) for msgId in reversed(ids[:300])))
+        # Queued messages get their ids as they enter the window
+        self.assertEqual(self._sent(), [(0x03, d.msgId, False) for d in dl[300:]])
+        self.assertEqual(len(self.protocol.factory.windowPublish[self.addr]), 100)
+        self.assertEqual(len(self.protocol.factory.queuePublishTx[self.addr]), 0)
+        self._puback(dl[300:])
+        self.assertEqual(self.protocol.factory.packetIds[self.addr].inUse, 0)
+
+    def test_publish_deep_queue(self):
+        # Queued messages hold no packet id
+        self._connect()
+        self.protocol.setWindowSize(10)
+        dl = [self.protocol.publish(topic="foo/bar/baz", qos=1, message="Hello World") for i in range(66000)]
+        for d in dl:
+            self.assertNoResult(d)
+        self.assertEqual(self.protocol.factory.packetIds[self.addr].inUse, 10)
+        self.assertEqual(len(self.protocol.factory.queuePublishTx[self.addr]), 65990)
+        self.assertEqual(dl[10].msgId, None)
+        self.transport.clear()
+        self.protocol.dataReceived(b''.join(self._ack(PUBACK, d.msgId) for d in dl[:10]))
+        self.assertEqual(self._sent(), [(0x03, d.msgId, False) for d in dl[10:20]])
+        self.assertEqual([d.msgId for d in dl[10:20]], list(range(11, 21)))
+
+    def test_publish_retransmit_order(self):
+        self._connect()
+        dl = self._publish(n=3, qos=1, topic="foo/bar/baz", msg="Hello World")
+        self.clock.advance(2)
+        self.protocol.dataReceived(self._ack(PUBACK, dl[1].msgId))
+        d = self.protocol.publish(topic="foo/bar/baz", qos=1, message="Hello World")
+        self.clock.advance(3.3)
+        # Retransmitted messages come after a later message already sent,
+        # in no particular order among themselves
+        sent = self._sent()
+        self.assertEqual(sent[0], (0x03, d.msgId, False))
+        self.assertEqual(sorted(sent[1:]), [(0x03, dl[0].msgId, True), (0x03, dl[2].msgId, True)])
+
+    def test_publish_rtt(self):
+        self._connect()
+        self.protocol.setWindowSize(2)
+        d = self.protocol.publish(topic="foo/bar/baz", qos=1, message="Hello World")
+        self.clock.advance(0.05)
+        self.protocol.dataReceived(self._ack(PUBACK, d.msgId))
+        self.assertAlmostEqual(self.protocol._rtt.srtt, 0.05, places=2)
+        # A fast server gets fast retransmissions
+        self.transport.clear()
+        d = self.protocol.publish(topic="foo/bar/baz", qos=1, message="Hello World")
+        self.clock.advance(1.5)
+        self.assertEqual(self._sent(), [(0x03, d.msgId, False), (0x03, d.msgId, True)])
+
+    def test_publish_rtt_karn(self):
+        self._connect()
+        d = self.protocol.publish(topic="foo/bar/baz", qos=1, message="Hello World")
+        self.clock.advance(6)
+        self.assertEqual(self.protocol.factory.windowPublish[self.addr][d.msgId].dup, True)
+        # The ACK may belong to either transmission, thus it is not sampled
+        self.protocol.dataReceived(self._ack(PUBACK, d.msgId))
+        self.assertEqual(d.msgId, self.successResultOf(d))
+        self.assertEqual(self.protocol._rtt.srtt, None)
+        # The timeout backed off is kept until a valid sample
+        self.assertEqual(self.protocol._rtt.timeout(), 2*MQTTBaseProtocol.TIMEOUT_INITIAL)
+
+    def test_publish_rtt_backoff(self):
+        self._connect()
+        self.protocol.setWindowSize(10)
+        for i in range(20):
+            d = self.protocol.publish(topic="foo/bar/baz", qos=1, message="Hello World")
+            self.clock.advance(0.05)
+            self.protocol.dataReceived(self._ack(PUBACK, d.msgId))
+        rto = self.protocol._rtt.timeout()
+        self.assertEqual(rto, MQTTBaseProtocol.TIMEOUT_MIN)
+        # The server slows down to 3.5 s round trips
+        dl = self._publish(n=10, qos=1, topic="foo/bar/baz", msg="Hello World")
+        for i in range(35):
+            self.clock.advance(0.1)
+        self.protocol.dataReceived(b''.join(self._ack(PUBACK, d.msgId) for d in dl))
+        for d in dl:
+            self.assertEqual(d.msgId, self.successResultOf(d))
+        # Backed off once per round of timeouts, not once per message,
+        # the ACKs arrive before a third transmission
+        self.assertEqual(self.protocol._rtt.timeout(), 4*rto)
+        stats = self.protocol.getWindowStats()
+        self.assertEqual(stats['timeouts'], 20)
+
+    def test_publish_bandwith(self):
+        self._connect()
+        self.assertEqual(self.protocol.getBandwith(), self.protocol.DEFAULT_BANDWITH)
+        dl = self._publish(n=10, qos=1, topic="foo/bar/baz", msg=bytes(1000))
+        # One message acknowledged every 10 ms
+        for d in dl:
+            self.clock.advance(0.01)
+            self.protocol.dataReceived(self._ack(PUBACK, d.msgId))
+        self.assertTrue(95000 <= self.protocol.getBandwith() <= 105000)
+        # Explicitly set values discard previous measurements
+        self.protocol.setBandwith(500)
+        self.assertEqual(self.protocol.getBandwith(), 500)
+
+    def test_adaptive_window_grows(self):
+        self._connect()
+        self.protocol.setAdaptiveWindow(2, 4)
+        window = self.protocol.factory.windowPublish[self.addr]
+        dl = [self.protocol.publish(topic="foo/bar/baz", qos=1, message="Hello World") for i in range(30)]
+        self.assertEqual(len(window), 2)
+        while window:
+            self.clock.advance(0.1)
+            for msgId in list(window):
+                self.protocol.dataReceived(self._ack(PUBACK, msgId))
+        for d in dl:
+            self.assertEqual(d.msgId, self.successResultOf(d))
+        stats = self.protocol.getWindowStats()
+        self.assertEqual(stats['window'], 4)
+        self.assertEqual(stats['adaptive'], True)
+        self.assertEqual(stats['decreases'], 0)
+
+    def test_adaptive_window_timeout(self):
+        self._connect()
+        self.protocol.setAdaptiveWindow(1, 16)
+        self.protocol._cwnd = 8.0
+        dl = [self.protocol.publish(topic="foo/bar/baz", qos=1, message="Hello World") for i in range(10)]
+        self.clock.advance(6)
+        # A single decrease for all the messages lost together
+        stats = self.protocol.getWindowStats()
+        self.assertEqual(stats['timeouts'], 8)
+        self.assertEqual(stats['decreases'], 1)
+        self.assertEqual(stats['window'], 4)
+        self.assertEqual(stats['inflight'], 8)
+        self.assertEqual(stats['queued'], 2)
+
+    def test_adaptive_window_rtt(self):
+        self._connect()
+        self.protocol.setAdaptiveWindow(1, 16)
+        self.protocol._cwnd = 8.0
+        d = self.protocol.publish(topic="foo/bar/baz", qos=1, message="Hello World")
+        self.clock.advance(0.1)
+        self.protocol.dataReceived(self._ack(PUBACK, d.msgId))
+        d = self.protocol.publish(topic="foo/bar/baz", qos=1, message="Hello World")
+        self.clock.advance(0.5)
+        self.protocol.dataReceived(self._ack(PUBACK, d.msgId))
+        stats = self.protocol.getWindowStats()
+        self.assertEqual(stats['rttInflations'], 1)
+        self.assertEqual(stats['window'], 4)
+
+    def test_adaptive_window_disabled(self):
+        self.assertRaises(ValueError, self.protocol.setAdaptiveWindow, 0, 4)
+        self.assertRaises(ValueError, self.protocol.setAdaptiveWindow, 5, 4)
+        self.assertRaises(ValueError, self.protocol.setAdaptiveWindow, 1, 65536)
+        self.protocol.setAdaptiveWindow(2, 4)
+        self.protocol.setWindowSize(3)
+        stats = self.protocol.getWindowStats()
+        self.assertEqual(stats['adaptive'], False)
+        self.assertEqual(stats['window'], 3)
+
+    def test_persistent_session_order(self):
+        self._connect(cleanStart=False)
+        dl = self._publish(n=4, qos=2, topic="foo/bar/baz", msg="Hello World")
+        self._pubrec(dl[2:3])
+        self._serverDown()
+        self._rebuild()
+        self._connect(cleanStart=False)
+        self.assertEqual(self._sent(), [(0x06, dl[2].msgId, True),
+            (0x03, dl[0].msgId, True), (0x03, dl[1].msgId, True), (0x03, dl[3].msgId, True)])
+
     def test_lost_session(self):
         self._connect()
         dl = self._publish(n=3, qos=2, topic="foo/bar/baz", msg="Hello World")
@@ -272,6 +625,22 @@ class TestMQTTPublisher1(unittest.TestCase):
         self.assertEqual(len(self.protocol.factory.windowPublish[self.addr]),  0)
 
 
+    def test_persistent_session_new_publish(self):
+        self._connect(cleanStart=False)
+        dl = self._publish(n=3, qos=1, topic="foo/bar/baz", msg="Hello World")
+        self._serverDown()
+        self._rebuild()
+        self._connect(cleanStart=False)
+        self.protocol.setWindowSize(4)
+        self.clock.advance(1)
+        d = self.protocol.publish(topic="foo/bar/baz", qos=1, message="Hello World")
+        self.clock.advance(1)
+        self.protocol.dataReceived(self._ack(PUBACK, d.msgId))
+        self.assertEqual(d.msgId, self.successResultOf(d))
+        self._puback(dl)
+        self.assertEqual(len(self.protocol.factory.windowPublish[self.addr]),  0)
+
+
     def test_persistent_session_qos2(self):
         self._connect(cleanStart=False)
         dl = self._publish(n=3, qos=2, topic="foo/bar/baz", msg="Hello World")
@@ -335,6 +704,7 @@ class TestMQTTPublisherDisconnect(unittest.TestCase):
         self.transport = proto_helpers.StringTransportWithDisconnection()
         self.clock     = task.Clock()
         MQTTBaseProtocol.callLater = self.clock.callLater
+        MQTTBaseProtocol.clock     = self.clock
         self.factory   = MQTTFactory(MQTTFactory.PUBLISHER)
         self._rebuild()
         self.disconnected = False
@@ -363,6 +733,7 @@ class TestMQTTPublisherDisconnect(unittest.TestCase):
         self.protocol  = self.factory.buildProtocol(0)
         self.transport.protocol = self.protocol
         MQTTBaseProtocol.callLater = self.clock.callLater
+        MQTTBaseProtocol.clock     = self.clock
         self.protocol.makeConnection(self.transport)
 
     def test_disconnect_1(self):
@@ -432,6 +803,7 @@ class TestMQTTPublisherForbiddenOps(unittest.TestCase):
         self.transport = proto_helpers.StringTransportWithDisconnection()
         self.clock     = task.Clock()
         MQTTBaseProtocol.callLater = self.clock.callLater
+        MQTTBaseProtocol.clock     = self.clock
         self.factory   = MQTTFactory(MQTTFactory.PUBLISHER)
         self._rebuild()
         self.disconnected = False
@@ -455,6 +827,7 @@ class TestMQTTPublisherForbiddenOps(unittest.TestCase):
         self.protocol  = self.factory.buildProtocol(0)
         self.transport.protocol = self.protocol
         MQTTBaseProtocol.callLater = self.clock.callLater
+        MQTTBaseProtocol.clock     = self.clock
         self.protocol.makeConnection(self.transport)
 
     def test_forbidden_subscribe(self):
@@ -485,6 +858,7 @@ class TestMQTTPublisherIntervals(unittest.TestCase):
         self.transport = proto_helpers.StringTransportWithDisconnection()
         self.clock     = task.Clock()
         MQTTBaseProtocol.callLater = self.clock.callLater
+        MQTTBaseProtocol.clock     = self.clock
         self.factory   = MQTTFactory(MQTTFactory.PUBLISHER)
         self.addr = IPv4Address('TCP','localhost',1880)
         self._rebuild()
@@ -507,6 +881,7 @@ class TestMQTTPublisherIntervals(unittest.TestCase):
         self.protocol  = self.factory.buildProtocol(self.addr)
         self.transport.protocol = self.protocol
         MQTTBaseProtocol.callLater = self.clock.callLater
+        MQTTBaseProtocol.clock     = self.clock
         self.protocol.makeConnection(self.transport)
 
 
@@ -540,6 +915,22 @@ class TestMQTTPublisherIntervals(unittest.TestCase):
         for i in range(0, len(dl)):
             self.assertEqual(dl[i].msgId, self.successResultOf(dl[i]))
 
+    def test_publish_retry_segments(self):
+        message = b'0123456789ABCDEF'*100
+        self._connect()
+        d = self.protocol.publish(topic="foo/bar/baz1", qos=1, message=message)
+        request = self.protocol.factory.windowPublish[self.addr][d.msgId]
+        header, body = request.frames[False]
+        self.assertIs(body, message)
+        self.assertEqual(self.transport.value(), header + message)
+        self.transport.clear()
+        self.clock.advance(7)
+        self.assertEqual(request.dup, True)
+        header, body = request.frames[True]
+        self.assertIs(body, message)
+        self.assertEqual(header[0] & 0x08, 0x08)
+        self.assertEqual(self.transport.value(), header + message)
+
     def test_publish_very_large_qos1(self):
         message = '0123456789ABCDEF'*1000000 # Large PDU
         self._connect()
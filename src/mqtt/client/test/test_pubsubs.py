@@ -28,7 +28,7 @@ from twisted.internet import task, defer, error
 
 from mqtt                   import v31
 from mqtt.error             import MQTTWindowError
-from mqtt.pdu               import CONNACK, PUBACK, PUBREC, PUBREL, PUBCOMP
+from mqtt.pdu               import CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP, PINGREQ, DISCONNECT
 from mqtt.client.base       import MQTTBaseProtocol
 from mqtt.client.factory    import MQTTFactory
 from mqtt.client.subscriber import MQTTProtocol as MQTTSubscriberProtocol
@@ -50,6 +50,7 @@ class TestMQTTPublisherDisconnect(unittest.TestCase):
         self.transport = proto_helpers.StringTransportWithDisconnection()
         self.clock     = task.Clock()
         MQTTBaseProtocol.callLater = self.clock.callLater
+        MQTTBaseProtocol.clock     = self.clock
         self.factory   = MQTTFactory(MQTTFactory.PUBLISHER | MQTTFactory.SUBSCRIBER)
         self._rebuild()
         self.disconnected = 0
@@ -78,6 +79,7 @@ class TestMQTTPublisherDisconnect(unittest.TestCase):
         self.protocol  = self.factory.buildProtocol(0)
         self.transport.protocol = self.protocol
         MQTTBaseProtocol.callLater = self.clock.callLater
+        MQTTBaseProtocol.clock     = self.clock
         self.protocol.makeConnection(self.transport)
 
     def test_disconnect_1(self):
@@ -153,6 +155,7 @@ class TestMQTTSubscriberDisconnect(unittest.TestCase):
         self.transport = proto_helpers.StringTransportWithDisconnection()
         self.clock     = task.Clock()
         MQTTBaseProtocol.callLater = self.clock.callLater
+        MQTTBaseProtocol.clock     = self.clock
         self.factory   = MQTTFactory(MQTTFactory.PUBLISHER | MQTTFactory.SUBSCRIBER)
         self._rebuild()
         self.disconnected = 0
@@ -176,6 +179,7 @@ class TestMQTTSubscriberDisconnect(unittest.TestCase):
         self.protocol  = self.factory.buildProtocol(0)
         self.transport.protocol = self.protocol
         MQTTBaseProtocol.callLater = self.clock.callLater
+        MQTTBaseProtocol.clock     = self.clock
         self.protocol.makeConnection(self.transport)
 
     def _serverDown(self):
@@ -244,3 +248,203 @@ class TestMQTTSubscriberDisconnect(unittest.TestCase):
         self.assertNoResult(d)
 
 
+
+class TestMQTTPubSubsAcks(unittest.TestCase):
+    '''
+    Testing the order of acknowledges and application replies
+    '''
+
+    def setUp(self):
+        self.transport = proto_helpers.StringTransportWithDisconnection()
+        self.clock     = task.Clock()
+        MQTTBaseProtocol.callLater = self.clock.callLater
+        MQTTBaseProtocol.clock     = self.clock
+        self.factory   = MQTTFactory(MQTTFactory.PUBLISHER | MQTTFactory.SUBSCRIBER)
+        self.protocol  = self.factory.buildProtocol(0)
+        self.transport.protocol = self.protocol
+        self.protocol.makeConnection(self.transport)
+        ack = CONNACK()
+        ack.session = False
+        ack.resultCode = 0
+        self.protocol.connect("TwistedMQTT-pubsubs", keepalive=0, version=v31)
+        self.protocol.dataReceived(ack.encode())
+        self.transport.clear()
+
+    def test_reply_after_ack(self):
+        def onPublish(topic, payload, qos, dup, retain, msgId):
+            self.protocol.publish(topic="reply", qos=0, message=bytes([msgId]))
+        self.protocol.onPublish = onPublish
+        data = bytearray()
+        for msgId in (1, 2):
+            pub =PUBLISH()
+            pub.qos     = 1
+            pub.dup     = False
+            pub.retain  = False
+            pub.topic   = "request"
+            pub.msgId   = msgId
+            pub.payload = "Hello world"
+            data.extend(pub.encode())
+        self.protocol.dataReceived(bytes(data))
+        reply = b'\x30\x08\x00\x05reply'
+        self.assertEqual(self.transport.value(),
+            b'\x40\x02\x00\x01' + reply + b'\x01' + b'\x40\x02\x00\x02' + reply + b'\x02')
+
+    def _inbound(self, msgId, qos=1):
+        pub =PUBLISH()
+        pub.qos     = qos
+        pub.dup     = False
+        pub.retain  = False
+        pub.topic   = "request"
+        pub.msgId   = msgId
+        pub.payload = "Hello world"
+        return pub.encode()
+
+    def test_producer(self):
+        self.assertIs(self.transport.producer, self.protocol)
+        self.assertTrue(self.transport.streaming)
+        self.transport.loseConnection()
+        self.assertIs(self.transport.producer, None)
+
+    def test_acks_bypass_publishes(self):
+        self.protocol.onPublish = lambda *args: None
+        self.protocol.setWindowSize(5)
+        self.protocol.pauseProducing()
+        dl = [self.protocol.publish(topic="foo", qos=1, message=b"x"*1000) for i in range(5)]
+        self.assertEqual(self.transport.value(), b'')
+        self.protocol.dataReceived(self._inbound(1))
+        self.protocol.ping()
+        self.assertEqual(self.transport.value(), b'\x40\x02\x00\x01' + PINGREQ().encode())
+        self.transport.clear()
+        self.protocol.resumeProducing()
+        data = self.transport.value()
+        self.assertEqual(len(data), 5*(3 + 5 + 2 + 1000))
+        self.assertEqual(data.count(b"x"*1000), 5)
+
+    def _held(self, n, size):
+        # Coalesced PUBLISH packets held back by a full transport
+        self.protocol.setWindowSize(n)
+        self.protocol.setCoalescing(1, n*size*2)
+        dl = [self.protocol.publish(topic="foo", qos=1, message=b"x"*size) for i in range(n)]
+        self.protocol.pauseProducing()
+        self.protocol.setCoalescing(None)
+        self.assertEqual(self.transport.value(), b'')
+        return dl
+
+    def test_paused_while_flushing(self):
+        self._held(20, 10000)
+        writeSequence = self.transport.writeSequence
+        def pausingWrite(seq):
+            writeSequence(seq)
+            self.protocol.pauseProducing()
+        self.transport.writeSequence = pausingWrite
+        # A first batch of COALESCE_BYTES at least
+        self.protocol.resumeProducing()
+        self.assertEqual(self.transport.value().count(b"x"*10000), 7)
+        self.protocol.resumeProducing()
+        self.assertEqual(self.transport.value().count(b"x"*10000), 14)
+        self.protocol.resumeProducing()
+        self.protocol.resumeProducing()
+        self.assertEqual(self.transport.value().count(b"x"*10000), 20)
+
+    def test_disconnect_paused(self):
+        dl = self._held(3, 100)
+        producers = []
+        loseConnection = self.transport.loseConnection
+        def recordingLose():
+            producers.append(self.transport.producer)
+            loseConnection()
+        self.transport.loseConnection = recordingLose
+        self.protocol.disconnect()
+        self.assertEqual(producers, [None])
+        data = self.transport.value()
+        self.assertEqual(data.count(b"x"*100), 3)
+        self.assertEqual(data[-2:], DISCONNECT().encode())
+        for d in dl:
+            self.failureResultOf(d, error.ConnectionDone)
+
+    def test_coalescing_acks_first(self):
+        self.protocol.onPublish = lambda *args: None
+        self.protocol.setCoalescing(1)
+        self.protocol.publish(topic="foo", qos=0, message=b"x"*100)
+        self.protocol.dataReceived(self._inbound(1))
+        self.assertEqual(self.transport.value(), b'')
+        self.clock.advance(1)
+        data = self.transport.value()
+        self.assertEqual(data[:4], b'\x40\x02\x00\x01')
+        self.assertEqual(data[4] >> 4, 0x03)
+
+    def test_paused_queues(self):
+        self.protocol.setWindowSize(5)
+        self.protocol.pauseProducing()
+        dl = [self.protocol.publish(topic="foo", qos=q, message=b"x"*100) for q in (0, 0, 1, 1)]
+        self.assertEqual(len(self.protocol.session.queuePublishTx), 4)
+        self.assertEqual(len(self.protocol.session.windowPublish), 0)
+        self.protocol.resumeProducing()
+        self.assertEqual(len(self.protocol.session.queuePublishTx), 0)
+        self.assertEqual(len(self.protocol.session.windowPublish), 2)
+        self.assertEqual(self.transport.value().count(b"x"*100), 4)
+
+    def test_when_writable(self):
+        self.assertTrue(self.protocol.whenWritable().called)
+        self.protocol.pauseProducing()
+        d = self.protocol.whenWritable()
+        self.assertFalse(d.called)
+        self.protocol.resumeProducing()
+        self.assertTrue(d.called)
+
+    def test_when_writable_paused_again(self):
+        self.protocol.setWindowSize(5)
+        self.protocol.pauseProducing()
+        self.protocol.publish(topic="foo", qos=0, message=b"x"*100)
+        d = self.protocol.whenWritable()
+        self.transport.writeSequence = lambda seq: self.protocol.pauseProducing()
+        self.protocol.resumeProducing()
+        self.assertFalse(d.called)
+
+    def test_when_writable_lost(self):
+        self.protocol.pauseProducing()
+        d = self.protocol.whenWritable()
+        self.transport.loseConnection()
+        self.failureResultOf(d)
+
+
+    def test_paused_queues_qos0(self):
+        # QoS 0 messages take no room in the publish window
+        self.protocol.pauseProducing()
+        dl = [self.protocol.publish(topic="foo", qos=0, message=b"x"*100) for i in range(10)]
+        d = self.protocol.whenWritable()
+        self.protocol.resumeProducing()
+        self.assertTrue(d.called)
+        self.assertEqual(len(self.protocol.session.queuePublishTx), 0)
+        self.assertEqual(self.transport.value().count(b"x"*100), 10)
+
+    def test_paused_while_refilling(self):
+        self.protocol.pauseProducing()
+        dl = [self.protocol.publish(topic="foo", qos=0, message=b"x"*10000) for i in range(20)]
+        writeSequence = self.transport.writeSequence
+        def pausingWrite(seq):
+            writeSequence(seq)
+            self.protocol.pauseProducing()
+        self.transport.writeSequence = pausingWrite
+        # The queue is drained in batches of COALESCE_BYTES at least
+        self.protocol.resumeProducing()
+        self.assertEqual(self.transport.value().count(b"x"*10000), 7)
+        self.assertEqual(len(self.protocol.session.queuePublishTx), 13)
+        for i in range(3):
+            self.protocol.resumeProducing()
+        self.assertEqual(self.transport.value().count(b"x"*10000), 20)
+
+    def test_paused_connecting(self):
+        # Publishing is allowed before CONNACK
+        transport = proto_helpers.StringTransportWithDisconnection()
+        protocol  = self.factory.buildProtocol(1)
+        transport.protocol = protocol
+        protocol.makeConnection(transport)
+        protocol.connect("TwistedMQTT-pubsubs", keepalive=0, version=v31)
+        transport.clear()
+        protocol.setWindowSize(3)
+        protocol.pauseProducing()
+        dl = [protocol.publish(topic="foo", qos=1, message=b"x"*100) for i in range(3)]
+        self.assertEqual(transport.value(), b'')
+        protocol.resumeProducing()
+        self.assertEqual(transport.value().count(b"x"*100), 3)
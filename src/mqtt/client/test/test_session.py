@@ -0,0 +1,62 @@
+# ----------------------------------------------------------------------
+# Copyright (C) 2015 by Rafael Gonzalez 
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+from twisted.trial import unittest
+
+from mqtt.error             import MQTTWindowError
+from mqtt.client.session    import PacketIdAllocator
+
+
+class PacketIdAllocatorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.ids = PacketIdAllocator()
+
+    def test_sequential(self):
+        self.assertEqual([self.ids.allocate() for i in range(3)], [1, 2, 3])
+        self.assertEqual(self.ids.inUse, 3)
+        self.assertIn(2, self.ids)
+        self.assertNotIn(4, self.ids)
+
+    def test_release(self):
+        msgId = self.ids.allocate()
+        self.ids.release(msgId)
+        self.assertEqual(self.ids.inUse, 0)
+        self.assertNotIn(msgId, self.ids)
+        # Releasing twice, None or an unknown id does nothing
+        self.ids.release(msgId)
+        self.ids.release(None)
+        self.ids.release(1000)
+        self.assertEqual(len(self.ids), 0)
+
+    def test_wrap_skips_in_use(self):
+        for i in range(PacketIdAllocator.MAX_ID):
+            self.ids.allocate()
+        self.assertRaises(MQTTWindowError, self.ids.allocate)
+        # Only released ids are handed out again, oldest first
+        self.ids.release(500)
+        self.ids.release(7)
+        self.assertEqual(self.ids.allocate(), 500)
+        self.assertEqual(self.ids.allocate(), 7)
+        self.assertRaises(MQTTWindowError, self.ids.allocate)
+        self.assertEqual(self.ids.inUse, PacketIdAllocator.MAX_ID)
@@ -50,6 +50,7 @@ class TestMQTTSubscriber1(unittest.TestCase):
         self.transport = proto_helpers.StringTransportWithDisconnection()
         self.clock     = task.Clock()
         MQTTBaseProtocol.callLater = self.clock.callLater
+        MQTTBaseProtocol.clock     = self.clock
         self.factory   = MQTTFactory(MQTTFactory.SUBSCRIBER)
         self.addr = IPv4Address('TCP','localhost',1880)
         self._rebuild()
@@ -77,6 +78,7 @@ class TestMQTTSubscriber1(unittest.TestCase):
         self.protocol  = self.factory.buildProtocol(self.addr)
         self.transport.protocol = self.protocol
         MQTTBaseProtocol.callLater = self.clock.callLater
+        MQTTBaseProtocol.clock     = self.clock
         self.protocol.makeConnection(self.transport)
 
 
@@ -160,6 +162,34 @@ class TestMQTTSubscriber1(unittest.TestCase):
             self.failureResultOf(d).trap(error.ConnectionDone)
         
 
+    def test_subscribe_large_window(self):
+        dl = self._subscribe(n=500, qos=1, topic="foo/bar/baz")
+        self.assertEqual(len(self.protocol.factory.windowSubscribe[self.addr]), 500)
+        # Retries of a full window are spread over a bounded delay
+        request = self.protocol.factory.windowSubscribe[self.addr][dl[-1].msgId]
+        delay = 2*MQTTBaseProtocol.TIMEOUT_INITIAL + 1 + self.protocol.RETRY_SPREAD_MAX
+        self.assertLessEqual(request.alarm.getTime() - self.clock.seconds(), delay)
+        self._serverDown()
+        for d in dl:
+            self.failureResultOf(d).trap(error.ConnectionDone)
+
+    def test_subscribe_retry_frames(self):
+        d = self.protocol.subscribe("foo/bar/baz1", 2 )
+        request = self.protocol.factory.windowSubscribe[self.addr][d.msgId]
+        self.assertEqual(self.transport.value(), request.frames[False])
+        self.transport.clear()
+        self.clock.advance(10)
+        self.assertEqual(self.transport.value(), request.frames[True])
+        self.assertEqual(request.frames[True][0] & 0x08, 0x08)
+        self.transport.clear()
+        self.clock.advance(18)
+        self.assertEqual(self.transport.value(), request.frames[True])
+        ack = SUBACK()
+        ack.msgId = d.msgId
+        ack.granted = [(2, False)]
+        self.protocol.dataReceived(ack.encode())
+        self.assertEqual([(2, False)], self.successResultOf(d))
+
     def test_unsubscribe_single(self):
         d = self.protocol.unsubscribe("foo/bar/baz1")
         self.transport.clear()
@@ -273,6 +303,73 @@ class TestMQTTSubscriber1(unittest.TestCase):
         self.assertEqual(self.dup,     pub.dup )
 
 
+    def test_publish_recv_acks(self):
+        self.protocol.onPublish = lambda *args: None
+        for qos in (1, 2, 1):
+            pub =PUBLISH()
+            pub.qos     = qos
+            pub.dup     = False
+            pub.retain  = False
+            pub.topic   = "foo/bar/baz"
+            pub.msgId   = 0x1234
+            pub.payload = "Hello world"
+            self.protocol.dataReceived(pub.encode())
+        rel = PUBREL()
+        rel.msgId = pub.msgId
+        self.protocol.dataReceived(rel.encode())
+        self.assertEqual(self.transport.value(), 
+            b'\x40\x02\x12\x34' + b'\x50\x02\x12\x34' + b'\x40\x02\x12\x34' + b'\x72\x02\x12\x34')
+
+    def _publishes(self, qosList, start=1):
+        data = bytearray()
+        for i, qos in enumerate(qosList):
+            pub =PUBLISH()
+            pub.qos     = qos
+            pub.dup     = False
+            pub.retain  = False
+            pub.topic   = "foo/bar/baz"
+            pub.msgId   = start + i
+            pub.payload = "Hello world"
+            data.extend(pub.encode())
+        return bytes(data)
+
+    def test_publish_recv_acks_batch(self):
+        self.protocol.onPublish = lambda *args: None
+        writes = []
+        writeSequence = self.transport.writeSequence
+        def countWrites(seq):
+            writes.append(len(seq))
+            writeSequence(seq)
+        self.transport.writeSequence = countWrites
+        self.transport.write = lambda data: writes.append(1)
+        self.protocol.dataReceived(self._publishes([1]*500))
+        self.assertEqual(writes, [500])
+        self.assertEqual(self.transport.value(),
+            b''.join(b'\x40\x02' + bytes([i >> 8, i & 0xFF]) for i in range(1, 501)))
+
+    def test_publish_recv_acks_delivery(self):
+        self.delivered = []
+        def onPublish(topic, payload, qos, dup, retain, msgId):
+            # acknowledges in the wire when delivered
+            self.delivered.append((msgId, self.transport.value()))
+        self.protocol.onPublish = onPublish
+        self.protocol.dataReceived(self._publishes([1, 2, 1, 0, 2]))
+        # QoS 2 messages are delivered later, on PUBREL
+        self.assertEqual([msgId for msgId, sent in self.delivered], [1, 3, None])
+        self.assertEqual(self.transport.value(), 
+            b'\x40\x02\x00\x01' + b'\x50\x02\x00\x02' + b'\x40\x02\x00\x03' + b'\x50\x02\x00\x05')
+        self.transport.clear()
+        self.delivered = []
+        rel = PUBREL()
+        rel.msgId = 5
+        data = rel.encode()
+        rel.msgId = 2
+        self.protocol.dataReceived(data + rel.encode())
+        # PUBCOMP only goes out after the message has been delivered
+        self.assertEqual(self.delivered, [(5, b''), (2, b'')])
+        self.assertEqual(self.transport.value(), b'\x72\x02\x00\x05' + b'\x72\x02\x00\x02')
+
+
 class TestMQTTSubscriberDisconnect(unittest.TestCase):
     '''
     Testing various cases of disconnect callback
@@ -285,6 +382,7 @@ class TestMQTTSubscriberDisconnect(unittest.TestCase):
         self.transport = proto_helpers.StringTransportWithDisconnection()
         self.clock     = task.Clock()
         MQTTBaseProtocol.callLater = self.clock.callLater
+        MQTTBaseProtocol.clock     = self.clock
         self.factory   = MQTTFactory(MQTTFactory.SUBSCRIBER)
         self._rebuild()
         self.disconnected = False
@@ -308,6 +406,7 @@ class TestMQTTSubscriberDisconnect(unittest.TestCase):
         self.protocol  = self.factory.buildProtocol(0)
         self.transport.protocol = self.protocol
         MQTTBaseProtocol.callLater = self.clock.callLater
+        MQTTBaseProtocol.clock     = self.clock
         self.protocol.makeConnection(self.transport)
 
     def _serverDown(self):
@@ -384,6 +483,7 @@ class TestMQTTSubscriber2(unittest.TestCase):
         self.transport = proto_helpers.StringTransportWithDisconnection()
         self.clock     = task.Clock()
         MQTTBaseProtocol.callLater = self.clock.callLater
+        MQTTBaseProtocol.clock     = self.clock
         self.factory   = MQTTFactory(MQTTFactory.SUBSCRIBER)
         self._rebuild()
        
@@ -409,6 +509,7 @@ class TestMQTTSubscriber2(unittest.TestCase):
         self.protocol  = self.factory.buildProtocol(0)
         self.transport.protocol = self.protocol
         MQTTBaseProtocol.callLater = self.clock.callLater
+        MQTTBaseProtocol.clock     = self.clock
         self.protocol.makeConnection(self.transport)
 
 
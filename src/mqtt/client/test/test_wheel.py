@@ -0,0 +1,138 @@
+# ----------------------------------------------------------------------
+# Copyright (C) 2015 by Rafael Gonzalez 
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+
+from twisted.trial    import unittest
+from twisted.internet import task
+
+from mqtt.client.wheel import TimingWheel
+
+
+class TimingWheelTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.wheel = TimingWheel(self.clock, resolution=0.25, size=8)
+        self.fired = []
+
+    def fire(self, tag):
+        self.fired.append((tag, self.clock.seconds()))
+
+    def test_fires_never_early(self):
+        call = self.wheel.callLater(1.1, self.fire, 'a')
+        self.assertEqual(call.getTime(), 1.1)
+        self.clock.advance(1.0)
+        self.assertEqual(self.fired, [])
+        self.assertTrue(call.active())
+        self.clock.advance(0.25)
+        self.assertEqual(self.fired, [('a', 1.25)])
+        self.assertFalse(call.active())
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_exact_tick(self):
+        self.wheel.callLater(0.5, self.fire, 'a')
+        self.clock.advance(0.5)
+        self.assertEqual(self.fired, [('a', 0.5)])
+
+    def test_cancel(self):
+        call = self.wheel.callLater(1, self.fire, 'a')
+        self.wheel.callLater(1, self.fire, 'b')
+        call.cancel()
+        call.cancel()   # no-op
+        self.assertEqual(len(self.wheel), 1)
+        self.clock.advance(2)
+        self.assertEqual(self.fired, [('b', 2)])
+
+    def test_idle(self):
+        call = self.wheel.callLater(1, self.fire, 'a')
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        call.cancel()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.wheel.callLater(1, self.fire, 'b')
+        self.clock.advance(1)
+        self.assertEqual(self.fired, [('b', 1)])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_order(self):
+        # 0.8 and 0.9 fall in the same tick and keep their scheduling order
+        self.wheel.callLater(1.2, self.fire, 'd')
+        self.wheel.callLater(0.9, self.fire, 'b')
+        self.wheel.callLater(0.8, self.fire, 'c')
+        self.wheel.callLater(0.3, self.fire, 'a')
+        self.clock.advance(5)
+        self.assertEqual([tag for tag, t in self.fired], ['a', 'b', 'c', 'd'])
+
+    def test_several_revolutions(self):
+        # The wheel spans 8 slots of 0.25 s, that is, 2 seconds
+        self.wheel.callLater(0.5, self.fire, 'a')
+        self.wheel.callLater(4.5, self.fire, 'b')
+        self.clock.pump([0.25] * 17)
+        self.assertEqual(self.fired, [('a', 0.5)])
+        self.clock.advance(0.25)
+        self.assertEqual(self.fired, [('a', 0.5), ('b', 4.5)])
+
+    def test_late_reactor(self):
+        self.wheel.callLater(0.5, self.fire, 'a')
+        self.wheel.callLater(7, self.fire, 'b')
+        self.wheel.callLater(30, self.fire, 'c')
+        self.clock.advance(10)
+        self.assertEqual(self.fired, [('a', 10), ('b', 10)])
+        self.clock.advance(20)
+        self.assertEqual(self.fired[2:], [('c', 30)])
+
+    def test_reschedule_from_callback(self):
+        def retry(n):
+            self.fire(n)
+            if n < 3:
+                self.wheel.callLater(1, retry, n + 1)
+        self.wheel.callLater(1, retry, 1)
+        self.clock.pump([0.25] * 12)
+        self.assertEqual(self.fired, [(1, 1), (2, 2), (3, 3)])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_cancel_from_callback(self):
+        other = self.wheel.callLater(1, self.fire, 'b')
+        self.wheel.callLater(1, lambda: other.cancel())
+        self.wheel.callLater(1, self.fire, 'c')
+        self.clock.advance(1)
+        # 'b' was scheduled first, so it runs before being cancelled
+        self.assertEqual([tag for tag, t in self.fired], ['b', 'c'])
+        other = self.wheel.callLater(1, self.fire, 'e')
+        self.wheel.callLater(0.5, lambda: other.cancel())
+        self.clock.advance(1)
+        self.assertEqual([tag for tag, t in self.fired], ['b', 'c'])
+
+    def test_failing_call(self):
+        def fail():
+            raise ValueError("boom")
+        self.wheel.callLater(1, self.fire, 'a')
+        self.wheel.callLater(1, fail)
+        self.wheel.callLater(1, self.fire, 'b')
+        self.wheel.callLater(2, self.fire, 'c')
+        self.clock.advance(1)
+        # The other calls due in the slot still run, and so do later ones
+        self.assertEqual(self.fired, [('a', 1), ('b', 1)])
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.clock.advance(1)
+        self.assertEqual(self.fired[2:], [('c', 2)])
+        self.assertEqual(len(self.wheel), 0)
@@ -0,0 +1,174 @@
+# -*- test-case-name: mqtt.client.test.test_wheel -*-
+# ----------------------------------------------------------------------
+# Copyright (C) 2015 by Rafael Gonzalez 
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+# ----------------
+# Standard modules
+# ----------------
+
+import math
+
+# ---------------
+# Twisted modules
+# ---------------
+
+from twisted.logger import Logger
+
+log = Logger(namespace='mqtt')
+
+
+class WheelCall(object):
+    '''
+    Handle of a call scheduled in a C{TimingWheel}. It mimics the subset
+    of C{IDelayedCall} used by the protocol: C{getTime()}, C{active()}
+    and C{cancel()}.
+    '''
+
+    __slots__ = ('wheel', 'slot', 'tick', 'time', 'func', 'args')
+
+    def __init__(self, wheel, tick, time, func, args):
+        self.wheel = wheel
+        self.slot  = None   # wheel slot holding this call, None when no longer pending
+        self.tick  = tick   # absolute wheel tick when the call is due
+        self.time  = time
+        self.func  = func
+        self.args  = args
+
+
+    def getTime(self):
+        '''Returns the time at which this call was scheduled to run'''
+        return self.time
+
+
+    def active(self):
+        '''Returns True if this call is still pending'''
+        return self.slot is not None
+
+
+    def cancel(self):
+        '''Cancels this call. Cancelling a call no longer pending does nothing.'''
+        if self.slot is not None:
+            self.wheel._remove(self)
+
+
+class TimingWheel(object):
+    '''
+    Hashed timing wheel holding many timeouts on top of a single
+    reactor timer. Scheduling and cancelling a call are O(1).
+
+    Time is divided in ticks of C{resolution} seconds, and a call is
+    stored in the slot of the tick when it is due, modulo the number of
+    slots. The reactor timer runs once per tick, only while calls are
+    pending, and fires the due calls of the slots it visits. Calls due
+    beyond a full revolution simply stay in their slot until their tick.
+
+    Calls never run early, but may run up to C{resolution} seconds late.
+    Calls due in the same tick run in scheduling order.
+
+    @ivar clock: an C{IReactorTime} provider (the reactor or a C{task.Clock}).
+    @ivar resolution: tick duration, in seconds.
+    @ivar size: number of slots in the wheel.
+    '''
+
+    def __init__(self, clock, resolution=0.25, size=512):
+        self.clock      = clock
+        self.resolution = resolution
+        self.size       = size
+        self._slots     = [dict() for i in range(size)]   # insertion ordered sets of calls
+        self._tick      = 0     # last tick processed
+        self._due       = 0     # tick when the reactor timer is due
+        self._call      = None  # reactor timer driving the wheel
+        self._len       = 0
+
+
+    def __len__(self):
+        return self._len
+
+
+    def callLater(self, delay, func, *args):
+        '''
+        Schedules C{func(*args)} to run in C{delay} seconds.
+        @return: a C{WheelCall} handle.
+        '''
+        now  = self.clock.seconds()
+        when = now + delay
+        if not self._len and self._call is None:     # the wheel was idle
+            self._tick = max(self._tick, int(now // self.resolution))
+        tick = max(int(math.ceil(when / self.resolution)), self._tick + 1)
+        call = WheelCall(self, tick, when, func, args)
+        call.slot = self._slots[tick % self.size]
+        call.slot[call] = None
+        self._len += 1
+        if self._call is None:
+            self._start(now)
+        return call
+
+
+    def _start(self, now):
+        '''Schedules the reactor timer at the next tick'''
+        self._due  = self._tick + 1
+        self._call = self.clock.callLater(max(0, self._due * self.resolution - now), self._advance)
+
+
+    def _remove(self, call):
+        del call.slot[call]
+        call.slot = None
+        self._len -= 1
+        if not self._len and self._call is not None:
+            self._call.cancel()
+            self._call = None
+
+
+    def _advance(self):
+        '''
+        Fires the calls due in the ticks elapsed since the last run.
+        A failing call is logged and does not prevent the others from running.
+        '''
+        self._call = None
+        now    = self.clock.seconds()
+        target = max(int(now // self.resolution), self._due)
+        tick   = self._tick
+        ticks  = min(target - tick, self.size)  # one revolution visits every slot
+        self._tick = target     # calls scheduled from now on go to later ticks
+        try:
+            for i in range(ticks):
+                tick += 1
+                slot  = self._slots[tick % self.size]
+                if not slot:
+                    continue
+                due = [call for call in slot if call.tick <= target]
+                for call in due:
+                    if call.slot is slot:   # not cancelled by a previous callback
+                        del slot[call]
+                        call.slot = None
+                        self._len -= 1
+                        try:
+                            call.func(*call.args)
+                        except Exception:
+                            log.failure("Timing wheel call {func!r} failed", func=call.func)
+        finally:
+            if self._len and self._call is None:
+                self._start(now)
+
+
+__all__ = ['TimingWheel', 'WheelCall']
@@ -100,6 +100,24 @@ class WindowValueError(ValueError):
         s = '{0}.'.format(s)
         return s
 
+class FrameSizeValueError(ValueError):
+    '''Max. size of received packets out of range'''
+    def __str__(self):
+        s = self.__doc__
+        if self.args:
+            s = "{0}: {1}".format(s, self.args[0])
+        s = '{0}.'.format(s)
+        return s
+
+class CoalescingValueError(ValueError):
+    '''Output coalescing thresholds out of range'''
+    def __str__(self):
+        s = self.__doc__
+        if self.args:
+            s = "{0}: {1}".format(s, self.args[0])
+        s = '{0}.'.format(s)
+        return s
+
 
 class ProfileValueError(ValueError):
     '''MQTT client profile value not supported'''
@@ -119,6 +137,15 @@ class PayloadValueError(ValueError):
         s = '{0}.'.format(s)
         return s
 
+class MsgIdValueError(ValueError):
+    '''Message id not within [0..65535] range'''
+    def __str__(self):
+        s = self.__doc__
+        if self.args:
+            s = "{0}: {1}".format(s, self.args[0])
+        s = '{0}.'.format(s)
+        return s
+
 class StringValueError(ValueError):
     '''MQTT strings exceeds 65535 bytes'''
     def __str__(self):
@@ -27,6 +27,8 @@
 # Standard modules
 # ----------------
 
+import struct
+from collections import OrderedDict
 
 # ----------------
 # Twisted  modules
@@ -38,8 +40,9 @@ from twisted.logger import Logger
 # Own modules
 # -----------
 
-from .     import PY2, v31, v311
-from .error import StringValueError, PayloadValueError, PayloadTypeError
+from .     import v31, v311
+from .error import StringValueError, PayloadValueError, PayloadTypeError, MsgIdValueError
+from .error import KeepaliveValueError
 
 
 log = Logger(namespace='mqtt')
@@ -64,11 +67,12 @@ def encodeString(string):
 
 def decodeString(encoded):
     '''
-    Decodes an UTF-8 string from an encoded MQTT bytearray.
-    Returns the decoded string and renaining bytearray to be parsed
+    Decodes an UTF-8 string from an encoded MQTT bytearray or memoryview.
+    Returns the decoded string and renaining bytes to be parsed,
+    which is a zero-copy view if C{encoded} is a memoryview.
     '''
     length = encoded[0]*256 + encoded[1]
-    return (encoded[2:2+length].decode('utf-8'), encoded[2+length:])
+    return (str(encoded[2:2+length], 'utf-8'), encoded[2+length:])
 
 
 def encode16Int(value):
@@ -89,11 +93,19 @@ def decode16Int(encoded):
     return encoded[0]*256 + encoded[1]
 
 
+# Encoded remaining length fields of one byte
+_LENGTH1 = [bytes((value,)) for value in range(0x80)]
+
 def encodeLength(value):
     '''
     Encodes value into a multibyte sequence defined by MQTT protocol.
-    Used to encode packet length fields.
+    Used to encode packet length fields. 
+    One and two byte lengths take a fast path.
     '''
+    if value < 0x80:
+        return _LENGTH1[value]
+    if value < 0x4000:
+        return bytes(((value & 0x7F) | 0x80, value >> 7))
     encoded = bytearray()
     while True:
         digit = value % 128
@@ -106,11 +118,57 @@ def encodeLength(value):
     return encoded
 
 
+def encodePayload(payload):
+    '''
+    Encodes an application message into an immutable bytes object.
+    Bytes are used as is and strings are UTF-8 encoded. Any other object 
+    supporting the buffer protocol (bytearray, memoryview, mmap, array, 
+    NumPy arrays ...) is copied once, as transports only accept bytes.
+    @raise e: C{TypeError} if payload does not support the buffer protocol.
+    '''
+    if isinstance(payload, bytes):
+        return payload
+    if isinstance(payload, str):
+        return payload.encode('utf-8')
+    try:
+        return memoryview(payload).tobytes()
+    except TypeError:
+        raise PayloadTypeError(type(payload))
+
+
+def lengthSize(value):
+    '''
+    Returns the number of bytes needed to encode value 
+    as a remaining length field.
+    '''
+    if value < 0x80:
+        return 1
+    if value < 0x4000:
+        return 2
+    if value < 0x200000:
+        return 3
+    return 4
+
+
+def headerSize(packet):
+    '''
+    Returns the size of the fixed header of an encoded packet, that is, 
+    the offset of its variable header. Decoders take this offset as an 
+    optional argument, as the protocol framer already knows it.
+    '''
+    offset = 1
+    while packet[offset] & 0x80:
+        offset += 1
+    return offset + 1
+
+
 def decodeLength(encoded):
     '''
     Decodes a variable length value defined in the MQTT protocol.
     This value typically represents remaining field lengths
     '''
+    if encoded[0] < 0x80:
+        return encoded[0]
     value      = 0
     multiplier = 1
     for i in encoded:
@@ -121,12 +179,202 @@ def decodeLength(encoded):
     return value
 
 
+# ------------------------------------------------------
+# Single buffer encoding helpers. Encoders compute the 
+# packet size first and fill one preallocated buffer
+# ------------------------------------------------------
+
+_UINT16 = struct.Struct('!H')
+_ACK    = struct.Struct('!BBH')     # fixed header + msgId
+_FLAGS  = struct.Struct('!BBH')     # CONNECT level, flags & keepalive
+
+_DISCONNECT = b'\xE0\x00'
+_PINGREQ    = b'\xC0\x00'
+_PINGRES    = b'\xD0\x00'
+
+
+def _utf8(string):
+    '''
+    Encodes a string for MQTT, without the length prefix.
+    @raise e: C{StringValueError} if encoded string exceeds 65535 bytes.
+    '''
+    encoded = string.encode('utf-8')
+    if len(encoded) > 65535:
+        raise StringValueError(len(encoded))
+    return encoded
+
+
+def encodeAck(code, msgId):
+    '''
+    Returns an encoded 4 byte acknowledge packet given its fixed header 
+    code (i.e. 0x40 for PUBACK) and msgId, without building its PDU.
+    @raise e: C{MsgIdValueError} if msgId is not within [0..65535].
+    '''
+    try:
+        return _ACK.pack(code, 0x02, msgId)
+    except struct.error:
+        raise MsgIdValueError(msgId)
+
+
+def stampMsgId(frames, msgId):
+    '''
+    Returns the C{frames} of a QoS 1 or 2 PUBLISH packet encoded by 
+    C{PUBLISH.encodeSegments()} with the msgId ending both headers 
+    replaced, so that a packet can be encoded before its msgId is known.
+    Payloads are shared, not copied.
+    @raise e: C{MsgIdValueError} if msgId is not within [0..65535].
+    '''
+    try:
+        packed = _UINT16.pack(msgId)
+    except struct.error:
+        raise MsgIdValueError(msgId)
+    (header, payload), (dupHeader, dupPayload) = frames
+    return ((header[:-2] + packed, payload), (dupHeader[:-2] + packed, dupPayload))
+
+
+def _packHeader(buf, code, remaining):
+    '''
+    Writes the fixed header into buf. 
+    Returns the offset of the variable header.
+    '''
+    buf[0] = code
+    if remaining < 0x80:
+        buf[1] = remaining
+        return 2
+    if remaining < 0x4000:
+        buf[1] = (remaining & 0x7F) | 0x80
+        buf[2] = remaining >> 7
+        return 3
+    offset = 1
+    while remaining > 0x7F:
+        buf[offset] = (remaining & 0x7F) | 0x80
+        remaining >>= 7
+        offset += 1
+    buf[offset] = remaining
+    return offset + 1
+
+
+def _packMsgId(buf, offset, msgId):
+    '''
+    Writes a msgId into buf at offset. Returns the next offset.
+    '''
+    try:
+        _UINT16.pack_into(buf, offset, msgId)
+    except struct.error:
+        raise MsgIdValueError(msgId)
+    return offset + 2
+
+
+def _packString(buf, offset, encoded):
+    '''
+    Writes an already encoded string, prefixed by its length,
+    into buf at offset. Returns the next offset.
+    '''
+    length = len(encoded)
+    _UINT16.pack_into(buf, offset, length)
+    offset += 2
+    buf[offset:offset+length] = encoded
+    return offset + length
+
+# ------------------------------------------------------
+# Topic name caches. Clients usually send and receive 
+# messages over a limited set of topics
+# ------------------------------------------------------
+
+class TopicCache(object):
+    '''
+    Bounded LRU cache of topic names, converting keys into values 
+    with a given function upon misses. A size of 0 disables caching.
+
+    @ivar size:   maximum number of cached topics.
+    @ivar hits:   number of lookups found in the cache.
+    @ivar misses: number of lookups that had to convert the key.
+    '''
+
+    def __init__(self, convert, size=1024):
+        self._convert = convert
+        self._entries = OrderedDict()
+        self.size     = size
+        self.hits     = 0
+        self.misses   = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        '''
+        Returns the cached value for key, converting and caching it 
+        if not found. The least recently used topic is evicted when full.
+        '''
+        entries = self._entries
+        try:
+            value = entries[key]
+        except KeyError:
+            self.misses += 1
+            value = self._convert(key)
+            if self.size:
+                entries[key] = value
+                if len(entries) > self.size:
+                    entries.popitem(last=False)
+        else:
+            self.hits += 1
+            entries.move_to_end(key)
+        return value
+
+    def resize(self, size):
+        '''
+        Sets the maximum number of cached topics, evicting the least 
+        recently used ones if needed.
+        @raise e: C{ValueError} if size is negative.
+        '''
+        if size < 0:
+            raise ValueError("Cache size should not be negative")
+        self.size = size
+        while len(self._entries) > size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        '''
+        Empties the cache and resets its counters.
+        '''
+        self._entries.clear()
+        self.hits   = 0
+        self.misses = 0
+
+
+def encodeTopic(topic):
+    '''
+    Encodes a topic name into MQTT format (length prefixed UTF-8 string), 
+    to be reused by several PUBLISH packets through their C{encodedTopic}
+    attribute. Returns an immutable bytes object.
+    @raise e: C{ValueError} if encoded topic string exceeds 65535 bytes.
+    '''
+    encoded = _utf8(topic)
+    return _UINT16.pack(len(encoded)) + encoded
+
+
+def decodeTopic(encoded):
+    '''
+    Decodes a topic name given its UTF-8 bytes, without length prefix.
+    '''
+    return str(encoded, 'utf-8')
+
+
+# Topic names sent in PUBLISH packets, by string
+encodeTopicCache = TopicCache(encodeTopic)
+
+# Topic names received in PUBLISH packets, by UTF-8 bytes. 
+# Repeated topics share the same string object.
+decodeTopicCache = TopicCache(decodeTopic)
+
 # -------------------------------
 # MQTT Protocol Data Units (PDUs)
 # -------------------------------
 
 class DISCONNECT(object):
 
+    __slots__ = ('encoded',)
+
     def __init__(self):
         self.encoded = None 
 
@@ -134,12 +382,10 @@ class DISCONNECT(object):
         '''
         Encode and store a DISCONNECT control packet.
         '''
-        header    = bytearray(2)
-        header[0] = 0xE0
-        self.encoded = header
-        return str(header) if PY2 else bytes(header)
+        self.encoded = _DISCONNECT
+        return self.encoded
 
-    def decode(self, packet):
+    def decode(self, packet, offset=None):
         '''
         Decode a DISCONNECT control packet. 
         '''
@@ -150,6 +396,8 @@ class DISCONNECT(object):
 
 class PINGREQ(object):
 
+    __slots__ = ('encoded',)
+
     def __init__(self):
         self.encoded = None 
 
@@ -157,12 +405,10 @@ class PINGREQ(object):
         '''
         Encode and store a PINGREQ control message.
         '''
-        header    = bytearray(2)
-        header[0] = 0xC0
-        self.encoded = header
-        return str(header) if PY2 else bytes(header)
+        self.encoded = _PINGREQ
+        return self.encoded
 
-    def decode(self, packet):
+    def decode(self, packet, offset=None):
         '''
         Decode a PINGREQ control packet. 
         '''
@@ -173,6 +419,8 @@ class PINGREQ(object):
 # Server class Only
 class PINGRES(object):
 
+    __slots__ = ('encoded',)
+
     def __init__(self):
         self.encoded = None 
 
@@ -180,12 +428,10 @@ class PINGRES(object):
         '''
         Encode and store a PINGRES control message.
         '''
-        header    = bytearray(2)
-        header[0] = 0xD0
-        self.encoded = header
-        return str(header) if PY2 else bytes(header)
+        self.encoded = _PINGRES
+        return self.encoded
 
-    def decode(self, packet):
+    def decode(self, packet, offset=None):
         '''
         Decode a CONNACK control packet. 
         '''
@@ -195,6 +441,9 @@ class PINGRES(object):
 
 class CONNECT(object):
 
+    __slots__ = ('encoded', 'clientId', 'keepalive', 'willTopic', 'willMessage', 'willQoS',
+                 'willRetain', 'username', 'password', 'cleanStart', 'version')
+
     def __init__(self):
         self.encoded    = None 
         self.clientId    = None
@@ -214,50 +463,43 @@ class CONNECT(object):
         @raise e: C{ValueError} if any encoded topic string exceeds 65535 bytes.
         @raise e: C{ValueError} if encoded username string exceeds 65535 bytes.
         '''
-        header    = bytearray(1)
-        varHeader = bytearray()
-        payload   = bytearray()
-        header[0] = 0x10            # packet code
-        # ---- Variable header encoding section -----
-        
-        varHeader.extend(encodeString(self.version['tag'])) 
-        varHeader.append(self.version['level']) # protocol Level
-        flags =  (self.cleanStart << 1)
+        tag     = _utf8(self.version['tag'])
+        strings = [_utf8(self.clientId)]
+        flags   = (self.cleanStart << 1)
         if  self.willTopic is not None and self.willMessage is not None:
             flags |= 0x04 | (self.willRetain << 5) | (self.willQoS << 3)
+            strings.append(_utf8(self.willTopic))
+            strings.append(_utf8(self.willMessage))
         if self.username is not None:
             flags |= 0x80
+            strings.append(_utf8(self.username))
         if self.password is not None:
             flags |= 0x40
-        varHeader.append(flags)
-        varHeader.extend(encode16Int(self.keepalive))
-        # ------ Payload encoding section ----
-        payload.extend(encodeString(self.clientId))
-        if self.willTopic is not None and self.willMessage is not None:
-            payload.extend(encodeString(self.willTopic))
-            payload.extend(encodeString(self.willMessage))
-        if self.username is not None:
-             payload.extend(encodeString(self.username))
-        if self.password is not None:
-            payload.extend(encode16Int(len(self.password)))
-            payload.extend(bytearray(self.password, encoding='ascii', errors='ignore'))
+            strings.append(self.password.encode('ascii', 'ignore'))
         # ---- Build the packet once all lengths are known ----
-        header.extend(encodeLength(len(varHeader) + len(payload)))
-        header.extend(varHeader)
-        header.extend(payload)
-        self.encoded = header
-        return str(header) if PY2 else bytes(header)
-
-    def decode(self, packet):
+        remaining = 2 + len(tag) + _FLAGS.size + 2*len(strings) + sum(map(len, strings))
+        buf    = bytearray(1 + lengthSize(remaining) + remaining)
+        offset = _packHeader(buf, 0x10, remaining)
+        offset = _packString(buf, offset, tag)
+        try:
+            _FLAGS.pack_into(buf, offset, self.version['level'], flags, self.keepalive)
+        except struct.error:
+            raise KeepaliveValueError(self.keepalive)
+        offset += _FLAGS.size
+        for encoded in strings:
+            offset = _packString(buf, offset, encoded)
+        self.encoded = bytes(buf)
+        return self.encoded
+
+    def decode(self, packet, offset=None):
         '''
         Decode a CONNECT control packet. 
         '''
         self.encoded = packet
         # Strip the fixed header plus variable length field
-        lenLen = 1
-        while packet[lenLen] & 0x80:
-            lenLen += 1
-        packet_remaining = packet[lenLen+1:]
+        if offset is None:
+            offset = headerSize(packet)
+        packet_remaining = memoryview(packet)[offset:]
         # Variable Header
         version_str, packet_remaining = decodeString(packet_remaining)
         version_id = int(packet_remaining[0])
@@ -286,7 +528,7 @@ class CONNECT(object):
             self.username, packet_remaining = decodeString(packet_remaining)
         if passFlag:
             l = decode16Int(packet_remaining)
-            self.password = packet_remaining[2:2+l]
+            self.password = bytes(packet_remaining[2:2+l])
 
 
 
@@ -294,6 +536,8 @@ class CONNECT(object):
 
 class CONNACK(object):
 
+    __slots__ = ('encoded', 'session', 'resultCode')
+
     def __init__(self):
         self.encoded   = None
         self.session    = None
@@ -303,27 +547,18 @@ class CONNACK(object):
         '''
         Encode and store a CONNACK control packet. 
         '''
-     
-        header       = bytearray(1)
-        varHeader    = bytearray(2)
-        header[0]    = 0x20 
-        varHeader[0] = self.session
-        varHeader[1] = self.resultCode
-        header.extend(encodeLength(len(varHeader)))
-        header.extend(varHeader)
-        self.encoded = header
-        return str(header) if PY2 else bytes(header)
+        self.encoded = bytes((0x20, 0x02, self.session, self.resultCode))
+        return self.encoded
 
-    def decode(self, packet):
+    def decode(self, packet, offset=None):
         '''
         Decode a CONNACK control packet. 
         '''
         self.encoded = packet
         # Strip the fixed header plus variable length field
-        lenLen = 1
-        while packet[lenLen] & 0x80:
-            lenLen += 1
-        packet_remaining = packet[lenLen+1:]
+        if offset is None:
+            offset = headerSize(packet)
+        packet_remaining = memoryview(packet)[offset:]
         self.session = (packet_remaining[0] & 0x01) == 0x01 
         self.resultCode  = int(packet_remaining[1])
       
@@ -331,38 +566,43 @@ class CONNACK(object):
 
 class SUBSCRIBE(object):
 
+    __slots__ = ('encoded', 'frames', 'topics', 'qos', 'msgId')
+
     def __init__(self):
         self.encoded = None
+        self.frames  = None
         self.topics   = None
+        self.qos      = None    # QoS applied when topics is a single string
         self.msgId    = None 
 
     def encode(self):
         '''
         Encode and store a SUBSCRIBE control packet. 
+        C{frames} keeps the original and the DUP flagged packets.
         @raise e: C{ValueError} if any encoded topic string exceeds 65535 bytes.
         '''
-        header    = bytearray(1)
-        payload   = bytearray()
-        varHeader = encode16Int(self.msgId)
-        header[0] = 0x82        # packet with QoS=1
-        for topic in self.topics:
-            payload.extend(encodeString(topic[0])) # topic name
-            payload.append(topic[1])               # topic QoS
-        header.extend(encodeLength(len(varHeader) + len(payload)))
-        header.extend(varHeader)
-        header.extend(payload)
-        self.encoded = header
-        return str(header) if PY2 else bytes(header)
-
-    def decode(self, packet):
+        topics    = [(_utf8(topic), qos) for topic, qos in self.topics]
+        remaining = 2 + sum(3 + len(topic) for topic, qos in topics)
+        buf    = bytearray(1 + lengthSize(remaining) + remaining)
+        offset = _packHeader(buf, 0x82, remaining)      # packet with QoS=1
+        offset = _packMsgId(buf, offset, self.msgId)
+        for topic, qos in topics:
+            offset = _packString(buf, offset, topic)    # topic name
+            buf[offset] = qos                           # topic QoS
+            offset += 1
+        self.encoded = bytes(buf)
+        buf[0] |= 0x08
+        self.frames  = (self.encoded, bytes(buf))
+        return self.encoded
+
+    def decode(self, packet, offset=None):
         '''
         Decode a SUBSCRIBE control packet. 
         '''
         self.encoded = packet
-        lenLen = 1
-        while packet[lenLen] & 0x80:
-            lenLen += 1
-        packet_remaining = packet[lenLen+1:]
+        if offset is None:
+            offset = headerSize(packet)
+        packet_remaining = memoryview(packet)[offset:]
         self.msgId   = decode16Int(packet_remaining[0:2])
         self.topics = []
         packet_remaining = packet_remaining[2:]
@@ -379,6 +619,8 @@ class SUBSCRIBE(object):
 
 class SUBACK(object):
 
+    __slots__ = ('encoded', 'msgId', 'granted')
+
     def __init__(self):
         self.encoded = None
         self.msgId   = None
@@ -388,28 +630,25 @@ class SUBACK(object):
         '''
         Encode and store a SUBACK control packet.
         '''
-        header    = bytearray(1)
-        payload   = bytearray()
-        varHeader = encode16Int(self.msgId)
-        header[0] = 0x90
+        remaining = 2 + len(self.granted)
+        buf    = bytearray(1 + lengthSize(remaining) + remaining)
+        offset = _packHeader(buf, 0x90, remaining)
+        offset = _packMsgId(buf, offset, self.msgId)
         for code in self.granted:
-            payload.append(code[0] | (0x80 if code[1] == True else 0x00))
-        header.extend(encodeLength(len(varHeader) + len(payload)))
-        header.extend(varHeader)
-        header.extend(payload)
-        self.encoded = header
-        return str(header) if PY2 else bytes(header)
+            buf[offset] = code[0] | (0x80 if code[1] == True else 0x00)
+            offset += 1
+        self.encoded = bytes(buf)
+        return self.encoded
 
 
-    def decode(self, packet):
+    def decode(self, packet, offset=None):
         '''
         Decode a SUBACK control packet. 
         '''
         self.encoded = packet
-        lenLen = 1
-        while packet[lenLen] & 0x80:
-            lenLen += 1
-        packet_remaining = packet[lenLen+1:]
+        if offset is None:
+            offset = headerSize(packet)
+        packet_remaining = memoryview(packet)[offset:]
         self.msgId   = decode16Int(packet_remaining)
         # Make a sequence of tuples of (GrantedQoS, Failure Flag)
         self.granted = [ (byte & 0x7F, byte & 0x80 == 0x80) 
@@ -422,43 +661,46 @@ class SUBACK(object):
 
 class UNSUBSCRIBE(object):
 
+    __slots__ = ('encoded', 'frames', 'msgId', 'topics')
+
     def __init__(self):
         self.encoded = None
+        self.frames  = None
         self.msgId   = None
         self.topics  = None
 
     def encode(self):
         '''
         Encode and store an UNSUBCRIBE control packet
+        C{frames} keeps the original and the DUP flagged packets.
         @raise e: C{ValueError} if any encoded topic string exceeds 65535 bytes
         '''
-        header    = bytearray(1)
-        payload   = bytearray()
-        varHeader = encode16Int(self.msgId)
-        header[0] = 0xA2    # packet with QoS=1
-        for topic in self.topics:
-            payload.extend(encodeString(topic)) # topic name
-        header.extend(encodeLength(len(varHeader) + len(payload)))
-        header.extend(varHeader)
-        header.extend(payload)
-        self.encoded = header
-        return str(header) if PY2 else bytes(header)
+        topics    = [_utf8(topic) for topic in self.topics]
+        remaining = 2 + sum(2 + len(topic) for topic in topics)
+        buf    = bytearray(1 + lengthSize(remaining) + remaining)
+        offset = _packHeader(buf, 0xA2, remaining)      # packet with QoS=1
+        offset = _packMsgId(buf, offset, self.msgId)
+        for topic in topics:
+            offset = _packString(buf, offset, topic)    # topic name
+        self.encoded = bytes(buf)
+        buf[0] |= 0x08
+        self.frames  = (self.encoded, bytes(buf))
+        return self.encoded
 
-    def decode(self, packet):
+    def decode(self, packet, offset=None):
         '''
         Decode a UNSUBACK control packet. 
         '''
         self.encoded = packet
-        lenLen = 1
-        while packet[lenLen] & 0x80:
-            lenLen += 1
-        packet_remaining = packet[lenLen+1:]
+        if offset is None:
+            offset = headerSize(packet)
+        packet_remaining = memoryview(packet)[offset:]
         self.msgId   = decode16Int(packet_remaining[0:2])
         self.topics = []
         packet_remaining = packet_remaining[2:]
         while len(packet_remaining):
             l = decode16Int(packet_remaining[0:2])
-            topic = packet_remaining[2:2+l].decode(encoding='utf-8')
+            topic = str(packet_remaining[2:2+l], 'utf-8')
             self.topics.append(topic)
             packet_remaining = packet_remaining[2+l:]
 
@@ -467,6 +709,8 @@ class UNSUBSCRIBE(object):
 # Server PDU
 class UNSUBACK(object):
 
+    __slots__ = ('encoded', 'msgId')
+
     def __init__(self):
         self.encoded = None
         self.msgId   = None
@@ -475,23 +719,17 @@ class UNSUBACK(object):
         '''
         Encode and store an UNSUBACK control packet
         '''
-        header    = bytearray(1)
-        varHeader = encode16Int(self.msgId)
-        header[0] = 0xB0 
-        header.extend(encodeLength(len(varHeader)))
-        header.extend(varHeader)
-        self.encoded = header
-        return str(header) if PY2 else bytes(header)
+        self.encoded = encodeAck(0xB0, self.msgId)
+        return self.encoded
 
-    def decode(self, packet):
+    def decode(self, packet, offset=None):
         '''
         Decode a UNSUBACK control packet. 
         '''
         self.encoded = packet
-        lenLen = 1
-        while packet[lenLen] & 0x80:
-            lenLen += 1
-        packet_remaining = packet[lenLen+1:]
+        if offset is None:
+            offset = headerSize(packet)
+        packet_remaining = memoryview(packet)[offset:]
         self.msgId   = decode16Int(packet_remaining)
 
 
@@ -499,74 +737,105 @@ class UNSUBACK(object):
 
 class PUBLISH(object):
 
+    __slots__ = ('encoded', 'header', 'body', 'frames', 'qos', 'dup',
+                 'retain', 'topic', 'encodedTopic', 'msgId', 'payload')
+
     def __init__(self):
         self.encoded = None
+        self.header  = None
+        self.body    = None
+        self.frames  = None
         self.qos     = None
         self.dup     = None
         self.retain  = None
         self.topic   = None
+        self.encodedTopic = None
         self.msgId   = None
         self.payload = None
 
     def encode(self):
         '''
         Encode and store a PUBLISH control packet.
+        The payload is copied once into the stored packet, which is 
+        an immutable bytes object.
         @raise e: C{ValueError} if encoded topic string exceeds 65535 bytes.
         @raise e: C{ValueError} if encoded packet size exceeds 268435455 bytes.
-        @raise e: C{TypeError} if C{data} is not a string, bytearray, int, boolean or float.
-        '''
-        header    = bytearray(1)
-        varHeader = bytearray()
-        payload   = bytearray()
-
+        @raise e: C{TypeError} if C{payload} is neither a string nor a bytes-like object.
+        '''
+        header, body = self.encodeSegments()
+        self.encoded = header + body
+        return self.encoded
+
+    def encodeSegments(self):
+        '''
+        Encode and store a PUBLISH control packet as two segments, 
+        suitable for C{transport.writeSequence()}: a small C{header} 
+        (fixed header, topic name and msgId) and a C{body} referencing
+        the payload, which is not copied if it is a bytes object.
+        C{frames} keeps the segments of the original and the DUP flagged 
+        packets, which share the same body.
+        The topic name is taken from C{encodedTopic} when given 
+        (see C{encodeTopic()}) or from C{encodeTopicCache}.
+        Returns the tuple C{(header, body)}.
+        @raise e: see C{encode()}
+        '''
+        topic = self.encodedTopic
+        if topic is None:
+            topic = encodeTopicCache.get(self.topic)
+        payload = encodePayload(self.payload)
         if self.qos:
-            header[0] = 0x30 | self.retain | (self.qos << 1) | (self.dup << 3)
-            varHeader.extend(encodeString(self.topic)) # topic name
-            varHeader.extend(encode16Int(self.msgId))  # msgId should not be None
-        else:
-            header[0] = 0x30 | self.retain
-            varHeader.extend(encodeString(self.topic)) # topic name
-        if isinstance(self.payload, bytearray):
-            payload.extend(self.payload)
-        elif isinstance(self.payload, str):
-            payload.extend(bytearray(self.payload, encoding='utf-8'))
+            code      = 0x30 | self.retain | (self.qos << 1) | (self.dup << 3)
+            varLen    = 2 + len(topic)
         else:
-            raise PayloadTypeError(type(self.payload))
-        totalLen = len(varHeader) + len(payload)
+            code      = 0x30 | self.retain
+            varLen    = len(topic)
+        totalLen = varLen + len(payload)
         if totalLen > 268435455:
             raise PayloadValueError(totalLen)
-        header.extend(encodeLength(totalLen))
-        header.extend(varHeader)
-        header.extend(payload)
-        self.encoded = header
-        return str(header) if PY2 else bytes(header)
+        buf    = bytearray(1 + lengthSize(totalLen) + varLen)
+        offset = _packHeader(buf, code, totalLen)
+        buf[offset:offset+len(topic)] = topic               # topic name
+        offset += len(topic)
+        if self.qos:
+            _packMsgId(buf, offset, self.msgId)             # msgId should not be None
+        self.header = bytes(buf)
+        self.body   = payload
+        buf[0] |= 0x08
+        self.frames = ((self.header, payload), (bytes(buf), payload))
+        return self.header, self.body
 
-    def decode(self, packet):
+    def decode(self, packet, offset=None):
         '''
         Decode a PUBLISH control packet. 
+        The packet is parsed through memoryviews, so that the payload 
+        is copied exactly once into an owned, immutable bytes object.
+        Topic names are shared through C{decodeTopicCache}.
         '''
         self.encoded = packet
-        lenLen = 1
-        while packet[lenLen] & 0x80:
-            lenLen += 1
-        packet_remaining = packet[lenLen+1:]
-        self.dup    = (packet[0] & 0x08) == 0x08
-        self.qos    = (packet[0] & 0x06) >> 1
-        self.retain = (packet[0] & 0x01) == 0x01
-        self.topic, _  = decodeString(packet_remaining)
-        topicLen       = decode16Int(packet_remaining)
+        if offset is None:
+            offset = headerSize(packet)
+        view   = memoryview(packet)
+        flags  = packet[0]
+        self.dup    = (flags & 0x08) == 0x08
+        self.qos    = (flags & 0x06) >> 1
+        self.retain = (flags & 0x01) == 0x01
+        start  = offset + 2
+        end    = start + packet[offset]*256 + packet[offset+1]
+        self.topic  = decodeTopicCache.get(bytes(view[start:end]))
         if self.qos:
-            self.msgId = decode16Int( packet_remaining[topicLen+2:topicLen+4] )
-            self.payload =  packet_remaining[topicLen+4:]
+            self.msgId = packet[end]*256 + packet[end+1]
+            end += 2
         else:
             self.msgId = None
-            self.payload = packet_remaining[topicLen+2:] # payload is a bytearray
+        self.payload = bytes(view[end:])
         
 
 # ------------------------------------------------------------------------------
 
 class PUBACK(object):
 
+    __slots__ = ('encoded', 'msgId')
+
     def __init__(self):
         self.encoded = None
         self.msgId   = None
@@ -575,23 +844,17 @@ class PUBACK(object):
         '''
         Encode and store a PUBACK control packet
         '''
-        header    = bytearray(1)
-        varHeader = encode16Int(self.msgId)
-        header[0] = 0x40 
-        header.extend(encodeLength(len(varHeader)))
-        header.extend(varHeader)
-        self.encoded = header
-        return str(header) if PY2 else bytes(header)
+        self.encoded = encodeAck(0x40, self.msgId)
+        return self.encoded
 
-    def decode(self, packet):
+    def decode(self, packet, offset=None):
         '''
         Decode a PUBACK control packet. 
         '''
         self.encoded = packet
-        lenLen = 1
-        while packet[lenLen] & 0x80:
-            lenLen += 1
-        packet_remaining = packet[lenLen+1:]
+        if offset is None:
+            offset = headerSize(packet)
+        packet_remaining = memoryview(packet)[offset:]
         self.msgId = decode16Int(packet_remaining)
 
 
@@ -599,6 +862,8 @@ class PUBACK(object):
 
 class PUBREC(object):
    
+    __slots__ = ('encoded', 'msgId')
+
     def __init__(self):
         self.encoded = None
         self.msgId   = None
@@ -607,23 +872,17 @@ class PUBREC(object):
         '''
         Encode and store a PUBREC control packet
         '''
-        header    = bytearray(1)
-        varHeader = encode16Int(self.msgId)
-        header[0] = 0x50 
-        header.extend(encodeLength(len(varHeader)))
-        header.extend(varHeader)
-        self.encoded = header
-        return str(header) if PY2 else bytes(header)
+        self.encoded = encodeAck(0x50, self.msgId)
+        return self.encoded
 
-    def decode(self, packet):
+    def decode(self, packet, offset=None):
         '''
         Decode a PUBREC control packet. 
         '''
         self.encoded = packet
-        lenLen = 1
-        while packet[lenLen] & 0x80:
-            lenLen += 1
-        packet_remaining = packet[lenLen+1:]
+        if offset is None:
+            offset = headerSize(packet)
+        packet_remaining = memoryview(packet)[offset:]
         self.msgId = decode16Int(packet_remaining)
 
 
@@ -631,32 +890,31 @@ class PUBREC(object):
 
 class PUBREL(object):
    
+    __slots__ = ('encoded', 'frames', 'msgId', 'dup')
+
     def __init__(self):
         self.encoded = None
+        self.frames  = None
         self.msgId   = None
         self.dup     = None
 
     def encode(self):
         '''
         Encode and store a PUBREL control packet
+        C{frames} keeps the original and the DUP flagged packets.
         '''
-        header    = bytearray(1)
-        varHeader = encode16Int(self.msgId)
-        header[0] = 0x62    # packet with QoS=1
-        header.extend(encodeLength(len(varHeader)))
-        header.extend(varHeader)
-        self.encoded = header
-        return str(header) if PY2 else bytes(header)
+        self.encoded = encodeAck(0x62, self.msgId)   # packet with QoS=1
+        self.frames  = (self.encoded, encodeAck(0x6A, self.msgId))
+        return self.encoded
 
-    def decode(self, packet):
+    def decode(self, packet, offset=None):
         '''
         Decode a PUBREL control packet. 
         '''
         self.encoded = packet
-        lenLen = 1
-        while packet[lenLen] & 0x80:
-            lenLen += 1
-        packet_remaining = packet[lenLen+1:]
+        if offset is None:
+            offset = headerSize(packet)
+        packet_remaining = memoryview(packet)[offset:]
         self.msgId  = decode16Int(packet_remaining)
         self.dup = (packet[0] & 0x08) == 0x08
 
@@ -665,6 +923,8 @@ class PUBREL(object):
 
 class PUBCOMP(object):
    
+    __slots__ = ('encoded', 'msgId')
+
     def __init__(self):
         self.encoded = None
         self.msgId    = None
@@ -673,29 +933,31 @@ class PUBCOMP(object):
         '''
         Encode and store a PUBCOMP control packet
         '''
-        header    = bytearray(1)
-        varHeader = encode16Int(self.msgId)
-        header[0] = 0x72 
-        header.extend(encodeLength(len(varHeader)))
-        header.extend(varHeader)
-        self.encoded = header
-        return str(header) if PY2 else bytes(header)
+        self.encoded = encodeAck(0x72, self.msgId)
+        return self.encoded
 
-    def decode(self, packet):
+    def decode(self, packet, offset=None):
         '''
         Decode a PUBCOMP control packet. 
         '''
         self.encoded = packet
-        lenLen = 1
-        while packet[lenLen] & 0x80:
-            lenLen += 1
-        packet_remaining = packet[lenLen+1:]
+        if offset is None:
+            offset = headerSize(packet)
+        packet_remaining = memoryview(packet)[offset:]
         self.msgId   = decode16Int(packet_remaining)
 
 # ------------------------------------------------------------------------------
 
 __all__ = [
     'decodeLength',
+    'headerSize',
+    'encodeAck',
+    'stampMsgId',
+    'encodeTopic',
+    'decodeTopic',
+    'TopicCache',
+    'encodeTopicCache',
+    'decodeTopicCache',
     'CONNECT',
     'CONNACK',
     'DISCONNECT',
@@ -21,10 +21,14 @@
 # WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 # ----------------------------------------------------------------------
 
+import array
+import mmap
+import tracemalloc
+
 from twisted.trial import unittest
 from twisted.test import proto_helpers
 
-from mqtt import v31, v311
+from mqtt import v31, v311, pdu
 from mqtt.pdu import (
     CONNECT,
     CONNACK,
@@ -40,6 +44,15 @@ from mqtt.pdu import (
     PUBREC,
     PUBREL,
     PUBCOMP,
+    encodeAck,
+    stampMsgId,
+    encodeTopic,
+    TopicCache,
+    encodeTopicCache,
+    decodeTopicCache,
+    encodeLength,
+    decodeLength,
+    headerSize,
     )
 
 class PDUTestCase(unittest.TestCase):
@@ -471,6 +484,171 @@ class PDUTestCase(unittest.TestCase):
         self.assertEqual(request.topic,   response.topic)
         self.assertEqual(request.payload, response.payload)
 
+    def test_PUBLISH_decode_memoryview(self):
+        request  = PUBLISH()
+        response = PUBLISH()
+        request.msgId   = 30001
+        request.qos     = 1
+        request.dup     = False
+        request.retain  = False
+        request.topic   = "foo/bar"
+        request.payload = bytearray(range(256))*4
+        packet = bytearray(request.encode())
+        view = memoryview(packet)
+        response.decode(view)
+        view.release()
+        packet[-1] ^= 0xFF      # payload must be owned, not a view
+        self.assertIsInstance(response.payload, bytes)
+        self.assertEqual(request.topic,   response.topic)
+        self.assertEqual(request.msgId,   response.msgId)
+        self.assertEqual(request.payload, response.payload)
+
+    def test_PUBLISH_encdec_payload_bytes(self):
+        request  = PUBLISH()
+        response = PUBLISH()
+        request.msgId   = 30001
+        request.qos     = 1
+        request.dup     = False
+        request.retain  = False
+        request.topic   = "foo"
+        request.payload = b'\x00\x01\x02\x03'
+        encoded = request.encode()
+        self.assertIsInstance(encoded, bytes)
+        response.decode(encoded)
+        self.assertEqual(request.topic,   response.topic)
+        self.assertEqual(request.payload, response.payload)
+
+    def test_PUBLISH_encdec_payload_buffers(self):
+        data = bytes(range(256))*4
+        mapped = mmap.mmap(-1, len(data))
+        mapped.write(data)
+        self.addCleanup(mapped.close)
+        for payload in (memoryview(data), memoryview(data)[256:512], 
+                        array.array('B', data), mapped):
+            request  = PUBLISH()
+            response = PUBLISH()
+            request.msgId   = 30001
+            request.qos     = 1
+            request.dup     = False
+            request.retain  = False
+            request.topic   = "foo"
+            request.payload = payload
+            response.decode(request.encode())
+            self.assertEqual(bytes(payload), response.payload)
+
+    def test_PUBLISH_encode_segments(self):
+        request  = PUBLISH()
+        request.msgId   = 30001
+        request.qos     = 1
+        request.dup     = False
+        request.retain  = False
+        request.topic   = "foo"
+        request.payload = bytes(range(256))*4
+        header, body = request.encodeSegments()
+        self.assertIs(body, request.payload)
+        self.assertEqual(len(header), 1 + 2 + 2 + 3 + 2)
+        self.assertEqual(header + body, request.encode())
+
+    def test_SUBSCRIBE_frames(self):
+        request = SUBSCRIBE()
+        request.topics = [('foo', 1), ('bar', 2)]
+        request.msgId = 5
+        encoded = request.encode()
+        original, dup = request.frames
+        self.assertIs(original, encoded)
+        self.assertEqual(dup[0], encoded[0] | 0x08)
+        self.assertEqual(dup[1:], encoded[1:])
+
+    def test_PUBLISH_frames(self):
+        request  = PUBLISH()
+        request.msgId   = 30001
+        request.qos     = 1
+        request.dup     = False
+        request.retain  = False
+        request.topic   = "foo"
+        request.payload = bytes(range(256))
+        request.encodeSegments()
+        (header, body), (dupHeader, dupBody) = request.frames
+        self.assertIs(body, request.payload)
+        self.assertIs(dupBody, request.payload)
+        self.assertEqual(dupHeader[0], header[0] | 0x08)
+        self.assertEqual(dupHeader[1:], header[1:])
+
+    def test_PUBLISH_encoded_topic(self):
+        request  = PUBLISH()
+        response = PUBLISH()
+        request.msgId   = 30001
+        request.qos     = 1
+        request.dup     = False
+        request.retain  = False
+        request.topic   = None
+        request.encodedTopic = encodeTopic("foo/\u00f1")
+        request.payload = b'hello'
+        response.decode(request.encode())
+        self.assertEqual(response.topic, "foo/\u00f1")
+        self.assertEqual(response.payload, b'hello')
+
+    def test_length_encdec(self):
+        for value in (0, 1, 127, 128, 300, 16383, 16384, 2097151, 2097152, 268435455):
+            encoded = encodeLength(value)
+            self.assertEqual(len(encoded), 1 + (value > 127) + (value > 16383) + (value > 2097151))
+            self.assertEqual(decodeLength(encoded), value)
+        self.assertEqual(encodeLength(321), b'\xc1\x02')
+
+    def test_PUBLISH_decode_offset(self):
+        request  = PUBLISH()
+        request.msgId   = 30001
+        request.qos     = 1
+        request.dup     = False
+        request.retain  = False
+        request.topic   = "foo"
+        request.payload = bytes(range(256))
+        encoded = request.encode()
+        self.assertEqual(headerSize(encoded), 3)
+        for offset in (None, 3):
+            response = PUBLISH()
+            response.decode(encoded, offset)
+            self.assertEqual(request.topic,   response.topic)
+            self.assertEqual(request.msgId,   response.msgId)
+            self.assertEqual(request.payload, response.payload)
+
+    def test_encodeAck(self):
+        for code, cls in ((0x40, PUBACK), (0x50, PUBREC), (0x62, PUBREL), (0x72, PUBCOMP)):
+            request = cls()
+            request.msgId = 0xABCD
+            encoded = encodeAck(code, 0xABCD)
+            self.assertEqual(encoded, bytes((code, 0x02, 0xAB, 0xCD)))
+            self.assertEqual(request.encode(), encoded)
+        self.assertRaises(ValueError, encodeAck, 0x40, -1)
+        self.assertRaises(ValueError, encodeAck, 0x40, 65536)
+
+    def test_stampMsgId(self):
+        request = PUBLISH()
+        request.msgId   = 0
+        request.qos     = 2
+        request.dup     = False
+        request.retain  = False
+        request.topic   = "foo/bar"
+        request.payload = b'0123456789'
+        request.encodeSegments()
+        frames = stampMsgId(request.frames, 0xABCD)
+        for dup, (header, payload) in enumerate(frames):
+            response = PUBLISH()
+            response.decode(header + payload)
+            self.assertEqual(response.msgId, 0xABCD)
+            self.assertEqual(response.dup, bool(dup))
+            self.assertIs(payload, request.payload)
+        self.assertRaises(ValueError, stampMsgId, request.frames, 65536)
+
+    def test_UNSUBSCRIBE_decode_memoryview(self):
+        request  = UNSUBSCRIBE()
+        response = UNSUBSCRIBE()
+        request.topics = ['foo', 'bar', 'baz']
+        request.msgId = 6
+        response.decode(memoryview(request.encode()))
+        self.assertEqual(request.msgId,  response.msgId)
+        self.assertEqual(request.topics, response.topics)
+
 
 class PDUTestCase2(unittest.TestCase):
 
@@ -507,5 +685,234 @@ class PDUTestCase2(unittest.TestCase):
         request.topic   = "foo"
         request.payload = 12.25
         self.assertRaises(TypeError, request.encode)
+
+    def test_PDU_slots(self):
+        for cls in (CONNECT, CONNACK, DISCONNECT, PINGREQ, PINGRES, SUBSCRIBE, SUBACK, 
+                    UNSUBSCRIBE, UNSUBACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP):
+            request = cls()
+            self.assertFalse(hasattr(request, '__dict__'), cls.__name__)
+            self.assertRaises(AttributeError, setattr, request, 'deferred', None)
     
         
+
+
+class PDUAllocationTestCase(unittest.TestCase):
+    '''
+    Encoders compute the packet length first and fill a single buffer.
+    The memory blocks allocated in mqtt.pdu and still in use after an 
+    encoder call are counted exactly: the encoded packet(s) and nothing 
+    else. Variable size packets are also measured with a large string 
+    field, so that the peak of allocated memory, temporaries included,
+    is expressed in copies of the packet.
+    '''
+
+    TOPIC = 't' * 20000
+
+    def startTracing(self):
+        '''Returns the memory in use, accounting for the returned value'''
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        return base
+
+    def snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(True, pdu.__file__)])
+
+    def blocks(self, encode):
+        '''Returns the number of blocks allocated by an encoder call and still in use'''
+        encode()                # warm up, caches included
+        encode()
+        self.startTracing()
+        before  = self.snapshot()
+        encoded = encode()
+        after   = self.snapshot()
+        return sum(stat.count_diff for stat in after.compare_to(before, 'lineno'))
+
+    def peak(self, request):
+        '''Returns the peak of memory allocated by encode() and its result'''
+        request.encode()        # warm up
+        request.encoded = None
+        if 'frames' in request.__slots__:
+            request.frames = None
+        base = self.startTracing()
+        encoded = request.encode()
+        return tracemalloc.get_traced_memory()[1] - base, encoded
+
+    def assertBlocks(self, request, count):
+        self.assertEqual(self.blocks(request.encode), count)
+
+    def assertCopies(self, request, copies):
+        peak, encoded = self.peak(request)
+        self.assertLess(peak, (copies + 0.5) * len(encoded))
+
+    def test_DISCONNECT(self):
+        # constant packet
+        self.assertBlocks(DISCONNECT(), 0)
+
+    def test_PINGREQ(self):
+        self.assertBlocks(PINGREQ(), 0)
+
+    def test_PINGRES(self):
+        self.assertBlocks(PINGRES(), 0)
+
+    def test_CONNACK(self):
+        request = CONNACK()
+        request.session    = True
+        request.resultCode = 2
+        self.assertBlocks(request, 1)
+
+    def test_PUBACK(self):
+        # packed in a single step
+        request = PUBACK()
+        request.msgId = 1234
+        self.assertBlocks(request, 1)
+
+    def test_PUBREC(self):
+        request = PUBREC()
+        request.msgId = 1234
+        self.assertBlocks(request, 1)
+
+    def test_PUBCOMP(self):
+        request = PUBCOMP()
+        request.msgId = 1234
+        self.assertBlocks(request, 1)
+
+    def test_UNSUBACK(self):
+        request = UNSUBACK()
+        request.msgId = 1234
+        self.assertBlocks(request, 1)
+
+    def test_PUBREL(self):
+        # original and DUP flagged packets
+        request = PUBREL()
+        request.msgId = 1234
+        self.assertBlocks(request, 2)
+
+    def test_CONNECT(self):
+        request = CONNECT()
+        request.clientId   = self.TOPIC
+        request.keepalive  = 0
+        request.willTopic  = None
+        request.willMessage= None
+        request.username   = None
+        request.password   = None
+        request.cleanStart = True
+        request.version    = v311
+        self.assertBlocks(request, 1)
+        # UTF-8 string, buffer and packet
+        self.assertCopies(request, 3)
+
+    def test_SUBACK(self):
+        request = SUBACK()
+        request.msgId   = 1234
+        request.granted = [(1, False)] * 20000
+        self.assertBlocks(request, 1)
+        # buffer and packet
+        self.assertCopies(request, 2)
+
+    def test_SUBSCRIBE(self):
+        request = SUBSCRIBE()
+        request.msgId  = 1234
+        request.topics = [(self.TOPIC, 1)]
+        # original and DUP flagged packets
+        self.assertBlocks(request, 2)
+        # UTF-8 string, buffer, original and DUP flagged packets
+        self.assertCopies(request, 4)
+
+    def test_UNSUBSCRIBE(self):
+        request = UNSUBSCRIBE()
+        request.msgId  = 1234
+        request.topics = [self.TOPIC]
+        self.assertBlocks(request, 2)
+        self.assertCopies(request, 4)
+
+    def test_PUBLISH(self):
+        request = PUBLISH()
+        request.msgId   = 1234
+        request.qos     = 1
+        request.dup     = False
+        request.retain  = False
+        request.topic   = self.TOPIC
+        request.payload = b'0123456789'
+        # original and DUP flagged headers, the bytes payload is shared
+        request.encodedTopic = encodeTopic(request.topic)
+        self.assertEqual(self.blocks(request.encodeSegments), 2)
+        request.encodedTopic = None
+        request.frames  = None
+        base = self.startTracing()
+        header, body = request.encodeSegments()
+        peak = tracemalloc.get_traced_memory()[1] - base
+        # UTF-8 string, buffer, original and DUP flagged headers
+        self.assertLess(peak, 4.5 * len(header))
+
+    def test_PUBLISH_encode(self):
+        request = PUBLISH()
+        request.msgId   = 1234
+        request.qos     = 1
+        request.dup     = False
+        request.retain  = False
+        request.encodedTopic = encodeTopic("foo/bar")
+        request.payload = b'0123456789'
+        # headers and the single copy of the payload in the packet
+        self.assertBlocks(request, 3)
+
+
+class TopicCacheTestCase(unittest.TestCase):
+
+    def test_hits_misses(self):
+        cache = TopicCache(encodeTopic, size=2)
+        self.assertEqual(cache.get("foo"), b'\x00\x03foo')
+        self.assertEqual(cache.get("foo"), b'\x00\x03foo')
+        self.assertEqual(cache.get("bar"), b'\x00\x03bar')
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        self.assertEqual(len(cache), 2)
+
+    def test_lru_eviction(self):
+        cache = TopicCache(encodeTopic, size=2)
+        cache.get("foo")
+        cache.get("bar")
+        cache.get("foo")        # bar is now the least recently used
+        cache.get("baz")
+        cache.get("foo")
+        self.assertEqual((cache.hits, cache.misses), (2, 3))
+        cache.get("bar")
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+
+    def test_resize(self):
+        cache = TopicCache(encodeTopic, size=4)
+        for topic in ("a", "b", "c", "d"):
+            cache.get(topic)
+        cache.resize(1)
+        self.assertEqual(len(cache), 1)
+        cache.get("d")
+        self.assertEqual(cache.hits, 1)
+        cache.resize(0)
+        cache.get("d")
+        cache.get("d")
+        self.assertEqual((len(cache), cache.hits, cache.misses), (0, 1, 6))
+        self.assertRaises(ValueError, cache.resize, -1)
+
+    def test_encode_error_not_cached(self):
+        cache = TopicCache(encodeTopic)
+        self.assertRaises(ValueError, cache.get, "t"*65536)
+        self.assertEqual(len(cache), 0)
+
+    def test_PUBLISH_caches(self):
+        encodeTopicCache.clear()
+        decodeTopicCache.clear()
+        request  = PUBLISH()
+        request.msgId   = 30001
+        request.qos     = 1
+        request.dup     = False
+        request.retain  = False
+        request.topic   = "foo/bar"
+        request.payload = b'hello'
+        response1 = PUBLISH()
+        response2 = PUBLISH()
+        response1.decode(request.encode())
+        response2.decode(request.encode())
+        self.assertEqual((encodeTopicCache.hits, encodeTopicCache.misses), (1, 1))
+        self.assertEqual((decodeTopicCache.hits, decodeTopicCache.misses), (1, 1))
+        self.assertEqual(response1.topic, "foo/bar")
+        self.assertIs(response1.topic, response2.topic)